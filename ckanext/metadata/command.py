@@ -13,6 +13,25 @@ class MetadataFrameworkCommand(tk.CkanCommand):
     Usage:
         paster metadata_framework initdb
             - Initialize the database tables for the metadata framework
+        paster metadata_framework backfill_attrs
+            - Re-populate the indexed metadata record attributes (DOI, SID, collection,
+              standard, workflow state, validated) from the metadata record extras
+        paster metadata_framework create_indexes [--explain]
+            - Create (concurrently) the indexes on core CKAN tables that are used by the
+              metadata framework queries; with --explain, show the query plans of the
+              hot queries before and after
+        paster metadata_framework revalidation_worker [--once]
+            - Revalidate the metadata records in the background revalidation queue, at the
+              configured rate; with --once, exit when the queue is empty
+        paster metadata_framework index_outbox_relay [--once]
+            - Send pending search index updates to the Elastic search agent (requires the
+              metadata_elasticsearch plugin, with ckan.metadata.elastic.index_outbox enabled);
+              with --once, exit when there are none left
+        paster metadata_framework index_audit [--repair]
+            - Compare the published metadata records of each metadata standard with the
+              documents in its search index (requires the metadata_elasticsearch plugin), and
+              report missing, stale and orphaned documents; with --repair, fix the differences.
+              An index that cannot be audited is reported, and the others are still audited.
         paster metadata_framework init_permissions
             - Initialize the permissions for the metadata framework action API
         paster metadata_framework reset_permissions
@@ -37,6 +56,16 @@ class MetadataFrameworkCommand(tk.CkanCommand):
 
         if cmd == 'initdb':
             self._initdb()
+        elif cmd == 'backfill_attrs':
+            self._backfill_attrs()
+        elif cmd == 'create_indexes':
+            self._create_indexes('--explain' in self.args[1:])
+        elif cmd == 'revalidation_worker':
+            self._revalidation_worker('--once' in self.args[1:])
+        elif cmd == 'index_outbox_relay':
+            self._index_outbox_relay('--once' in self.args[1:])
+        elif cmd == 'index_audit':
+            self._index_audit('--repair' in self.args[1:])
         elif cmd == 'init_permissions':
             self._init_permissions()
         elif cmd == 'reset_permissions':
@@ -51,6 +80,86 @@ class MetadataFrameworkCommand(tk.CkanCommand):
         setup.init_tables()
         self.log.info("Metadata tables have been initialized")
 
+    def _backfill_attrs(self):
+        from ckanext.metadata.model import setup
+        count = setup.backfill_metadata_record_attrs()
+        self.log.info("Indexed attributes have been backfilled for %d metadata records", count)
+
+    def _create_indexes(self, explain):
+        from ckanext.metadata.model import setup
+        if explain:
+            plans_before = setup.explain_hot_queries()
+
+        for name, status in setup.create_indexes():
+            print "%s: %s" % (name, status)
+
+        if explain:
+            plans_after = setup.explain_hot_queries()
+            for (name, plan_before), (_name, plan_after) in zip(plans_before, plans_after):
+                print
+                print "=== %s ===" % name
+                print "--- before:"
+                print plan_before
+                print "--- after:"
+                print plan_after
+
+        self.log.info("Indexes have been created")
+
+    def _revalidation_worker(self, once):
+        from ckanext.metadata.lib import revalidation_queue
+        self.log.info("Revalidation worker started")
+        revalidation_queue.drain(once)
+        self.log.info("Revalidation queue is empty")
+
+    def _index_outbox_relay(self, once):
+        from ckanext.metadata.elastic import outbox
+        self.log.info("Search index outbox relay started")
+        outbox.relay(once)
+        self.log.info("Search index outbox relay stopped")
+
+    def _index_audit(self, repair):
+        from ckan import model
+        from ckanext.metadata.elastic import audit, client
+        import ckanext.metadata.model as ckanext_model
+
+        indexes = client.get_indexes()
+        if not indexes['success']:
+            print indexes['msg']
+            sys.exit(1)
+
+        metadata_standards = model.Session.query(ckanext_model.MetadataStandard) \
+            .filter_by(state='active') \
+            .order_by(ckanext_model.MetadataStandard.name) \
+            .all()
+        failed_standards = []
+        for metadata_standard in metadata_standards:
+            if metadata_standard.name not in indexes['indexes']:
+                continue
+            print "=== %s ===" % metadata_standard.name
+            try:
+                report = audit.audit_index(model.Session, metadata_standard, repair)
+            except tk.ValidationError, e:
+                model.Session.rollback()
+                self.log.error("Audit of search index '%s' failed: %s", metadata_standard.name, e.error_dict)
+                print "audit failed: %s" % (e.error_dict,)
+                failed_standards += [metadata_standard.name]
+                continue
+
+            print "published records: %d; indexed records: %d" % (report['db_count'], report['index_count'])
+            for key in ('missing', 'stale', 'orphaned'):
+                print "%s: %d" % (key, len(report[key]))
+                for record_id in report[key]:
+                    print "    %s" % record_id
+            if repair:
+                print "repaired: %d; failed: %d" % (
+                    len(report['missing']) + len(report['stale']) + len(report['orphaned']) - report['repair_failed'],
+                    report['repair_failed'])
+
+        if failed_standards:
+            self.log.error("Search index audit failed for: %s", ', '.join(failed_standards))
+            sys.exit(1)
+        self.log.info("Search index audit is complete")
+
     def _init_permissions(self):
         from ckanext.metadata.logic import setup_permissions
         setup_permissions.init_permissions()
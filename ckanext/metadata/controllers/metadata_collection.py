@@ -161,14 +161,14 @@ class MetadataCollectionController(GroupController):
             context['user_is_admin'] = tk.c.userobj.sysadmin
 
         try:
-            data_dict_global_results = {
+            data_dict_count = {
                 'owner_org': organization_id,
                 'metadata_collection_id': id,
-                'all_fields': False,
+                'count_only': True,
                 'q': q,
                 'type': 'metadata_record',
             }
-            global_results = tk.get_action('metadata_record_list')(context, data_dict_global_results)
+            item_count = tk.get_action('metadata_record_list')(context, data_dict_count)
         except tk.ValidationError as e:
             if e.error_dict and e.error_dict.get('message'):
                 msg = e.error_dict['message']
@@ -192,9 +192,10 @@ class MetadataCollectionController(GroupController):
             record['workflow_state'] = workflow_states.get(record['workflow_state_id'], '')
 
         tk.c.page = helpers.Page(
-            collection=global_results,
+            collection=page_results,
             page=page,
             url=tk.h.pager_url,
+            item_count=item_count,
             items_per_page=limit,
         )
 
@@ -220,7 +221,8 @@ class MetadataCollectionController(GroupController):
         self._set_organization_context(organization_id)
 
         return tk.render('metadata_collection/bulk_action.html', extra_vars={
-            'workflow_state_lookup_list': self._workflow_state_lookup_list()})
+            'workflow_state_lookup_list': self._workflow_state_lookup_list(),
+            'bulk_job_id': tk.request.params.get('bulk_job_id')})
 
     @staticmethod
     def _bulk_validate(id, organization_id, async, context):
@@ -236,7 +238,8 @@ class MetadataCollectionController(GroupController):
         except tk.ObjectNotFound:
             tk.abort(404, tk._('Metadata collection not found'))
 
-        tk.h.redirect_to('metadata_collection_bulk_action', id=id, organization_id=organization_id)
+        tk.h.redirect_to('metadata_collection_bulk_action', id=id, organization_id=organization_id,
+                         bulk_job_id=result['job_group_id'] if async else None)
 
     @staticmethod
     def _bulk_transition(id, organization_id, workflow_state_id, async, context):
@@ -254,7 +257,8 @@ class MetadataCollectionController(GroupController):
         except tk.ObjectNotFound:
             tk.abort(404, tk._('Metadata collection not found'))
 
-        tk.h.redirect_to('metadata_collection_bulk_action', id=id, organization_id=organization_id)
+        tk.h.redirect_to('metadata_collection_bulk_action', id=id, organization_id=organization_id,
+                         bulk_job_id=result['job_group_id'] if async else None)
 
     @staticmethod
     def _workflow_state_lookup_list():
@@ -4,9 +4,13 @@ import logging
 from paste.deploy.converters import asbool
 
 import ckan.plugins.toolkit as tk
-from ckan.common import _
+from ckan.common import _, config
+from ckan import model as ckan_model
 from ckanext.metadata.elastic import client
+from ckanext.metadata.elastic import bulk_index
+from ckanext.metadata.elastic import transport
 import ckanext.metadata.model as ckanext_model
+from ckanext.metadata.lib import after_commit
 from ckan.logic.action.update import organization_update as ckan_org_update
 
 log = logging.getLogger(__name__)
@@ -18,7 +22,7 @@ def metadata_standard_index_create(original_action, context, data_dict):
     Initialize a metadata search index.
 
     Creates the index and then pushes all published metadata records associated with
-    the metadata standard to the index asynchronously.
+    the metadata standard to the index asynchronously, in batches.
 
     :param id: the id or name of the metadata standard
     :type id: string
@@ -41,22 +45,17 @@ def metadata_standard_index_create(original_action, context, data_dict):
     model = context['model']
     session = context['session']
 
-    metadata_records = session.query(model.Package).join(model.PackageExtra) \
-        .filter(model.PackageExtra.key == 'metadata_standard_id') \
-        .filter(model.PackageExtra.value == metadata_standard.id) \
-        .filter(model.Package.type == 'metadata_record') \
-        .filter(model.Package.state == 'active') \
-        .filter(model.Package.private == False) \
-        .all()
+    log.info("Queueing records for insertion into index '%s'", metadata_standard.name)
 
-    log.info("Queueing %d records for insertion into index '%s'" % (len(metadata_records), metadata_standard.name))
+    result = bulk_index.index_metadata_records(session, [
+        ckanext_model.MetadataRecordAttrs.metadata_standard_id == metadata_standard.id,
+        model.Package.state == 'active',
+        model.Package.private == False,
+    ])
 
-    for metadata_record in metadata_records:
-        index_context = context.copy()
-        index_context['metadata_record'] = metadata_record
-        tk.get_action('metadata_record_index_update')(index_context, {'id': metadata_record.id, 'async': True})
+    log.info("Queued %d records for insertion into index '%s'", result['records_added'], metadata_standard.name)
 
-    return {'records_queued': len(metadata_records)}
+    return {'records_queued': result['records_added']}
 
 
 @tk.chained_action
@@ -90,6 +89,12 @@ def metadata_record_index_update(original_action, context, data_dict):
     AND active (= not deleted), then add the record to the index (update if already
     present); otherwise, remove the record if present in the index.
 
+    If async, the request is sent to the search agent via Celery once the current
+    transaction commits. If ``ckan.metadata.elastic.index_outbox`` is enabled, the
+    operation is instead written to the search index outbox, in the current transaction,
+    and is sent to the search agent by the outbox relay worker
+    (``paster metadata_framework index_outbox_relay``).
+
     :param id: the id or name of the metadata record
     :type id: string
     :param async: update the index asynchronously (optional, default: ``True``)
@@ -100,6 +105,7 @@ def metadata_record_index_update(original_action, context, data_dict):
     model = context['model']
     session = context['session']
     async = asbool(data_dict.get('async', True))
+    defer_commit = context.get('defer_commit', False)
 
     metadata_record = context.get('metadata_record')
     if not metadata_record:
@@ -113,6 +119,18 @@ def metadata_record_index_update(original_action, context, data_dict):
         .scalar()
     record_id = metadata_record.id
 
+    if async and asbool(config.get('ckan.metadata.elastic.index_outbox', False)):
+        if not metadata_record.private and metadata_record.state == 'active':
+            log.debug("Queueing addition of metadata record to search index: %s", record_id)
+            operation = ckanext_model.IndexOutbox.PUT
+        else:
+            log.debug("Queueing removal of metadata record from search index: %s", record_id)
+            operation = ckanext_model.IndexOutbox.DELETE
+        ckanext_model.IndexOutbox.add(record_id, index_name, operation)
+        if not defer_commit:
+            model.repo.commit()
+        return
+
     if not metadata_record.private and metadata_record.state == 'active':
         log.debug("Adding metadata record to search index: %s", record_id)
 
@@ -132,13 +150,22 @@ def metadata_record_index_update(original_action, context, data_dict):
             .all()
         infrastructure_titles = [title for (title,) in infrastructure_titles]
 
-        result = client.put_record(index_name, record_id, metadata_record.extras['metadata_json'],
-                                   organization_title, collection_title, infrastructure_titles, async)
+        request = (client.put_record, [index_name, record_id, metadata_record.extras['metadata_json'],
+                                       organization_title, collection_title, infrastructure_titles])
     else:
         log.debug("Removing metadata record from search index: %s", record_id)
-        result = client.delete_record(index_name, record_id, async)
+        request = (client.delete_record, [index_name, record_id])
 
-    if not async and not result['success']:
+    if async:
+        # the document is built now, but only sent if the change is committed
+        after_commit.add(session, _AFTER_COMMIT_NAME, request)
+        if not defer_commit:
+            model.repo.commit()
+        return
+
+    func, args = request
+    result = func(*(args + [False]))
+    if not result['success']:
         raise tk.ValidationError(result['msg'])
 
 
@@ -201,13 +228,29 @@ def metadata_record_index_show(original_action, context, data_dict):
     return result.get('record')
 
 
+@tk.chained_action
+def search_agent_stats(original_action, context, data_dict):
+    """
+    Get statistics on the requests made by this process to the Elastic search agent.
+
+    :returns: { circuit, consecutive_failures, endpoints }, where circuit is the state of the
+        circuit breaker ('closed', 'open' or 'half_open'), and endpoints maps each search agent
+        endpoint to a latency histogram { count, errors, total_seconds, buckets }
+    :rtype: dictionary
+    """
+    original_action(context, data_dict)
+    return transport.stats()
+
+
 @tk.chained_action
 def infrastructure_update(original_action, context, data_dict):
     """
     Hook into this action so that we can update the search index if an infrastructure title changes.
+
+    The affected metadata records are re-indexed by a background job, the id of which is
+    returned in the result dict as 'index_job_id'.
     """
     model = context['model']
-    session = context['session']
     return_id_only = context.get('return_id_only', False)
 
     update_search_index = False
@@ -225,21 +268,9 @@ def infrastructure_update(original_action, context, data_dict):
     infrastructure_id = result if return_id_only else result['id']
 
     if update_search_index:
-        metadata_records = session.query(model.Package) \
-            .join(model.PackageExtra, model.Package.id == model.PackageExtra.package_id) \
-            .filter(model.PackageExtra.key == 'metadata_collection_id') \
-            .join(model.Member, model.PackageExtra.value == model.Member.table_id) \
-            .filter(model.Member.group_id == infrastructure_id) \
-            .filter(model.Member.table_name == 'group') \
-            .filter(model.Member.state != 'deleted') \
-            .filter(model.Package.type == 'metadata_record') \
-            .filter(model.Package.state != 'deleted') \
-            .all()
-
-        for metadata_record in metadata_records:
-            index_context = context.copy()
-            index_context['metadata_record'] = metadata_record
-            tk.get_action('metadata_record_index_update')(index_context, {'id': metadata_record.id})
+        job_id = bulk_index.enqueue_reindex(context, 'infrastructure', infrastructure_id)
+        if not return_id_only:
+            result['index_job_id'] = job_id
 
     return result
 
@@ -249,6 +280,9 @@ def metadata_collection_update(original_action, context, data_dict):
     """
     Hook into this action so that we can update the search index if a metadata collection title changes
     or if its infrastructure list changes.
+
+    The affected metadata records are re-indexed by a background job, the id of which is
+    returned in the result dict as 'index_job_id'.
     """
     model = context['model']
     session = context['session']
@@ -288,18 +322,9 @@ def metadata_collection_update(original_action, context, data_dict):
     metadata_collection_id = result if return_id_only else result['id']
 
     if update_search_index:
-        metadata_records = session.query(model.Package) \
-            .join(model.PackageExtra, model.Package.id == model.PackageExtra.package_id) \
-            .filter(model.PackageExtra.key == 'metadata_collection_id') \
-            .filter(model.PackageExtra.value == metadata_collection_id) \
-            .filter(model.Package.type == 'metadata_record') \
-            .filter(model.Package.state != 'deleted') \
-            .all()
-
-        for metadata_record in metadata_records:
-            index_context = context.copy()
-            index_context['metadata_record'] = metadata_record
-            tk.get_action('metadata_record_index_update')(index_context, {'id': metadata_record.id})
+        job_id = bulk_index.enqueue_reindex(context, 'metadata_collection', metadata_collection_id)
+        if not return_id_only:
+            result['index_job_id'] = job_id
 
     return result
 
@@ -307,9 +332,11 @@ def metadata_collection_update(original_action, context, data_dict):
 def organization_update(context, data_dict):
     """
     Hook into this action so that we can update the search index if an organization title changes.
+
+    The affected metadata records are re-indexed by a background job, the id of which is
+    returned in the result dict as 'index_job_id'.
     """
     model = context['model']
-    session = context['session']
     return_id_only = context.get('return_id_only', False)
 
     update_search_index = False
@@ -327,15 +354,20 @@ def organization_update(context, data_dict):
     organization_id = result if return_id_only else result['id']
 
     if update_search_index:
-        metadata_records = session.query(model.Package) \
-            .filter(model.Package.owner_org == organization_id) \
-            .filter(model.Package.type == 'metadata_record') \
-            .filter(model.Package.state != 'deleted') \
-            .all()
-
-        for metadata_record in metadata_records:
-            index_context = context.copy()
-            index_context['metadata_record'] = metadata_record
-            tk.get_action('metadata_record_index_update')(index_context, {'id': metadata_record.id})
+        job_id = bulk_index.enqueue_reindex(context, 'organization', organization_id)
+        if not return_id_only:
+            result['index_job_id'] = job_id
 
     return result
+
+
+_AFTER_COMMIT_NAME = 'metadata_elastic_index_requests'
+
+
+@after_commit.handler(_AFTER_COMMIT_NAME)
+def _send_requests(requests):
+    for func, args in requests:
+        try:
+            func(*(args + [True]))
+        except Exception:
+            log.exception("Error dispatching search index update for metadata record %s", args[1])
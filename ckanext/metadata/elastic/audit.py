@@ -0,0 +1,150 @@
+# encoding: utf-8
+
+import logging
+import json
+import hashlib
+from paste.deploy.converters import asint
+
+import ckan.plugins.toolkit as tk
+from ckan.common import config
+from ckan import model as ckan_model
+from ckanext.metadata.elastic import client
+from ckanext.metadata.elastic.bulk_index import record_query, documents, index_metadata_records, DEFAULT_BATCH_SIZE
+import ckanext.metadata.model as ckanext_model
+
+log = logging.getLogger(__name__)
+
+
+def content_hash(document):
+    """
+    Compute a hash of the content of a search index document - as built from the DB, or as
+    returned by the search agent - that is independent of key order and of whether the
+    metadata JSON is serialized.
+    """
+    metadata_json = document.get('metadata_json')
+    if isinstance(metadata_json, basestring):
+        try:
+            metadata_json = json.loads(metadata_json)
+        except ValueError:
+            pass
+    content = {
+        'metadata_json': metadata_json,
+        'organization': document.get('organization'),
+        'collection': document.get('collection'),
+        'infrastructures': sorted(document.get('infrastructures') or []),
+    }
+    return hashlib.sha1(json.dumps(content, sort_keys=True)).hexdigest()
+
+
+def audit_index(session, metadata_standard, repair=False):
+    """
+    Compare the published metadata records of a metadata standard with the documents in
+    its search index, and optionally repair any differences.
+
+    Record ids and content hashes are streamed from the DB and from the search agent a page
+    (of ``ckan.metadata.elastic.bulk_batch_size``) at a time, both sorted by record id - the
+    index being paged by key, following the last record id of the previous page - and
+    are compared by merging the two streams; so memory use is proportional to the number of
+    differences found, rather than to the size of the index. Repairs are made after the
+    comparison is complete, so as not to disturb the paging of the index.
+
+    :param session: DB session
+    :param metadata_standard: MetadataStandard object; its name is the index name
+    :param repair: add/update the missing and stale records, and remove the orphaned records
+    :returns: dict{'db_count', 'index_count', 'missing', 'stale', 'orphaned', 'repair_failed'},
+        where missing, stale and orphaned are lists of record ids: published records that are
+        not in the index, published records whose indexed content differs, and indexed records
+        that are not published, respectively
+    """
+    batch_size = max(1, asint(config.get('ckan.metadata.elastic.bulk_batch_size', DEFAULT_BATCH_SIZE)))
+    report = {
+        'db_count': 0,
+        'index_count': 0,
+        'missing': [],
+        'stale': [],
+        'orphaned': [],
+        'repair_failed': 0,
+    }
+
+    db_stream = _db_hashes(session, metadata_standard, batch_size)
+    index_stream = _index_hashes(metadata_standard.name, batch_size)
+    db_item = next(db_stream, None)
+    index_item = next(index_stream, None)
+    while db_item is not None or index_item is not None:
+        if index_item is None or (db_item is not None and db_item[0] < index_item[0]):
+            report['missing'] += [db_item[0]]
+            report['db_count'] += 1
+            db_item = next(db_stream, None)
+        elif db_item is None or index_item[0] < db_item[0]:
+            report['orphaned'] += [index_item[0]]
+            report['index_count'] += 1
+            index_item = next(index_stream, None)
+        else:
+            if db_item[1] != index_item[1]:
+                report['stale'] += [db_item[0]]
+            report['db_count'] += 1
+            report['index_count'] += 1
+            db_item = next(db_stream, None)
+            index_item = next(index_stream, None)
+
+    log.info("Audited search index '%s': %d missing, %d stale, %d orphaned", metadata_standard.name,
+             len(report['missing']), len(report['stale']), len(report['orphaned']))
+
+    if repair:
+        put_ids = report['missing'] + report['stale']
+        for i in range(0, len(put_ids), batch_size):
+            counts = index_metadata_records(session, [ckan_model.Package.id.in_(put_ids[i:i + batch_size])],
+                                            async=False)
+            report['repair_failed'] += counts['records_failed']
+
+        for record_id in report['orphaned']:
+            result = client.delete_record(metadata_standard.name, record_id, False)
+            if not result['success']:
+                log.error("Removal of record %s from '%s' failed: %s", record_id, metadata_standard.name, result['msg'])
+                report['repair_failed'] += 1
+
+    return report
+
+
+def _db_hashes(session, metadata_standard, batch_size):
+    """
+    Yield (record_id, content_hash) for the published records of a metadata standard,
+    in order of record id.
+    """
+    rows = record_query(session, [
+        ckanext_model.MetadataRecordAttrs.metadata_standard_id == metadata_standard.id,
+        ckan_model.Package.state == 'active',
+        ckan_model.Package.private == False,
+    ]).order_by(ckan_model.Package.id.collate('C')).yield_per(batch_size)
+
+    page = []
+    for row in rows:
+        page += [row]
+        if len(page) == batch_size:
+            for record_id, _index_name, document in documents(session, page):
+                yield record_id, content_hash(document)
+            page = []
+    for record_id, _index_name, document in documents(session, page):
+        yield record_id, content_hash(document)
+
+
+def _index_hashes(index_name, batch_size):
+    """
+    Yield (record_id, content_hash) for the documents in a search index, in order of record id.
+    """
+    last_record_id = None
+    while True:
+        result = client.get_records(index_name, batch_size, last_record_id)
+        if not result['success']:
+            raise tk.ValidationError(result['msg'])
+
+        for record in result['results']:
+            record_id = record.get('record_id')
+            if last_record_id is not None and record_id <= last_record_id:
+                raise tk.ValidationError("Search index '%s' did not return records in order of record id"
+                                         % index_name)
+            last_record_id = record_id
+            yield record_id, content_hash(record)
+
+        if len(result['results']) < batch_size:
+            break
@@ -0,0 +1,295 @@
+# encoding: utf-8
+
+import logging
+import time
+from paste.deploy.converters import asint, asbool
+from sqlalchemy import and_
+from sqlalchemy.orm import aliased
+
+import ckan.plugins.toolkit as tk
+from ckan.common import config
+from ckan import model as ckan_model
+from ckan.lib.redis import connect_to_redis
+from ckanext.metadata.elastic import client
+import ckanext.metadata.model as ckanext_model
+from ckanext.metadata.lib import after_commit
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 500
+
+
+def index_metadata_records(session, criteria, async=True, results=None):
+    """
+    Add/update/delete metadata records in the search indexes, in batches, with the same
+    outcome as calling ``metadata_record_index_update`` for each record.
+
+    Records are streamed from the DB a page at a time. The organization and collection titles
+    are fetched in the same query as the records, and the infrastructure titles with one
+    query per page. Published, active records are sent to the search agent - as one bulk
+    request per page per index if ``ckan.metadata.elastic.bulk_add`` is enabled, otherwise
+    one request per record; any other records are removed from the index.
+
+    :param session: DB session
+    :param criteria: list of SQLAlchemy filter clauses selecting the metadata records, in terms
+        of Package and/or MetadataRecordAttrs columns
+    :param async: send the requests to the search agent asynchronously
+    :param results: if given (and not async), a dict that is filled with the search agent's
+        result for each record, keyed by record id; for a bulk request, every record in the
+        request gets the same result
+    :returns: dict{'records_added': count, 'records_removed': count, 'records_failed': count},
+        where records_failed is the number of records whose requests were rejected by, or
+        could not be sent to, the search agent (always 0 if async)
+    """
+    batch_size = max(1, asint(config.get('ckan.metadata.elastic.bulk_batch_size', DEFAULT_BATCH_SIZE)))
+    bulk_add = asbool(config.get('ckan.metadata.elastic.bulk_add', False))
+    rows = record_query(session, criteria).yield_per(batch_size)
+
+    counts = {
+        'records_added': 0,
+        'records_removed': 0,
+        'records_failed': 0,
+    }
+    page = []
+    for row in rows:
+        page += [row]
+        if len(page) == batch_size:
+            _index_page(session, page, async, bulk_add, counts, results)
+            page = []
+    if page:
+        _index_page(session, page, async, bulk_add, counts, results)
+
+    return counts
+
+
+def record_query(session, criteria):
+    """
+    Build a query for the metadata records matching the given criteria, with the columns
+    needed to build their search index documents (see :py:func:`documents`).
+
+    :param session: DB session
+    :param criteria: list of SQLAlchemy filter clauses, in terms of Package and/or
+        MetadataRecordAttrs columns
+    """
+    organization = aliased(ckan_model.Group)
+    collection = aliased(ckan_model.Group)
+    attrs = ckanext_model.MetadataRecordAttrs
+
+    return session.query(ckan_model.Package.id,
+                         ckan_model.Package.private,
+                         ckan_model.Package.state,
+                         ckanext_model.MetadataStandard.name,
+                         ckan_model.PackageExtra.value,
+                         attrs.metadata_collection_id,
+                         organization.title,
+                         collection.title) \
+        .join(attrs, ckan_model.Package.id == attrs.package_id) \
+        .join(ckanext_model.MetadataStandard, ckanext_model.MetadataStandard.id == attrs.metadata_standard_id) \
+        .outerjoin(ckan_model.PackageExtra, and_(ckan_model.PackageExtra.package_id == ckan_model.Package.id,
+                                                 ckan_model.PackageExtra.key == 'metadata_json',
+                                                 ckan_model.PackageExtra.state == 'active')) \
+        .outerjoin(organization, organization.id == ckan_model.Package.owner_org) \
+        .outerjoin(collection, collection.id == attrs.metadata_collection_id) \
+        .filter(ckan_model.Package.type == 'metadata_record') \
+        .filter(*criteria)
+
+
+def documents(session, page):
+    """
+    Build the search index documents for a page of rows returned by :py:func:`record_query`.
+
+    :returns: list of (record_id, index_name, document) tuples, where document is None if
+        the record should not be in the index (i.e. is private or deleted)
+    """
+    infrastructure_titles = _infrastructure_titles(session, set(row[5] for row in page if row[5]))
+    result = []
+    for record_id, private, state, index_name, metadata_json, collection_id, organization_title, collection_title in page:
+        if not private and state == 'active':
+            document = {
+                'record_id': record_id,
+                'metadata_json': metadata_json,
+                'organization': organization_title,
+                'collection': collection_title,
+                'infrastructures': infrastructure_titles.get(collection_id, []),
+            }
+        else:
+            document = None
+        result += [(record_id, index_name, document)]
+    return result
+
+
+def _index_page(session, page, async, bulk_add, counts, results):
+    if results is None or async:
+        results = {}
+
+    index_documents = {}
+    for record_id, index_name, document in documents(session, page):
+        if document is not None:
+            index_documents.setdefault(index_name, []).append(document)
+        else:
+            result = results[record_id] = client.delete_record(index_name, record_id, async)
+            if not async and not result['success']:
+                log.error("Removal of record %s from '%s' failed: %s", record_id, index_name, result['msg'])
+                counts['records_failed'] += 1
+            counts['records_removed'] += 1
+
+    for index_name, records in index_documents.iteritems():
+        log.debug("Sending %d records to search index '%s'", len(records), index_name)
+        if bulk_add:
+            result = client.put_records(index_name, records, async)
+            results.update((record['record_id'], result) for record in records)
+            if not async and not result['success']:
+                log.error("Bulk indexing of %d records into '%s' failed: %s",
+                          len(records), index_name, result['msg'])
+                counts['records_failed'] += len(records)
+        else:
+            for record in records:
+                result = results[record['record_id']] = client.put_record(
+                    index_name, record['record_id'], record['metadata_json'],
+                    record['organization'], record['collection'], record['infrastructures'], async)
+                if not async and not result['success']:
+                    log.error("Indexing of record %s into '%s' failed: %s",
+                              record['record_id'], index_name, result['msg'])
+                    counts['records_failed'] += 1
+        counts['records_added'] += len(records)
+
+
+def _infrastructure_titles(session, collection_ids):
+    """
+    :returns: dict{metadata_collection_id: [infrastructure titles]}
+    """
+    if not collection_ids:
+        return {}
+
+    rows = session.query(ckan_model.Member.table_id, ckan_model.Group.title) \
+        .join(ckan_model.Group, ckan_model.Group.id == ckan_model.Member.group_id) \
+        .filter(ckan_model.Group.type == 'infrastructure') \
+        .filter(ckan_model.Group.state == 'active') \
+        .filter(ckan_model.Member.table_name == 'group') \
+        .filter(ckan_model.Member.table_id.in_(collection_ids)) \
+        .filter(ckan_model.Member.state == 'active') \
+        .all()
+
+    titles = {}
+    for collection_id, title in rows:
+        titles.setdefault(collection_id, []).append(title)
+    return titles
+
+
+def enqueue_reindex(context, group_type, group_id):
+    """
+    Enqueue a background job to update the search index entries of the metadata records that
+    belong to the given organization, metadata collection or infrastructure (e.g. following
+    a title change). If the context defers the commit, the job is enqueued once the caller's
+    transaction commits, so that the job sees the change.
+
+    :param group_type: 'organization' | 'metadata_collection' | 'infrastructure'
+    :param group_id: the id of the group
+    :returns: the background job id, or None if the job is deferred until commit
+    """
+    if context.get('defer_commit'):
+        after_commit.add(context['session'], _AFTER_COMMIT_NAME, (group_type, group_id))
+        return None
+    return _enqueue(group_type, group_id)
+
+
+def _enqueue(group_type, group_id):
+    job = tk.enqueue_job(reindex_job, [group_type, group_id],
+                         title='search index update for {} {}'.format(group_type, group_id))
+    return job.id
+
+
+def reindex_job(group_type, group_id):
+    """
+    Background job: update the search index entries of the metadata records belonging to a
+    group. Only the record ids are selected up front; the records are then indexed a page at
+    a time. Records that are already pending reindex by another job - i.e. claimed by a job
+    that has not yet read them - are skipped, since that job will pick up the latest state.
+    """
+    session = ckan_model.Session
+    attrs = ckanext_model.MetadataRecordAttrs
+    query = session.query(ckan_model.Package.id) \
+        .filter(ckan_model.Package.type == 'metadata_record') \
+        .filter(ckan_model.Package.state != 'deleted')
+    if group_type == 'organization':
+        query = query.filter(ckan_model.Package.owner_org == group_id)
+    elif group_type == 'metadata_collection':
+        query = query.join(attrs, ckan_model.Package.id == attrs.package_id) \
+            .filter(attrs.metadata_collection_id == group_id)
+    elif group_type == 'infrastructure':
+        query = query.join(attrs, ckan_model.Package.id == attrs.package_id) \
+            .join(ckan_model.Member, attrs.metadata_collection_id == ckan_model.Member.table_id) \
+            .filter(ckan_model.Member.group_id == group_id) \
+            .filter(ckan_model.Member.table_name == 'group') \
+            .filter(ckan_model.Member.state != 'deleted')
+    else:
+        raise ValueError("Unsupported group type: %s" % group_type)
+
+    record_ids = [record_id for (record_id,) in query.distinct()]
+    claimed_ids = _claim(record_ids)
+    log.info("Updating search index for %s %s: %d records (%d already pending)",
+             group_type, group_id, len(claimed_ids), len(record_ids) - len(claimed_ids))
+
+    batch_size = max(1, asint(config.get('ckan.metadata.elastic.bulk_batch_size', DEFAULT_BATCH_SIZE)))
+    try:
+        for i in range(0, len(claimed_ids), batch_size):
+            page_ids = claimed_ids[i:i + batch_size]
+            # release the claim before reading, so that a change made from here on is
+            # picked up by a subsequent job
+            _release(page_ids)
+            index_metadata_records(session, [ckan_model.Package.id.in_(page_ids)], async=False)
+    finally:
+        _release(claimed_ids)
+        session.remove()
+
+
+# sorted set of the ids of records claimed for reindexing, scored by claim time
+PENDING_KEY = 'ckanext-metadata:elastic:pending_reindex'
+
+# claims older than this (in seconds) are assumed to have been abandoned by a failed job
+_CLAIM_EXPIRY = 3600
+
+_CLAIM_SCRIPT = """
+local claimed = {}
+for i = 2, #ARGV do
+    local score = redis.call('ZSCORE', KEYS[1], ARGV[i])
+    if not score or tonumber(score) < tonumber(ARGV[1]) - %d then
+        redis.call('ZADD', KEYS[1], ARGV[1], ARGV[i])
+        claimed[#claimed + 1] = ARGV[i]
+    end
+end
+return claimed
+""" % _CLAIM_EXPIRY
+
+_scripts = {}
+
+
+def _claim(record_ids):
+    """
+    Mark records as pending reindex.
+
+    :returns: the ids of the records that were not already pending
+    """
+    if not record_ids:
+        return []
+    if 'claim' not in _scripts:
+        _scripts['claim'] = connect_to_redis().register_script(_CLAIM_SCRIPT)
+    return _scripts['claim'](keys=[PENDING_KEY], args=[time.time()] + record_ids)
+
+
+def _release(record_ids):
+    if record_ids:
+        connect_to_redis().zrem(PENDING_KEY, *record_ids)
+
+
+_AFTER_COMMIT_NAME = 'metadata_elastic_reindex'
+
+
+@after_commit.handler(_AFTER_COMMIT_NAME)
+def _enqueue_pending(groups):
+    # a group changed more than once in a transaction needs only one job
+    for group_type, group_id in sorted(set(groups), key=groups.index):
+        try:
+            _enqueue(group_type, group_id)
+        except Exception:
+            log.exception("Error enqueuing search index update for %s %s", group_type, group_id)
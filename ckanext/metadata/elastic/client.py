@@ -1,11 +1,12 @@
 # encoding: utf-8
 
 import os
+import json
 import logging
-import requests
 from celery import Celery
 
 from ckan.common import config
+from ckanext.metadata.elastic import transport
 
 RABBITMQ_HOST = os.getenv('RABBITMQ_HOST')
 if not RABBITMQ_HOST:
@@ -30,37 +31,45 @@ def _call_agent(url, *outputs, **kwargs):
     :param url: path to search agent API function
     :param outputs: expected members of the result dict in case of success
                     (optional, in addition to 'success' and 'msg')
-    :param kwargs: params to API function
+    :param kwargs: params to API function, and optionally ``idempotent`` (default ``True``),
+                   which must be ``False`` if repeating the request could change the outcome
 
-    :return: dict{'success', 'msg', 'output1', ...}
+    :return: dict{'success', 'msg', 'output1', ...}; in case of failure, also 'transient' (the
+        request may succeed if retried later) and 'unavailable' (the request was not sent
+        because the agent is known to be down)
     """
+    idempotent = kwargs.pop('idempotent', True)
     log.debug("POST to Elasticsearch agent %s %r", url, kwargs)
     try:
-        response = requests.post(url, data=kwargs)
-        response.raise_for_status()
+        response = transport.post(url, kwargs, idempotent)
         result = response.json()
         if not isinstance(result.get('success'), bool):
             raise ValueError("Invalid response")
         if result['success'] and not (set(outputs) <= set(result)):
             raise ValueError("Incomplete response")
+    except transport.AgentUnavailable, e:
+        log.warning(str(e))
+        result = {'success': False, 'msg': "Elasticsearch agent unavailable", 'transient': True, 'unavailable': True}
     except Exception, e:
         msg = "Request to Elasticsearch agent failed"
         log.error(msg + ": " + str(e))
-        result = {'success': False, 'msg': msg}
+        result = {'success': False, 'msg': msg, 'transient': transport.is_transient(e)}
 
     if not result['success']:
         result.setdefault('msg', "Operation failed: reason unknown")
+        result.setdefault('transient', False)
+        result.setdefault('unavailable', False)
     return result
 
 
 def create_index(index_name, metadata_template_json):
     url = _search_agent_url() + '/create_index'
-    return _call_agent(url, index=index_name, metadata_json=metadata_template_json)
+    return _call_agent(url, index=index_name, metadata_json=metadata_template_json, idempotent=False)
 
 
 def delete_index(index_name):
     url = _search_agent_url() + '/delete_index'
-    return _call_agent(url, index=index_name)
+    return _call_agent(url, index=index_name, idempotent=False)
 
 
 def get_indexes():
@@ -87,6 +96,25 @@ def get_record(index_name, record_id):
     return result
 
 
+def get_records(index_name, size, search_after=None):
+    """
+    Get a page of the records in an index, in order of record id. Pages are selected by key
+    rather than by offset, so that the cost of fetching a page does not grow with its depth,
+    and paging is not limited by the index's max_result_window.
+
+    :param search_after: the record id of the last record on the previous page; omit to get
+        the first page
+    :returns: dict{'success', 'msg', 'results'}
+    """
+    url = _search_agent_url() + '/search'
+    params = {'index': index_name, 'sort': 'record_id', 'size': size}
+    if search_after is not None:
+        params['search_after'] = search_after
+    result = _call_agent(url, 'results', **params)
+    result.pop('result_length', None)
+    return result
+
+
 def put_record(index_name, record_id, metadata_json, organization, collection, infrastructures, async):
     url = _search_agent_url() + '/add'
     func = _call_agent.delay if async else _call_agent
@@ -96,6 +124,21 @@ def put_record(index_name, record_id, metadata_json, organization, collection, i
         return result
 
 
+def put_records(index_name, records, async):
+    """
+    Add/update multiple records in an index with a single request to the search agent.
+    The ``add_bulk`` endpoint is not provided by all versions of the search agent; see
+    ``ckan.metadata.elastic.bulk_add``.
+
+    :param records: list of dict{'record_id', 'metadata_json', 'organization', 'collection', 'infrastructures'}
+    """
+    url = _search_agent_url() + '/add_bulk'
+    func = _call_agent.delay if async else _call_agent
+    result = func(url, index=index_name, records=json.dumps(records))
+    if not async:
+        return result
+
+
 def delete_record(index_name, record_id, async):
     url = _search_agent_url() + '/delete'
     func = _call_agent.delay if async else _call_agent
@@ -0,0 +1,90 @@
+# encoding: utf-8
+
+import logging
+import time
+from paste.deploy.converters import asint
+
+from ckan.common import config
+from ckan import model as ckan_model
+from ckanext.metadata.elastic import client
+from ckanext.metadata.elastic.bulk_index import index_metadata_records, DEFAULT_BATCH_SIZE
+import ckanext.metadata.model as ckanext_model
+
+log = logging.getLogger(__name__)
+
+DEFAULT_POLL_INTERVAL = 1
+DEFAULT_MAX_ATTEMPTS = 10
+
+
+def relay(once=False):
+    """
+    Send the pending operations in the search index outbox to the search agent.
+
+    Operations are claimed for up to ``ckan.metadata.elastic.bulk_batch_size`` records at a
+    time, and coalesced per record, so that only the last operation written for a record is
+    sent. Records to be added/updated are read from the DB as they are now, and records to
+    be removed are deleted individually. The operations for each record are removed from the
+    outbox once its request succeeds.
+
+    A failed request is retried (in a later batch) only if the failure was transient - a
+    connection error, timeout or 5xx response. Its attempt count and error are recorded,
+    and it is moved to the dead-letter state if the agent rejected it, or once it has failed
+    ``ckan.metadata.elastic.outbox_max_attempts`` times. Requests that were not sent because
+    the search agent is unavailable (the circuit breaker is open) do not count as attempts.
+    After a batch with any failures, the relay waits for
+    ``ckan.metadata.elastic.outbox_poll_interval`` seconds.
+
+    :param once: stop when the outbox is empty (or a batch has failures), instead of waiting
+        for more operations
+    """
+    batch_size = max(1, asint(config.get('ckan.metadata.elastic.bulk_batch_size', DEFAULT_BATCH_SIZE)))
+    poll_interval = max(0, asint(config.get('ckan.metadata.elastic.outbox_poll_interval', DEFAULT_POLL_INTERVAL)))
+    max_attempts = max(1, asint(config.get('ckan.metadata.elastic.outbox_max_attempts', DEFAULT_MAX_ATTEMPTS)))
+    session = ckan_model.Session
+
+    while True:
+        operations = ckanext_model.IndexOutbox.claim(batch_size)
+        if not operations:
+            session.rollback()
+            if once:
+                break
+            time.sleep(poll_interval)
+            continue
+
+        results = {}
+        put_ids = [package_id for package_id, claimed in operations.iteritems()
+                   if claimed.operation == ckanext_model.IndexOutbox.PUT]
+        if put_ids:
+            index_metadata_records(session, [ckan_model.Package.id.in_(put_ids)], async=False, results=results)
+
+        for package_id, claimed in operations.iteritems():
+            if claimed.operation == ckanext_model.IndexOutbox.DELETE:
+                results[package_id] = client.delete_record(claimed.index_name, package_id, False)
+
+        failed_count = 0
+        for package_id, claimed in operations.iteritems():
+            # a record that no longer exists in the DB has nothing to send
+            result = results.get(package_id, {'success': True})
+            if result['success']:
+                ckanext_model.IndexOutbox.remove(claimed.row_ids)
+                continue
+
+            failed_count += 1
+            if result.get('unavailable'):
+                continue
+
+            dead = not result.get('transient') or claimed.attempts + 1 >= max_attempts
+            ckanext_model.IndexOutbox.fail(claimed.row_ids, result['msg'], dead)
+            if dead:
+                log.error("Search index update for record %s failed after %d attempt(s), and will not be retried: %s",
+                          package_id, claimed.attempts + 1, result['msg'])
+
+        session.commit()
+
+        if failed_count:
+            log.warning("Search index update failed for %d of %d records", failed_count, len(operations))
+            if once:
+                break
+            time.sleep(poll_interval)
+        else:
+            log.debug("Sent search index updates for %d records", len(operations))
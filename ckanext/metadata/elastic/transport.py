@@ -0,0 +1,311 @@
+# encoding: utf-8
+
+import logging
+import time
+import random
+import bisect
+import threading
+import urlparse
+from paste.deploy.converters import asint
+import requests
+import requests.adapters
+from requests.packages.urllib3.exceptions import NewConnectionError
+
+from ckan.common import config
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 30
+DEFAULT_POOL_SIZE = 10
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+DEFAULT_BACKOFF_MAX = 10
+DEFAULT_BREAKER_THRESHOLD = 5
+DEFAULT_BREAKER_RESET = 30
+
+# upper bounds (in seconds) of the latency histogram buckets; the last bucket is unbounded
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# responses with these statuses indicate a transient condition, and the request is retried
+_RETRY_STATUSES = frozenset((502, 503, 504))
+
+
+class AgentUnavailable(Exception):
+    """
+    Raised without making a request when the circuit breaker is open, i.e. when the
+    search agent has recently failed repeatedly.
+    """
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Tracks consecutive failed calls to the search agent. After ``threshold`` failures the
+    circuit opens and calls fail fast for ``reset_timeout`` seconds; then a single trial
+    call is let through (half-open), which closes the circuit if it succeeds or re-opens
+    it if it fails.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_progress = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state(time.time())
+
+    def _state(self, now):
+        if self.opened_at is None:
+            return self.CLOSED
+        if now - self.opened_at < self.reset_timeout:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def allow(self):
+        """
+        :returns: True if a call may be made now
+        """
+        with self._lock:
+            state = self._state(time.time())
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._trial_in_progress:
+                self._trial_in_progress = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_progress = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial_in_progress or self.failures >= self.threshold:
+                if self.opened_at is None or self._trial_in_progress:
+                    log.warning("Elasticsearch agent circuit breaker opened after %d consecutive failures",
+                                self.failures)
+                self.opened_at = time.time()
+            self._trial_in_progress = False
+
+
+class LatencyHistogram(object):
+    """
+    Counts request latencies into fixed buckets. Not thread-safe by itself; the
+    transport serializes access.
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+
+    def observe(self, seconds, error=False):
+        self.buckets[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total_seconds += seconds
+        if error:
+            self.errors += 1
+
+    def as_dict(self):
+        """
+        :return: dict{'count', 'errors', 'total_seconds', 'buckets'}, where buckets maps each
+            upper bound ('+Inf' for the last) to the number of requests that took no longer
+            than that but longer than the previous bound
+        """
+        labels = [str(bound) for bound in self.bounds] + ['+Inf']
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'total_seconds': round(self.total_seconds, 3),
+            'buckets': dict(zip(labels, self.buckets)),
+        }
+
+
+class AgentTransport(object):
+    """
+    Posts requests to the search agent through a pooled session, so that connections are
+    re-used across requests.
+
+    Connection errors, timeouts and 502/503/504 responses are retried up to ``retries`` times,
+    with exponential backoff and full jitter; for a request that is not idempotent, only a
+    failure to connect is retried, since the agent may otherwise have acted on the request
+    already. A call that fails after all its retries counts
+    as one failure towards the circuit breaker; an error response with any other status does
+    not, since it shows that the agent is up. The latency of every attempt is recorded in a
+    histogram for the endpoint (the URL path).
+    """
+
+    def __init__(self, connect_timeout, read_timeout, pool_size, retries, backoff, backoff_max,
+                 breaker_threshold, breaker_reset):
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_reset)
+
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def post(self, url, data, idempotent=True):
+        """
+        Post form data to the search agent.
+
+        :param idempotent: whether the request may safely be repeated
+
+        :returns: the requests Response object, which has a non-error status
+        :raises AgentUnavailable: if the circuit breaker is open
+        :raises requests.RequestException: if the request failed after all retries
+        """
+        if not self.breaker.allow():
+            raise AgentUnavailable("Elasticsearch agent unavailable; not retrying for up to %ds"
+                                   % self.breaker.reset_timeout)
+
+        endpoint = urlparse.urlparse(url).path
+        attempt = 0
+        while True:
+            start_time = time.time()
+            try:
+                response = self._session.post(url, data=data, timeout=self.timeout)
+                response.raise_for_status()
+                self._observe(endpoint, time.time() - start_time)
+                self.breaker.record_success()
+                return response
+            except requests.RequestException, e:
+                self._observe(endpoint, time.time() - start_time, error=True)
+                transient = self._is_transient(e)
+                if isinstance(e, requests.HTTPError) and not transient:
+                    # the agent is up, but rejected the request
+                    self.breaker.record_success()
+                    raise
+                if attempt >= self.retries or not transient or not (idempotent or self._is_connect_error(e)):
+                    self.breaker.record_failure()
+                    raise
+
+            delay = random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt))
+            attempt += 1
+            log.debug("Retrying POST to %s in %.2fs (attempt %d of %d): %s",
+                      endpoint, delay, attempt, self.retries, e)
+            time.sleep(delay)
+
+    @staticmethod
+    def _is_transient(e):
+        if isinstance(e, requests.HTTPError):
+            return e.response is not None and e.response.status_code in _RETRY_STATUSES
+        return isinstance(e, (requests.ConnectionError, requests.Timeout))
+
+    @staticmethod
+    def _is_connect_error(e):
+        """
+        :returns: True if the request failed before it could be sent
+        """
+        if isinstance(e, requests.ConnectTimeout):
+            return True
+        if isinstance(e, requests.ConnectionError) and e.args:
+            return isinstance(getattr(e.args[0], 'reason', e.args[0]), NewConnectionError)
+        return False
+
+    def _observe(self, endpoint, seconds, error=False):
+        with self._lock:
+            if endpoint not in self._histograms:
+                self._histograms[endpoint] = LatencyHistogram()
+            self._histograms[endpoint].observe(seconds, error)
+
+    def clear(self):
+        """
+        Reset the latency histograms and close the circuit.
+        """
+        with self._lock:
+            self._histograms.clear()
+        self.breaker.record_success()
+
+    def stats(self):
+        """
+        :return: dict{'circuit', 'consecutive_failures', 'endpoints': {path: histogram dict}}
+        """
+        with self._lock:
+            endpoints = dict((endpoint, histogram.as_dict())
+                             for endpoint, histogram in self._histograms.iteritems())
+        return {
+            'circuit': self.breaker.state,
+            'consecutive_failures': self.breaker.failures,
+            'endpoints': endpoints,
+        }
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def _get_transport():
+    global _transport
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                _transport = AgentTransport(
+                    connect_timeout=float(config.get('ckan.metadata.elastic.connect_timeout',
+                                                       DEFAULT_CONNECT_TIMEOUT)),
+                    read_timeout=float(config.get('ckan.metadata.elastic.read_timeout',
+                                                    DEFAULT_READ_TIMEOUT)),
+                    pool_size=max(1, asint(config.get('ckan.metadata.elastic.pool_size',
+                                                      DEFAULT_POOL_SIZE))),
+                    retries=max(0, asint(config.get('ckan.metadata.elastic.retries',
+                                                    DEFAULT_RETRIES))),
+                    backoff=float(config.get('ckan.metadata.elastic.retry_backoff',
+                                               DEFAULT_BACKOFF)),
+                    backoff_max=float(config.get('ckan.metadata.elastic.retry_backoff_max',
+                                                   DEFAULT_BACKOFF_MAX)),
+                    breaker_threshold=max(1, asint(config.get('ckan.metadata.elastic.breaker_threshold',
+                                                              DEFAULT_BREAKER_THRESHOLD))),
+                    breaker_reset=asint(config.get('ckan.metadata.elastic.breaker_reset',
+                                                   DEFAULT_BREAKER_RESET)),
+                )
+    return _transport
+
+
+def post(url, data, idempotent=True):
+    """
+    Post form data to the search agent using the process-wide transport.
+    See :py:meth:`AgentTransport.post`.
+    """
+    return _get_transport().post(url, data, idempotent)
+
+
+def is_transient(e):
+    """
+    Determine whether an exception raised by :py:func:`post` indicates a transient condition,
+    i.e. whether the request may succeed if it is sent again later.
+    """
+    if isinstance(e, AgentUnavailable):
+        return True
+    return isinstance(e, requests.RequestException) and AgentTransport._is_transient(e)
+
+
+def clear():
+    _get_transport().clear()
+
+
+def stats():
+    """
+    Get the circuit breaker state and per-endpoint latency histograms of the process-wide transport.
+    """
+    return _get_transport().stats()
@@ -0,0 +1,89 @@
+# encoding: utf-8
+
+import logging
+from sqlalchemy import event
+from sqlalchemy.orm import scoped_session
+
+from ckan import model as ckan_model
+
+log = logging.getLogger(__name__)
+
+# the key under which pending items are collected in session.info, per transaction
+_SESSION_INFO_KEY = 'metadata_after_commit'
+
+_handlers = {}
+
+
+def handler(name):
+    """
+    Decorator for registering the function that handles the items added under the given
+    name. The function is called with the list of items, in the order they were added, once
+    the outermost transaction that they were added in has been committed; any exception it
+    raises is logged.
+    """
+    def decorator(func):
+        _handlers[name] = func
+        return func
+    return decorator
+
+
+def add(session, name, item):
+    """
+    Add an item to be handled once the current transaction commits.
+
+    SQLAlchemy reports the release of a savepoint as a commit, so items added within a
+    savepoint are passed on to the enclosing transaction when the savepoint is released,
+    and are handled only when the outermost transaction commits. If a savepoint is rolled
+    back, only the items added within it are discarded.
+
+    :param session: the DB session (or the scoped session registry, e.g. ``model.Session``)
+    :param name: the name of a registered handler
+    :param item: any object
+    """
+    if isinstance(session, scoped_session):
+        # the registry does not proxy the current transaction
+        session = session()
+    transaction = _boundary(session.transaction)
+    pending = session.info.setdefault(_SESSION_INFO_KEY, {})
+    pending.setdefault(transaction, {}).setdefault(name, []).append(item)
+
+
+def _boundary(transaction):
+    # a subtransaction is committed or rolled back along with its enclosing savepoint
+    # or outermost transaction
+    while not transaction.nested and transaction.parent is not None:
+        transaction = transaction.parent
+    return transaction
+
+
+@event.listens_for(ckan_model.Session, 'after_commit')
+def _after_commit(session):
+    pending = session.info.get(_SESSION_INFO_KEY)
+    if not pending:
+        return
+
+    # the transaction being committed is still the session's current transaction
+    transaction = session.transaction
+    items = pending.pop(transaction, None)
+    if not items:
+        return
+
+    if transaction.nested:
+        parent_items = pending.setdefault(_boundary(transaction.parent), {})
+        for name, name_items in items.iteritems():
+            parent_items.setdefault(name, []).extend(name_items)
+        return
+
+    for name, name_items in items.iteritems():
+        try:
+            _handlers[name](name_items)
+        except Exception:
+            log.exception("Error handling %d committed item(s) for %s", len(name_items), name)
+
+
+@event.listens_for(ckan_model.Session, 'after_transaction_end')
+def _after_transaction_end(session, transaction):
+    # anything still pending for a transaction that has ended was rolled back
+    pending = session.info.get(_SESSION_INFO_KEY)
+    if pending:
+        pending.pop(transaction, None)
@@ -0,0 +1,151 @@
+# encoding: utf-8
+
+import threading
+import jsonpointer
+from sqlalchemy import select
+
+import ckanext.metadata.model as ckanext_model
+
+
+class AttrMapPlan(object):
+    """
+    The metadata JSON attribute maps for a metadata standard, with the JSON pointers
+    precompiled, ready to be applied to any number of metadata documents.
+    """
+
+    def __init__(self, metadata_json_attr_maps):
+        self.mappings = []
+        for metadata_json_attr_map in metadata_json_attr_maps:
+            try:
+                pointer = jsonpointer.JsonPointer(metadata_json_attr_map.json_path)
+            except jsonpointer.JsonPointerException:
+                pointer = None
+            self.mappings += [(metadata_json_attr_map.record_attr, pointer, metadata_json_attr_map.is_key)]
+
+    def apply(self, metadata_dict):
+        """
+        Map values from a metadata document. Missing or empty elements are mapped
+        to empty strings.
+
+        :param metadata_dict: the parsed metadata JSON
+        :returns: dict{'data_dict', 'key_dict'}
+        """
+        result = {
+            'data_dict': {},
+            'key_dict': {},
+        }
+        for attr, pointer, is_key in self.mappings:
+            value = ''
+            if pointer is not None:
+                try:
+                    value = pointer.resolve(metadata_dict) or ''
+                except jsonpointer.JsonPointerException:
+                    pass
+
+            result['data_dict'][attr] = value
+            if is_key:
+                result['key_dict'][attr] = value
+
+        return result
+
+
+class AttrMapCache(object):
+    """
+    A thread-safe cache of attribute map plans, keyed by metadata standard id.
+
+    Each entry records the version of the standard's attribute maps from which it was built:
+    the ids and revision ids of the standard's attribute map rows, which change whenever an
+    attribute map for the standard is created, updated or deleted, by any process. The
+    version is read from the DB on every lookup - a single indexed query, much cheaper than
+    loading and compiling the maps - so a change takes effect in all processes as soon as
+    it is committed.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, session, metadata_standard_id):
+        """
+        Return the attribute map plan for the given metadata standard, loading it if necessary.
+        """
+        # read the version before the maps, so that a plan is never cached under a version
+        # that is newer than the maps it was built from
+        version = _version(session, metadata_standard_id)
+        with self._lock:
+            entry = self._entries.get(metadata_standard_id)
+            if entry is not None and entry[0] == version:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        metadata_json_attr_maps = session.query(ckanext_model.MetadataJSONAttrMap) \
+            .filter_by(metadata_standard_id=metadata_standard_id) \
+            .filter_by(state='active') \
+            .all()
+        plan = AttrMapPlan(metadata_json_attr_maps)
+        with self._lock:
+            self._entries[metadata_standard_id] = (version, plan)
+        return plan
+
+    def clear(self):
+        """
+        Remove all entries and reset the hit/miss counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        :return: dict{'size', 'hits', 'misses'}
+        """
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def _get_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = AttrMapCache()
+    return _cache
+
+
+def get_plan(session, metadata_standard_id):
+    """
+    Get the attribute map plan for a metadata standard from the process-wide cache.
+    See :py:meth:`AttrMapCache.get`.
+    """
+    return _get_cache().get(session, metadata_standard_id)
+
+
+def clear():
+    _get_cache().clear()
+
+
+def stats():
+    """
+    Get the size and hit/miss counters of the process-wide attribute map cache.
+    """
+    return _get_cache().stats()
+
+
+def _version(session, metadata_standard_id):
+    table = ckanext_model.metadata_json_attr_map_table
+    return frozenset(session.execute(
+        select([table.c.id, table.c.revision_id])
+            .where(table.c.metadata_standard_id == metadata_standard_id)
+    ).fetchall())
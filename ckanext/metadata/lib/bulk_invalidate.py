@@ -0,0 +1,128 @@
+# encoding: utf-8
+
+import logging
+from datetime import datetime
+from sqlalchemy import text
+
+import ckan.plugins.toolkit as tk
+from ckan.common import _
+from ckan.model import types as _types
+from ckanext.metadata.common import METADATA_VALIDATION_ACTIVITY_TYPE
+import ckanext.metadata.model as ckanext_model
+from ckanext.metadata.lib import revalidation_queue
+
+log = logging.getLogger(__name__)
+
+# the number of record ids per IN list
+CHUNK_SIZE = 1000
+
+
+def bulk_invalidate(context, metadata_record_ids):
+    """
+    Mark multiple metadata records as not validated, and log the change to each record's
+    activity stream, with the same outcome as calling ``metadata_record_invalidate`` for
+    each record, but using set-based statements under a single revision: the ``validated``
+    and ``errors`` extras (along with their revision history) and the metadata_record_attrs
+    rows are updated, and the activities inserted, with one statement each per chunk
+    of records. Records that are already not validated are skipped. The invalidated
+    records are scheduled for background revalidation, if the revalidation queue is enabled.
+
+    Pending changes in the session are flushed first, and all objects in the session are
+    expired afterwards, so that no stale extras are read back. The caller commits.
+
+    The context should include 'trigger_action' and 'trigger_object_id', and may include
+    'message', as for ``metadata_record_invalidate``.
+
+    :param context: context of the calling action
+    :param metadata_record_ids: iterable of metadata record ids
+    :returns: list of ids of the metadata records that were invalidated
+    """
+    model = context['model']
+    session = context['session']
+    user = context['user']
+    try:
+        user_id = tk.get_validator('convert_user_name_or_id_to_id')(user, context)
+    except tk.Invalid, e:
+        raise tk.ValidationError({'user_id': [e.error]})
+
+    session.flush()
+    metadata_record_ids = list(metadata_record_ids)
+    attrs = ckanext_model.MetadataRecordAttrs
+    invalidated_ids = []
+    for i in range(0, len(metadata_record_ids), CHUNK_SIZE):
+        invalidated_ids += [package_id for (package_id,) in session.query(attrs.package_id)
+                            .filter(attrs.package_id.in_(metadata_record_ids[i:i + CHUNK_SIZE]))
+                            .filter(attrs.validated == True)
+                            .all()]
+    if not invalidated_ids:
+        return []
+
+    rev = model.repo.new_revision()
+    rev.author = user
+    if 'message' in context:
+        rev.message = context['message']
+    else:
+        rev.message = _(u'REST API: Invalidate metadata records (%s %s)') % (
+            context.get('trigger_action'), context.get('trigger_object_id'))
+    session.flush()
+    timestamp = rev.timestamp or datetime.utcnow()
+
+    activity_data = {
+        'action': 'metadata_record_invalidate',
+        'trigger_action': context.get('trigger_action'),
+        'trigger_object_id': context.get('trigger_object_id'),
+    }
+
+    for i in range(0, len(invalidated_ids), CHUNK_SIZE):
+        chunk_ids = invalidated_ids[i:i + CHUNK_SIZE]
+        params = {
+            'package_ids': tuple(chunk_ids),
+            'revision_id': rev.id,
+            'timestamp': timestamp,
+        }
+
+        extra_ids = [extra_id for (extra_id,) in session.execute(text("""
+            UPDATE package_extra
+            SET value = CASE key WHEN 'validated' THEN 'false' ELSE '{}' END,
+                revision_id = :revision_id
+            WHERE package_id IN :package_ids AND key IN ('validated', 'errors') AND state = 'active'
+            RETURNING id
+        """), params)]
+
+        if extra_ids:
+            # keep the extras' revision history consistent with what vdm would have written
+            params['extra_ids'] = tuple(extra_ids)
+            session.execute(text("""
+                UPDATE package_extra_revision
+                SET expired_id = :revision_id, expired_timestamp = :timestamp, current = false
+                WHERE continuity_id IN :extra_ids AND current = true
+            """), params)
+            session.execute(text("""
+                INSERT INTO package_extra_revision (id, package_id, key, value, state, revision_id,
+                                                    continuity_id, revision_timestamp, expired_timestamp, current)
+                SELECT id, package_id, key, value, state, revision_id,
+                       id, :timestamp, '9999-12-31', true
+                FROM package_extra WHERE id IN :extra_ids
+            """), params)
+
+        session.execute(
+            ckanext_model.metadata_record_attrs_table.update()
+                .where(ckanext_model.metadata_record_attrs_table.c.package_id.in_(chunk_ids))
+                .values(validated=False)
+        )
+
+        session.execute(model.activity_table.insert(), [{
+            'id': _types.make_uuid(),
+            'timestamp': timestamp,
+            'user_id': user_id,
+            'object_id': metadata_record_id,
+            'revision_id': rev.id,
+            'activity_type': METADATA_VALIDATION_ACTIVITY_TYPE,
+            'data': activity_data,
+        } for metadata_record_id in chunk_ids])
+
+    session.expire_all()
+    revalidation_queue.schedule(session, invalidated_ids)
+    log.info("Invalidated %d metadata records (%s %s)", len(invalidated_ids),
+             context.get('trigger_action'), context.get('trigger_object_id'))
+    return invalidated_ids
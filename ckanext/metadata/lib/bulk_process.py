@@ -1,46 +1,197 @@
 # encoding: utf-8
 
 import logging
+from datetime import datetime
+from paste.deploy.converters import asint
 
 import ckan.plugins.toolkit as tk
+from ckan.common import config
+from ckan import model as ckan_model
+import ckanext.metadata.model as ckanext_model
+from ckanext.metadata.lib import privilege_cache
+from ckanext.metadata.lib import after_commit
 
 log = logging.getLogger(__name__)
 
+DEFAULT_CHUNK_SIZE = 100
 
-def bulk_action(action, context, data_dicts, async):
+
+def bulk_action(action, context, data_dicts, async, object_id=None):
     """
     Carry out multiple invocations of an action, optionally asynchronously.
 
+    The run is recorded as a bulk job, the progress of which - including an error message
+    for each failed invocation - may be retrieved using the ``bulk_job_status`` action.
+
+    In async mode, the invocations are split into chunks of ``ckan.metadata.bulk_action_chunk_size``
+    data dicts, and one background job is enqueued per chunk once the bulk job has been committed.
+    Each job processes its chunk within a single DB session, and commits once.
+
+    In serial mode, progress is recorded (and, unless the context defers the commit, committed)
+    after every chunk of invocations. Note that since the job group id is only returned once
+    the run is complete, a serial run cannot be polled by the caller; use async mode for that.
+
     :param action: name of the action function
     :param context: context to be passed to each action call (each gets its own copy of the context)
     :param data_dicts: list of dicts to be passed to each action call (as the data_dict)
     :param async: True to make the action calls asynchronously
-    :returns: { total_count, error_count }
+    :param object_id: the id of the object that the bulk operation applies to (optional)
+    :returns: { total_count, error_count, job_group_id }; in async mode, also { job_count }
     :rtype: dict
     """
+    chunk_size = max(1, asint(config.get('ckan.metadata.bulk_action_chunk_size', DEFAULT_CHUNK_SIZE)))
+    if async:
+        return _enqueue_chunks(action, context, data_dicts, object_id, chunk_size)
+
+    model = context['model']
+    defer_commit = context.get('defer_commit', False)
+    bulk_job = create_bulk_job(action, context, len(data_dicts), object_id)
+    bulk_job_id = bulk_job.id
+    if not defer_commit:
+        model.repo.commit()
+
+    # let validators reuse lookups (e.g. of users and their roles) across the run
+    context = dict(context, validation_memo={})
+
     error_count = 0
-    for data_dict in data_dicts:
-        if async:
-            async_context = context.copy()
-            del async_context['session'], async_context['model']
-            tk.enqueue_job(_call_action, [action, async_context, data_dict])
-        else:
-            if not _call_action(action, context.copy(), data_dict):
-                error_count += 1
+    for i in range(0, len(data_dicts), chunk_size):
+        chunk = data_dicts[i:i + chunk_size]
+        errors = []
+        for data_dict in chunk:
+            error = _call_action(action, context.copy(), data_dict)
+            if error is not None:
+                errors += [(data_dict.get('id'), error)]
+
+        ckanext_model.BulkJob.record_progress(bulk_job_id, len(chunk), errors)
+        if not defer_commit:
+            model.repo.commit()
+        error_count += len(errors)
 
     return {
         'total_count': len(data_dicts),
         'error_count': error_count,
+        'job_group_id': bulk_job_id,
+    }
+
+
+def create_bulk_job(action, context, total_count, object_id=None, job_count=0):
+    """
+    Create a bulk job record, within the current transaction. The caller commits.
+
+    :returns: the new BulkJob object
+    """
+    model = context['model']
+    user = model.User.by_name(context['user'].decode('utf8')) if context.get('user') else None
+
+    bulk_job = ckanext_model.BulkJob(
+        action=action,
+        object_id=object_id,
+        user_id=user.id if user else None,
+        total_count=total_count,
+        job_count=job_count,
+    )
+    if not total_count:
+        bulk_job.finished = bulk_job.created = datetime.utcnow()
+    model.Session.add(bulk_job)
+    model.Session.flush()
+    return bulk_job
+
+
+def _enqueue_chunks(action, context, data_dicts, object_id, chunk_size):
+    """
+    Create the bulk job, and enqueue one background job per chunk when the current transaction
+    commits - immediately, unless the context defers the commit - so that the background jobs
+    see the bulk job, and any changes made by the caller.
+    """
+    model = context['model']
+    chunks = [data_dicts[i:i + chunk_size] for i in range(0, len(data_dicts), chunk_size)]
+    bulk_job = create_bulk_job(action, context, len(data_dicts), object_id, job_count=len(chunks))
+    job_group_id = bulk_job.id
+
+    async_context = context.copy()
+    del async_context['session'], async_context['model']
+    async_context.pop('defer_commit', None)
+    # privileges cached for the current request must not outlive it
+    async_context.pop(privilege_cache.CONTEXT_KEY, None)
+    for i, chunk in enumerate(chunks):
+        enqueue_after_commit(model.Session, _call_action_chunk, [action, async_context, chunk, job_group_id],
+                             '{} {} ({}/{})'.format(action, job_group_id, i + 1, len(chunks)))
+
+    if not context.get('defer_commit'):
+        model.repo.commit()
+
+    return {
+        'total_count': len(data_dicts),
+        'error_count': 0,
+        'job_group_id': job_group_id,
+        'job_count': len(chunks),
     }
 
 
+def enqueue_after_commit(session, func, args, title):
+    """
+    Enqueue a background job when the current transaction commits; if it is rolled back,
+    the job is discarded. See :py:func:`ckanext.metadata.lib.after_commit.add`.
+    """
+    after_commit.add(session, _AFTER_COMMIT_NAME, (func, args, title))
+
+
+def _call_action_chunk(action, context, data_dicts, job_group_id):
+    """
+    Background job: carry out the action for a chunk of data dicts, within a single session
+    and with a single commit. Each invocation runs within a savepoint, so that a failed
+    invocation does not affect the others in the chunk.
+    """
+    session = ckan_model.Session
+    context = context.copy()
+    context.update({
+        'model': ckan_model,
+        'session': session,
+        'defer_commit': True,
+        # let validators reuse lookups (e.g. of users and their roles) across the chunk
+        'validation_memo': {},
+    })
+
+    errors = []
+    for data_dict in data_dicts:
+        savepoint = session.begin_nested()
+        error = _call_action(action, context.copy(), data_dict)
+        if savepoint.is_active:
+            if error is None:
+                savepoint.commit()
+            else:
+                savepoint.rollback()
+        if error is not None:
+            errors += [(data_dict.get('id'), error)]
+
+    ckanext_model.BulkJob.record_progress(job_group_id, len(data_dicts), errors, job_done=True)
+    ckan_model.repo.commit()
+
+
 def _call_action(action, context, data_dict):
     """
-    :returns: success/failure
-    :rtype: bool
+    :returns: an error message if the action failed, otherwise None
+    :rtype: unicode
     """
     try:
         tk.get_action(action)(context, data_dict)
-        return True
-    except:
-        return False
+        return None
+    except tk.ValidationError, e:
+        return unicode(e.error_dict.get('message') or e.error_dict)
+    except (tk.ObjectNotFound, tk.NotAuthorized), e:
+        return unicode(e.message or e.__class__.__name__)
+    except Exception, e:
+        log.exception("Error calling %s for %r", action, data_dict)
+        return unicode(e) or e.__class__.__name__
+
+
+_AFTER_COMMIT_NAME = 'metadata_bulk_jobs'
+
+
+@after_commit.handler(_AFTER_COMMIT_NAME)
+def _enqueue_jobs(jobs):
+    for func, args, title in jobs:
+        try:
+            tk.enqueue_job(func, args, title=title)
+        except Exception:
+            log.exception("Error enqueuing background job: %s", title)
@@ -0,0 +1,359 @@
+# encoding: utf-8
+
+import logging
+import json
+import time
+import multiprocessing
+from paste.deploy.converters import asint
+
+import ckan.plugins.toolkit as tk
+from ckan.common import _, config
+from ckan import model as ckan_model
+from ckanext.metadata.common import METADATA_VALIDATION_ACTIVITY_TYPE
+from ckanext.metadata.logic.metadata_validator import MetadataValidator
+from ckanext.metadata.lib import validator_cache
+from ckanext.metadata.lib import vocabulary_cache
+from ckanext.metadata.lib.dictization import model_save
+from ckanext.metadata.lib.bulk_process import create_bulk_job, enqueue_after_commit
+import ckanext.metadata.model as ckanext_model
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 500
+DEFAULT_PROCESSES = 2
+
+
+def bulk_validate(context, metadata_record_ids, async=False, object_id=None):
+    """
+    Validate multiple metadata records in bulk.
+
+    Records are loaded from the DB in chunks. For each chunk, the validation schemas (and
+    any vocabularies that they refer to) are resolved once per distinct combination of
+    organization, collection and metadata standard, and shared by all the records in that
+    group. The records are then validated without accessing the DB. Finally, the resulting
+    ``validated`` and ``errors`` extras, any changes to the metadata JSON, and the validation
+    activities are written back under a single revision, and committed once per chunk, along
+    with the progress of the run, which is recorded as a bulk job (see the ``bulk_job_status``
+    action).
+
+    If async, the run is carried out by a background job - enqueued when the current transaction
+    commits - which validates the records in parallel using a pool of worker processes. Otherwise,
+    the records are validated within the current process; a worker pool is never forked from a
+    web worker.
+
+    The number of worker processes and the chunk size are set by the config options
+    ``ckan.metadata.bulk_validate_processes`` and ``ckan.metadata.bulk_validate_chunk_size``.
+
+    :param context: context of the calling action
+    :param metadata_record_ids: list of ids of the metadata records to validate
+    :param async: validate the records in a background job
+    :param object_id: the id of the object (e.g. metadata collection) that the bulk operation
+        applies to (optional)
+    :returns: { total_count, error_count, job_group_id }; if async, also { job_count }; otherwise,
+        also { elapsed_seconds, records_per_second, schema_timings, failures }
+    :rtype: dict
+    """
+    model = context['model']
+    defer_commit = context.get('defer_commit', False)
+
+    if async and metadata_record_ids:
+        bulk_job = create_bulk_job('metadata_record_validate', context, len(metadata_record_ids), object_id,
+                                   job_count=1)
+        enqueue_after_commit(model.Session, bulk_validate_job, [context['user'], metadata_record_ids, bulk_job.id],
+                             'metadata_record_validate {} (parallel)'.format(bulk_job.id))
+        if not defer_commit:
+            model.repo.commit()
+        return {
+            'total_count': len(metadata_record_ids),
+            'error_count': 0,
+            'job_group_id': bulk_job.id,
+            'job_count': 1,
+        }
+
+    bulk_job = create_bulk_job('metadata_record_validate', context, len(metadata_record_ids), object_id)
+    if not defer_commit:
+        model.repo.commit()
+    return _run(context, metadata_record_ids, bulk_job.id, processes=1)
+
+
+def bulk_validate_job(user, metadata_record_ids, bulk_job_id):
+    """
+    Background job: validate metadata records using a pool of worker processes.
+    """
+    processes = max(1, asint(config.get('ckan.metadata.bulk_validate_processes', DEFAULT_PROCESSES)))
+    context = {
+        'model': ckan_model,
+        'session': ckan_model.Session,
+        'user': user,
+        'ignore_auth': True,
+    }
+    _run(context, metadata_record_ids, bulk_job_id, processes, background=True)
+
+
+def _run(context, metadata_record_ids, bulk_job_id, processes, background=False):
+    chunk_size = asint(config.get('ckan.metadata.bulk_validate_chunk_size', DEFAULT_CHUNK_SIZE))
+
+    model = context['model']
+    user = context['user']
+    user_id = model.User.by_name(user.decode('utf8')).id
+    defer_commit = context.get('defer_commit', False)
+
+    schema_timings = {}
+    failures = []
+    start_time = time.time()
+
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    try:
+        for i in range(0, len(metadata_record_ids), chunk_size):
+            chunk_ids = metadata_record_ids[i:i + chunk_size]
+            batches, records, chunk_failures = _prepare_chunk(context, chunk_ids, processes)
+
+            if pool is not None:
+                batch_results = pool.map(_validate_batch, batches)
+            else:
+                batch_results = map(_validate_batch, batches)
+
+            results = [result for batch_result in batch_results for result in batch_result]
+            chunk_failures += _save_chunk(context, user_id, records, results)
+            ckanext_model.BulkJob.record_progress(
+                bulk_job_id, len(chunk_ids), [(failure['id'], failure['message']) for failure in chunk_failures],
+                job_done=background and i + chunk_size >= len(metadata_record_ids))
+            if not defer_commit:
+                model.repo.commit()
+            failures += chunk_failures
+
+            for result in results:
+                for metadata_schema_id, seconds in result.get('timings', {}).iteritems():
+                    timing = schema_timings.setdefault(metadata_schema_id, {'count': 0, 'seconds': 0.0})
+                    timing['count'] += 1
+                    timing['seconds'] += seconds
+
+            log.debug("Bulk validation: processed %d of %d metadata records",
+                      i + len(chunk_ids), len(metadata_record_ids))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    elapsed_seconds = time.time() - start_time
+    result = {
+        'total_count': len(metadata_record_ids),
+        'error_count': len(failures),
+        'job_group_id': bulk_job_id,
+        'elapsed_seconds': round(elapsed_seconds, 3),
+        'records_per_second': round(len(metadata_record_ids) / elapsed_seconds, 1) if elapsed_seconds else None,
+        'schema_timings': [{
+            'metadata_schema_id': metadata_schema_id,
+            'count': timing['count'],
+            'total_seconds': round(timing['seconds'], 3),
+            'mean_milliseconds': round(1000 * timing['seconds'] / timing['count'], 3),
+        } for metadata_schema_id, timing in sorted(schema_timings.iteritems(), key=lambda t: -t[1]['seconds'])],
+        'failures': failures,
+    }
+    log.info("Bulk validated %d metadata records in %.1fs (%s records/s); %d failures",
+             result['total_count'], elapsed_seconds, result['records_per_second'], result['error_count'])
+    return result
+
+
+def _prepare_chunk(context, metadata_record_ids, processes):
+    """
+    Load a chunk of metadata records and resolve their validation schemas.
+
+    :returns: tuple(list of worker batches, dict of {id: Package}, list of failures)
+    """
+    model = context['model']
+    session = context['session']
+
+    records = session.query(model.Package) \
+        .filter(model.Package.id.in_(metadata_record_ids)) \
+        .filter(model.Package.type == 'metadata_record') \
+        .all()
+    records = {record.id: record for record in records}
+
+    extras = session.query(model.PackageExtra.package_id, model.PackageExtra.key, model.PackageExtra.value) \
+        .filter(model.PackageExtra.package_id.in_(metadata_record_ids)) \
+        .filter(model.PackageExtra.key.in_(('metadata_json', 'metadata_collection_id', 'metadata_standard_id'))) \
+        .filter(model.PackageExtra.state == 'active') \
+        .all()
+    record_extras = {}
+    for package_id, key, value in extras:
+        record_extras.setdefault(package_id, {})[key] = value
+
+    failures = []
+    groups = {}
+    for metadata_record_id in metadata_record_ids:
+        record = records.get(metadata_record_id)
+        if record is None:
+            failures += [{'id': metadata_record_id, 'message': '%s: %s' % (_('Not found'), _('Metadata Record'))}]
+            continue
+        record_extra = record_extras.get(metadata_record_id, {})
+        group_key = (record.owner_org,
+                     record_extra.get('metadata_collection_id'),
+                     record_extra.get('metadata_standard_id'))
+        groups.setdefault(group_key, []).append((metadata_record_id, record_extra.get('metadata_json')))
+
+    schema_list_context = context.copy()
+    schema_list_context['ignore_auth'] = True
+    vocabularies = {}
+    batches = []
+
+    for group_records in groups.itervalues():
+        schema_list_context['metadata_record'] = records[group_records[0][0]]
+        validation_schemas = tk.get_action('metadata_record_validation_schema_list')(schema_list_context, {
+            'id': group_records[0][0],
+            'all_fields': True,
+        })
+        if not validation_schemas:
+            failures += [{
+                'id': metadata_record_id,
+                'message': _('Could not find any metadata schemas for validating this metadata record'),
+            } for metadata_record_id, _metadata_json in group_records]
+            for metadata_record_id, _metadata_json in group_records:
+                del records[metadata_record_id]
+            continue
+
+        schemas = [(metadata_schema['id'], metadata_schema['schema_json']) for metadata_schema in validation_schemas]
+        for metadata_schema_id, schema_json in schemas:
+            for vocabulary_name in _vocabulary_names(json.loads(schema_json)):
+                if vocabulary_name not in vocabularies:
+                    vocabularies[vocabulary_name] = vocabulary_cache.get_tags(context['session'], vocabulary_name)
+
+        # split each group across the workers, so that the schema set is sent once per batch
+        # rather than once per record
+        batch_size = max(1, -(-len(group_records) // processes))
+        for j in range(0, len(group_records), batch_size):
+            batches += [(schemas, vocabularies, group_records[j:j + batch_size])]
+
+    return batches, records, failures
+
+
+def _save_chunk(context, user_id, records, results):
+    """
+    Write the validation results for a chunk of metadata records, and log the validation
+    activities, under a single revision. The caller commits.
+
+    :returns: list of failures
+    """
+    model = context['model']
+    user = context['user']
+
+    activity_context = context.copy()
+    activity_context.update({
+        'defer_commit': True,
+        'ignore_auth': True,
+        'schema': {
+            'user_id': [unicode, tk.get_validator('convert_user_name_or_id_to_id')],
+            'object_id': [],
+            'revision_id': [],
+            'activity_type': [],
+            'data': [],
+        },
+    })
+
+    rev = model.repo.new_revision()
+    rev.author = user
+    rev.message = _(u'REST API: Bulk validate metadata records')
+
+    failures = []
+    for result in results:
+        if result.get('failure'):
+            failures += [{'id': result['id'], 'message': result['failure']}]
+            continue
+
+        metadata_record = records[result['id']]
+        if result['metadata_json'] is not None:
+            metadata_record.extras['metadata_json'] = result['metadata_json']
+        metadata_record.extras['validated'] = True
+        metadata_record.extras['errors'] = json.dumps(result['errors'], ensure_ascii=False)
+        model_save.metadata_record_attrs_save(metadata_record, context)
+
+        tk.get_action('activity_create')(activity_context, {
+            'user_id': user_id,
+            'object_id': metadata_record.id,
+            'activity_type': METADATA_VALIDATION_ACTIVITY_TYPE,
+            'data': {
+                'action': 'metadata_record_validate',
+                'results': result['results'],
+            }
+        })
+
+    return failures
+
+
+def _validate_batch(batch):
+    """
+    Validate a batch of metadata records against a shared set of metadata schemas.
+    This runs in a worker process, and must not access the DB.
+
+    :param batch: tuple(list of (metadata_schema_id, schema_json), vocabularies dict,
+        list of (metadata_record_id, metadata_json))
+    :returns: list of result dicts
+    """
+    schemas, vocabularies, records = batch
+    validate_context = {
+        'allow_side_effects': True,
+        'ignore_auth': True,
+        'vocabularies': vocabularies,
+    }
+    results = []
+    for metadata_record_id, metadata_json in records:
+        try:
+            results += [_validate_record(metadata_record_id, metadata_json, schemas, validate_context)]
+        except Exception, e:
+            log.exception("Error validating metadata record %s", metadata_record_id)
+            results += [{'id': metadata_record_id, 'failure': unicode(e) or e.__class__.__name__}]
+    return results
+
+
+def _validate_record(metadata_record_id, metadata_json, schemas, validate_context):
+    """
+    Validate a single metadata record, in the same way as the metadata_record_validate action.
+    """
+    metadata_dict = json.loads(metadata_json)
+    metadata_modified = False
+    validation_results = []
+    accumulated_errors = {}
+    timings = {}
+
+    for metadata_schema_id, schema_json in schemas:
+        start_time = time.time()
+        json_validator = validator_cache.get_validator(
+            MetadataValidator, metadata_schema_id, schema_json
+        ).bind(metadata_record_id, validate_context)
+
+        validation_errors = json_validator.validate(metadata_dict)
+        if metadata_dict != json_validator.jsonschema_validator.root_instance:
+            metadata_dict = json_validator.jsonschema_validator.root_instance.copy()
+            metadata_modified = True
+        timings[metadata_schema_id] = time.time() - start_time
+
+        validation_results += [{
+            'metadata_schema_id': metadata_schema_id,
+            'errors': validation_errors,
+        }]
+        accumulated_errors.update(validation_errors)
+
+    return {
+        'id': metadata_record_id,
+        'metadata_json': json.dumps(metadata_dict, ensure_ascii=False) if metadata_modified else None,
+        'results': validation_results,
+        'errors': accumulated_errors,
+        'timings': timings,
+    }
+
+
+def _vocabulary_names(schema):
+    """
+    Find the names of all vocabularies referenced by "vocabulary" keywords in a schema.
+    """
+    names = set()
+    nodes = [schema]
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, dict):
+            if isinstance(node.get('vocabulary'), basestring):
+                names.add(node['vocabulary'])
+            nodes += node.values()
+        elif isinstance(node, list):
+            nodes += node
+    return names
@@ -47,6 +47,33 @@ def metadata_record_dictize(pkg, context):
     return result_dict
 
 
+def metadata_record_list_dictize(pkgs, context):
+    """
+    Dictize a list of (latest revision) metadata record packages, in the same way as
+    metadata_record_dictize, but fetching the extras for all the packages in a single query.
+    """
+    model = context['model']
+    if not pkgs:
+        return []
+
+    extra = model.package_extra_table
+    q = select([extra]).where(extra.c.package_id.in_([pkg.id for pkg in pkgs]))
+    pkg_extras = {}
+    for row in _execute(q, extra, context):
+        pkg_extras.setdefault(row.package_id, []).append(row)
+
+    result = []
+    for pkg in pkgs:
+        result_dict = d.table_dictize(pkg, context)
+        if result_dict.get('title'):
+            result_dict['title'] = result_dict['title'].strip()
+        result_dict['display_name'] = result_dict['title'] or result_dict['name'] or result_dict['id']
+        result_dict['extras'] = ckan_model_dictize.extras_list_dictize(pkg_extras.get(pkg.id, []), context)
+        result += [result_dict]
+
+    return result
+
+
 def metadata_collection_dictize(metadata_collection, context):
     model = context['model']
     is_latest_revision = not(context.get('revision_id') or
@@ -215,3 +242,31 @@ def _execute_with_revision(q, rev_table, context):
     q = q.where(rev_table.c.expired_timestamp > revision_date)
 
     return session.execute(q)
+
+
+def bulk_job_dictize(bulk_job, context, error_limit):
+    session = context['session']
+    BulkJobError = model_ext.BulkJobError
+
+    bulk_job_dict = d.table_dictize(bulk_job, context)
+    rate = bulk_job.rate()
+    remaining = bulk_job.total_count - bulk_job.done_count
+    bulk_job_dict['records_per_second'] = round(rate, 2) if rate else None
+    if bulk_job.finished:
+        bulk_job_dict['eta_seconds'] = 0
+    elif rate:
+        bulk_job_dict['eta_seconds'] = int(remaining / rate)
+    else:
+        bulk_job_dict['eta_seconds'] = None
+
+    errors = session.query(BulkJobError) \
+        .filter_by(bulk_job_id=bulk_job.id) \
+        .order_by(BulkJobError.timestamp) \
+        .limit(error_limit) \
+        .all()
+    bulk_job_dict['errors'] = [{
+        'object_id': error.object_id,
+        'message': error.message,
+        'timestamp': error.timestamp.isoformat(),
+    } for error in errors]
+    return bulk_job_dict
@@ -5,6 +5,22 @@ import ckan.lib.dictization as d
 import ckan.plugins.toolkit as tk
 from ckan.common import _
 from ckanext.metadata.common import model_info
+import ckanext.metadata.model as ckanext_model
+
+
+def metadata_record_attrs_save(metadata_record, context):
+    """
+    Save the metadata_record_attrs row for a metadata record, copying the current values
+    of the relevant package extras. This must be called whenever any of those extras are
+    changed, within the same transaction.
+    """
+    session = context['session']
+    metadata_record_attrs = session.query(ckanext_model.MetadataRecordAttrs).get(metadata_record.id)
+    if metadata_record_attrs is None:
+        metadata_record_attrs = ckanext_model.MetadataRecordAttrs(package_id=metadata_record.id)
+        session.add(metadata_record_attrs)
+    metadata_record_attrs.update_from_extras(metadata_record.extras)
+    return metadata_record_attrs
 
 
 def metadata_record_collection_membership_save(metadata_collection_id, context):
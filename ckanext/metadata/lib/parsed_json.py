@@ -0,0 +1,47 @@
+# encoding: utf-8
+
+import json
+
+CONTEXT_KEY = 'parsed_json'
+
+
+def loads(context, value):
+    """
+    Parse a JSON string, reusing the result of any earlier parse of the same string within
+    the given action context. This allows the validators and the action code on a write
+    path to share a single parse of a (possibly large) metadata document.
+
+    The returned object is shared, and must be treated as read-only; copy it before
+    making any changes.
+
+    :param context: the action context; the parsed documents are kept in it under
+        ``CONTEXT_KEY``, and so are shared with any actions and validators invoked with
+        the same context object
+    :param value: JSON string
+    :raises ValueError: if the string is not valid JSON
+    """
+    documents = context.setdefault(CONTEXT_KEY, {})
+    try:
+        return documents[value]
+    except KeyError:
+        obj = documents[value] = json.loads(value)
+        return obj
+
+
+def dumps(context, obj):
+    """
+    Serialize an object to a JSON string, and remember the object as the parsed form of
+    that string within the given action context, so that it need not be parsed again.
+    The object must not be changed afterwards.
+    """
+    value = json.dumps(obj, ensure_ascii=False)
+    context.setdefault(CONTEXT_KEY, {})[value] = obj
+    return value
+
+
+def peek(context, value):
+    """
+    :returns: the parsed form of a JSON string if it is already known within the given
+        action context, otherwise None
+    """
+    return context.get(CONTEXT_KEY, {}).get(value)
@@ -0,0 +1,155 @@
+# encoding: utf-8
+
+import logging
+import json
+import time
+import threading
+from paste.deploy.converters import asint
+
+from ckan.common import config
+from ckan.lib.redis import connect_to_redis
+
+log = logging.getLogger(__name__)
+
+# off by default, so that a change to a user's privileges takes effect on the next request
+DEFAULT_CACHE_TTL = 0
+
+# the key under which privileges (and organization names) are cached in an action context
+CONTEXT_KEY = 'metadata_privileges'
+
+
+class UserPrivileges(object):
+    """
+    A user's privileges, as written to Redis by ckanext-accesscontrol, indexed by institution
+    for constant-time role checks.
+    """
+
+    def __init__(self, token_data):
+        self.superuser = bool(token_data.get('superuser'))
+        self.roles = {}
+        for privilege in token_data.get('privileges', []):
+            self.roles.setdefault(privilege['institution'], set()).add(privilege['role'])
+
+    def has_role(self, institution, role):
+        return role in self.roles.get(institution, ())
+
+    def is_member(self, institution):
+        return institution in self.roles
+
+
+class PrivilegeCache(object):
+    """
+    A thread-safe cache of users' privileges, keyed by user id, with entries expiring after
+    ``ttl`` seconds. Since privileges are managed externally (by ckanext-accesscontrol), there
+    is no invalidation; ``ttl`` bounds how long a change to a user's privileges may go unnoticed.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """
+        Return the privileges of the given user, loading them from Redis if necessary.
+
+        :returns: UserPrivileges, or None if the user has no token data (i.e. is not logged in)
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        privileges = _load_privileges(user_id)
+        if self.ttl > 0:
+            with self._lock:
+                self._entries[user_id] = (now + self.ttl, privileges)
+        return privileges
+
+    def clear(self):
+        """
+        Remove all entries and reset the hit/miss counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        :return: dict{'size', 'ttl', 'hits', 'misses'}
+        """
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+def _load_privileges(user_id):
+    # connect_to_redis() draws on CKAN's process-wide connection pool
+    token_json = connect_to_redis().get('oidc_token_data:' + user_id)
+    if not token_json:
+        return None
+    return UserPrivileges(json.loads(token_json))
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def _get_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                ttl = asint(config.get('ckan.metadata.privilege_cache_ttl', DEFAULT_CACHE_TTL))
+                log.debug("Creating privilege cache with TTL %ds", ttl)
+                _cache = PrivilegeCache(ttl)
+    return _cache
+
+
+def get_privileges(context):
+    """
+    Get the privileges of the context user. They are cached in the context - and so are
+    shared by any actions and auth functions that are subsequently invoked with the same
+    context or a copy of it - as well as in the process-wide cache, if enabled.
+
+    :returns: UserPrivileges, or None if the user has no token data
+    """
+    request_cache = context.setdefault(CONTEXT_KEY, {})
+    user = context['user']
+    key = ('user', user)
+    if key not in request_cache:
+        user_id = context['model'].User.by_name(user.decode('utf8')).id
+        request_cache[key] = _get_cache().get(user_id)
+    return request_cache[key]
+
+
+def get_organization_name(context, organization_id):
+    """
+    Get the name of an organization given its id or name, caching it in the context.
+    """
+    request_cache = context.setdefault(CONTEXT_KEY, {})
+    key = ('organization', organization_id)
+    if key not in request_cache:
+        request_cache[key] = context['model'].Group.get(organization_id).name
+    return request_cache[key]
+
+
+def clear():
+    _get_cache().clear()
+
+
+def stats():
+    """
+    Get the size and hit/miss counters of the process-wide privilege cache.
+    """
+    return _get_cache().stats()
@@ -0,0 +1,82 @@
+# encoding: utf-8
+
+from sqlalchemy import func
+
+from ckan import model as ckan_model
+import ckanext.metadata.model as ckanext_model
+
+MATCH_ATTRS = ('doi', 'sid')
+
+
+def preload_matches(context, data_dicts):
+    """
+    Resolve the DOI and SID matches for a batch of metadata record data dicts, with one
+    set-based query per attribute, and cache the results in the context, where they will
+    be used by :py:func:`find_metadata_record` instead of querying per record.
+
+    The matched packages are loaded into the session, so that subsequent lookups by id
+    do not hit the DB.
+
+    :param context: the action context (shared with the create/update calls for the batch)
+    :param data_dicts: list of metadata record data dicts
+    """
+    session = context['session']
+    matches = context['metadata_record_matches'] = {}
+
+    for attr in MATCH_ATTRS:
+        values = set(data_dict[attr].lower() for data_dict in data_dicts
+                     if isinstance(data_dict.get(attr), basestring) and data_dict[attr])
+        attr_matches = matches[attr] = {}
+        if not values:
+            continue
+
+        attr_column = getattr(ckanext_model.MetadataRecordAttrs, attr)
+        packages = session.query(ckan_model.Package, attr_column) \
+            .join(ckanext_model.MetadataRecordAttrs,
+                  ckan_model.Package.id == ckanext_model.MetadataRecordAttrs.package_id) \
+            .filter(func.lower(attr_column).in_(values)) \
+            .all()
+        for package, value in packages:
+            attr_matches.setdefault(value.lower(), package.id)
+
+
+def refresh_match(context, metadata_record_id):
+    """
+    Update the cached DOI and SID matches following a create or update of a metadata record.
+    """
+    matches = context.get('metadata_record_matches')
+    if matches is None:
+        return
+
+    metadata_record_attrs = ckanext_model.MetadataRecordAttrs.get(metadata_record_id)
+    for attr in MATCH_ATTRS:
+        attr_matches = matches[attr]
+        for value in [value for value, package_id in attr_matches.iteritems() if package_id == metadata_record_id]:
+            del attr_matches[value]
+        value = getattr(metadata_record_attrs, attr) if metadata_record_attrs else None
+        if value:
+            attr_matches[value.lower()] = metadata_record_id
+
+
+def find_metadata_record(context, attr, value):
+    """
+    Find a metadata record by DOI or SID (case-insensitive), using the matches cached in
+    the context by :py:func:`preload_matches` if present.
+
+    :param attr: 'doi' or 'sid'
+    :param value: the DOI or SID
+    :returns: Package object, or None if not found
+    """
+    model = context['model']
+    session = context['session']
+
+    matches = context.get('metadata_record_matches')
+    if matches is not None:
+        package_id = matches[attr].get(value.lower())
+        return model.Package.get(package_id) if package_id else None
+
+    attr_column = getattr(ckanext_model.MetadataRecordAttrs, attr)
+    return session.query(model.Package) \
+        .join(ckanext_model.MetadataRecordAttrs, model.Package.id == ckanext_model.MetadataRecordAttrs.package_id) \
+        .filter(func.lower(attr_column) == value.lower()) \
+        .first()
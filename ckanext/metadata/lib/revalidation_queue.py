@@ -0,0 +1,263 @@
+# encoding: utf-8
+
+import logging
+import time
+import calendar
+from paste.deploy.converters import asbool, asint
+
+import ckan.plugins.toolkit as tk
+from ckan.common import config
+from ckan import model as ckan_model
+from ckan.lib.redis import connect_to_redis
+from ckanext.metadata.lib import after_commit
+
+log = logging.getLogger(__name__)
+
+DEFAULT_RATE = 10
+DEFAULT_CLAIM_TIMEOUT = 300
+DEFAULT_MAX_ATTEMPTS = 5
+
+# sorted set of metadata record ids, scored by priority
+QUEUE_KEY = 'ckanext-metadata:revalidation_queue'
+# sorted set of metadata record ids, scored by the time at which each was first queued
+QUEUED_AT_KEY = 'ckanext-metadata:revalidation_queue:queued_at'
+# sorted set of the ids of records claimed by a worker, scored by the time at which the claim expires
+CLAIMED_KEY = 'ckanext-metadata:revalidation_queue:claimed'
+# hash of the priorities of claimed records, for requeuing them if their claims expire
+CLAIMED_PRIORITY_KEY = 'ckanext-metadata:revalidation_queue:claimed_priority'
+# hash of the number of times each record has been claimed without being acknowledged
+ATTEMPTS_KEY = 'ckanext-metadata:revalidation_queue:attempts'
+# hash of worker counters
+STATS_KEY = 'ckanext-metadata:revalidation_queue:stats'
+
+_AFTER_COMMIT_NAME = 'metadata_revalidation'
+
+# published (public) records are ranked above all private records; within each group,
+# the most recently modified record comes first
+_PUBLISHED_PRIORITY = 10 ** 10
+
+_PUSH_SCRIPT = """
+for i = 1, #ARGV - 1, 2 do
+    redis.call('ZADD', KEYS[1], ARGV[i + 1], ARGV[i])
+    if not redis.call('ZSCORE', KEYS[2], ARGV[i]) then
+        redis.call('ZADD', KEYS[2], ARGV[#ARGV], ARGV[i])
+    end
+end
+"""
+
+# requeue records whose claims have expired (or drop them, once they have been claimed
+# the maximum number of times), then claim records from the head of the queue
+_CLAIM_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', ARGV[2])
+for _, id in ipairs(expired) do
+    local priority = redis.call('HGET', KEYS[4], id)
+    redis.call('ZREM', KEYS[3], id)
+    redis.call('HDEL', KEYS[4], id)
+    if tonumber(redis.call('HGET', KEYS[5], id) or 0) >= tonumber(ARGV[4]) then
+        redis.call('HDEL', KEYS[5], id)
+        redis.call('HINCRBY', KEYS[6], 'dropped', 1)
+        if not redis.call('ZSCORE', KEYS[1], id) then
+            redis.call('ZREM', KEYS[2], id)
+        end
+    elseif not redis.call('ZSCORE', KEYS[1], id) then
+        redis.call('ZADD', KEYS[1], priority or 0, id)
+    end
+end
+local entries = redis.call('ZREVRANGE', KEYS[1], 0, ARGV[1] - 1, 'WITHSCORES')
+local ids = {}
+for i = 1, #entries, 2 do
+    redis.call('ZREM', KEYS[1], entries[i])
+    redis.call('ZADD', KEYS[3], ARGV[3], entries[i])
+    redis.call('HSET', KEYS[4], entries[i], entries[i + 1])
+    redis.call('HINCRBY', KEYS[5], entries[i], 1)
+    ids[#ids + 1] = entries[i]
+end
+return ids
+"""
+
+# release the claims on records that have been processed; a record that was queued again
+# while claimed keeps its place in the queue
+_ACK_SCRIPT = """
+for i = 1, #ARGV do
+    redis.call('ZREM', KEYS[3], ARGV[i])
+    redis.call('HDEL', KEYS[4], ARGV[i])
+    redis.call('HDEL', KEYS[5], ARGV[i])
+    if not redis.call('ZSCORE', KEYS[1], ARGV[i]) then
+        redis.call('ZREM', KEYS[2], ARGV[i])
+    end
+end
+"""
+
+_KEYS = [QUEUE_KEY, QUEUED_AT_KEY, CLAIMED_KEY, CLAIMED_PRIORITY_KEY, ATTEMPTS_KEY, STATS_KEY]
+
+
+def is_enabled():
+    return asbool(config.get('ckan.metadata.revalidation_queue', False))
+
+
+def schedule(session, metadata_record_ids):
+    """
+    Schedule metadata records for background revalidation, if the revalidation queue
+    is enabled. The records are added to the queue when the current transaction commits,
+    and discarded if it is rolled back; see :py:func:`ckanext.metadata.lib.after_commit.add`.
+
+    :param session: the DB session in which the records are being invalidated
+    :param metadata_record_ids: iterable of metadata record ids
+    """
+    if not is_enabled():
+        return
+
+    metadata_record_ids = list(metadata_record_ids)
+    pending = {}
+    for i in range(0, len(metadata_record_ids), 1000):
+        for package_id, private, metadata_modified in session.query(
+                ckan_model.Package.id, ckan_model.Package.private, ckan_model.Package.metadata_modified) \
+                .filter(ckan_model.Package.id.in_(metadata_record_ids[i:i + 1000])):
+            pending[package_id] = _priority(private, metadata_modified)
+    if pending:
+        after_commit.add(session, _AFTER_COMMIT_NAME, pending)
+
+
+def claim(count):
+    """
+    Claim up to ``count`` metadata record ids from the head of the queue. The records are
+    moved out of the queue, but are put back if they are not acknowledged within
+    ``ckan.metadata.revalidation_claim_timeout`` seconds - e.g. because the worker was
+    stopped, or their revalidation failed - unless they have been claimed
+    ``ckan.metadata.revalidation_max_attempts`` times, in which case they are dropped.
+    """
+    claim_timeout = max(1, asint(config.get('ckan.metadata.revalidation_claim_timeout', DEFAULT_CLAIM_TIMEOUT)))
+    max_attempts = max(1, asint(config.get('ckan.metadata.revalidation_max_attempts', DEFAULT_MAX_ATTEMPTS)))
+    now = time.time()
+    return _script('claim')(keys=_KEYS, args=[count, now, now + claim_timeout, max_attempts])
+
+
+def ack(metadata_record_ids):
+    """
+    Release the claims on metadata records whose revalidation has been committed.
+    """
+    if metadata_record_ids:
+        _script('ack')(keys=_KEYS, args=list(metadata_record_ids))
+
+
+def status():
+    """
+    :returns: dict{'enabled', 'depth', 'claimed_count', 'lag_seconds', 'processed_count',
+        'error_count', 'dropped_count'}, where lag_seconds is the time for which the
+        longest-waiting record has been queued or claimed
+    """
+    redis = connect_to_redis()
+    pipe = redis.pipeline()
+    pipe.zcard(QUEUE_KEY)
+    pipe.zcard(CLAIMED_KEY)
+    pipe.zrange(QUEUED_AT_KEY, 0, 0, withscores=True)
+    pipe.hgetall(STATS_KEY)
+    depth, claimed_count, oldest, stats = pipe.execute()
+    return {
+        'enabled': is_enabled(),
+        'depth': depth,
+        'claimed_count': claimed_count,
+        'lag_seconds': round(time.time() - oldest[0][1], 1) if oldest else 0,
+        'processed_count': int(stats.get('processed', 0)),
+        'error_count': int(stats.get('errors', 0)),
+        'dropped_count': int(stats.get('dropped', 0)),
+    }
+
+
+def drain(once=False):
+    """
+    Revalidate queued metadata records, highest priority first, at no more than
+    ``ckan.metadata.revalidation_rate`` records per second. Each batch of records is
+    claimed, validated (as the site user) and committed within one second; the claims
+    on the records are released only after the commit, except for records whose
+    revalidation failed, which are left to be retried when their claims expire.
+
+    :param once: stop when the queue is empty, instead of waiting for more records
+    """
+    rate = max(1, asint(config.get('ckan.metadata.revalidation_rate', DEFAULT_RATE)))
+    site_user = tk.get_action('get_site_user')({'ignore_auth': True}, {})
+    redis = connect_to_redis()
+
+    while True:
+        start_time = time.time()
+        metadata_record_ids = claim(rate)
+        if not metadata_record_ids and once:
+            break
+
+        done_ids = []
+        for metadata_record_id in metadata_record_ids:
+            context = {
+                'model': ckan_model,
+                'session': ckan_model.Session,
+                'user': site_user['name'],
+                'ignore_auth': True,
+                'defer_commit': True,
+            }
+            savepoint = ckan_model.Session.begin_nested()
+            try:
+                # records that have since been revalidated are left as is by the action
+                tk.get_action('metadata_record_validate')(context, {'id': metadata_record_id})
+                savepoint.commit()
+                done_ids += [metadata_record_id]
+            except tk.ObjectNotFound:
+                savepoint.rollback()
+                log.debug("Metadata record %s no longer exists; skipping", metadata_record_id)
+                done_ids += [metadata_record_id]
+            except Exception, e:
+                if savepoint.is_active:
+                    savepoint.rollback()
+                log.warning("Revalidation of metadata record %s failed, and will be retried: %s",
+                            metadata_record_id, e)
+
+        if metadata_record_ids:
+            ckan_model.repo.commit()
+            ack(done_ids)
+            error_count = len(metadata_record_ids) - len(done_ids)
+            pipe = redis.pipeline()
+            pipe.hincrby(STATS_KEY, 'processed', len(metadata_record_ids))
+            pipe.hincrby(STATS_KEY, 'errors', error_count)
+            pipe.execute()
+            log.debug("Revalidated %d metadata records; %d failed", len(metadata_record_ids), error_count)
+
+        elapsed = time.time() - start_time
+        if elapsed < 1:
+            time.sleep(1 - elapsed)
+
+
+def _priority(private, metadata_modified):
+    modified = calendar.timegm(metadata_modified.utctimetuple()) if metadata_modified else 0
+    return modified + (0 if private else _PUBLISHED_PRIORITY)
+
+
+def _push(entries):
+    args = []
+    for metadata_record_id, priority in entries.iteritems():
+        args += [metadata_record_id, priority]
+    args += [time.time()]
+    _script('push')(keys=[QUEUE_KEY, QUEUED_AT_KEY], args=args)
+
+
+_scripts = {}
+
+
+def _script(name):
+    if name not in _scripts:
+        _scripts[name] = connect_to_redis().register_script({
+            'push': _PUSH_SCRIPT,
+            'claim': _CLAIM_SCRIPT,
+            'ack': _ACK_SCRIPT,
+        }[name])
+    return _scripts[name]
+
+
+@after_commit.handler(_AFTER_COMMIT_NAME)
+def _push_pending(pending_dicts):
+    pending = {}
+    for pending_dict in pending_dicts:
+        pending.update(pending_dict)
+    if pending:
+        try:
+            _push(pending)
+            log.debug("Queued %d metadata records for revalidation", len(pending))
+        except Exception:
+            log.exception("Error queuing metadata records for revalidation")
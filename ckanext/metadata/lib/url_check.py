@@ -0,0 +1,268 @@
+# encoding: utf-8
+
+import logging
+import re
+import time
+import threading
+import urlparse
+from multiprocessing.pool import ThreadPool
+from paste.deploy.converters import asint
+import requests
+import requests.adapters
+
+from ckan.common import config
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 10
+DEFAULT_CONCURRENCY = 10
+DEFAULT_HOST_CONCURRENCY = 2
+DEFAULT_CACHE_TTL = 60
+DEFAULT_NEGATIVE_CACHE_TTL = 60
+
+# expired cache entries are purged when the cache grows beyond this size
+_CACHE_PURGE_SIZE = 10000
+
+
+class URLChecker(object):
+    """
+    Checks the reachability of URLs by making HEAD requests through a pooled session.
+
+    Requests are made concurrently by a pool of threads, with no more than ``host_concurrency``
+    requests in flight to any one host. Results are cached by URL - successes for ``cache_ttl``
+    seconds and failures for ``negative_cache_ttl`` seconds - so that a URL that is referenced
+    by many metadata records (or re-checked on a subsequent transition) is requested only once.
+
+    Notes:
+        - We don't verify the server certificate. We are not fetching any data
+          so there is no risk here. It just means a user might get a certificate
+          warning in their browser when following the download link. Many of our
+          metadata download links are to plain-http servers anyway, the risk of
+          man-in-the-middle attacks applies equally to all of them.
+
+        - We allow HTTP 401 Unauthorized responses to pass. This response
+          typically means the resource is present but the user will be asked to
+          login to access it.
+    """
+
+    def __init__(self, connect_timeout, read_timeout, concurrency, host_concurrency,
+                 cache_ttl, negative_cache_ttl):
+        self.timeout = (connect_timeout, read_timeout)
+        self.concurrency = concurrency
+        self.host_concurrency = host_concurrency
+        self.cache_ttl = cache_ttl
+        self.negative_cache_ttl = negative_cache_ttl
+        self.hits = 0
+        self.misses = 0
+
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+        self._pool = None
+        self._host_semaphores = {}
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def check(self, url):
+        """
+        Check a single URL.
+
+        :returns: None if the URL is reachable, otherwise an error message
+        """
+        return self.check_all([url])[url]
+
+    def check_all(self, urls):
+        """
+        Check a collection of URLs concurrently, returning once all the checks are complete.
+
+        :returns: dict of {url: None if reachable, otherwise an error message}
+        """
+        results = {}
+        pending = []
+        now = time.time()
+        with self._lock:
+            for url in set(urls):
+                entry = self._entries.get(url)
+                if entry is not None and entry[0] > now:
+                    self.hits += 1
+                    results[url] = entry[1]
+                else:
+                    self.misses += 1
+                    pending += [url]
+
+        if len(pending) == 1:
+            results[pending[0]] = self._request(pending[0])
+        elif pending:
+            results.update(zip(pending, self._get_pool().map(self._request, pending)))
+        return results
+
+    def _request(self, url):
+        semaphore = self._get_host_semaphore(url)
+        with semaphore:
+            try:
+                response = self._session.head(url, verify=False, timeout=self.timeout)
+                if response.status_code != 401:
+                    response.raise_for_status()
+                error = None
+            except requests.RequestException, e:
+                error = str(e)
+            except ValueError, e:
+                # e.g. an unsupported or malformed URL that requests does not wrap
+                error = str(e)
+
+        ttl = self.cache_ttl if error is None else self.negative_cache_ttl
+        if ttl > 0:
+            with self._lock:
+                if len(self._entries) >= _CACHE_PURGE_SIZE:
+                    now = time.time()
+                    for expired_url in [u for u, (expiry, _e) in self._entries.iteritems() if expiry <= now]:
+                        del self._entries[expired_url]
+                self._entries[url] = (time.time() + ttl, error)
+        return error
+
+    def _get_host_semaphore(self, url):
+        host = urlparse.urlparse(url).netloc.lower()
+        with self._lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = threading.BoundedSemaphore(self.host_concurrency)
+            return self._host_semaphores[host]
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.concurrency)
+            return self._pool
+
+    def clear(self):
+        """
+        Remove all cached results and reset the hit/miss counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        :return: dict{'size', 'hits', 'misses'}
+        """
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+_checker = None
+_checker_lock = threading.Lock()
+
+
+def _get_checker():
+    global _checker
+    if _checker is None:
+        with _checker_lock:
+            if _checker is None:
+                _checker = URLChecker(
+                    connect_timeout=asint(config.get('ckan.metadata.url_test_connect_timeout',
+                                                     DEFAULT_CONNECT_TIMEOUT)),
+                    read_timeout=asint(config.get('ckan.metadata.url_test_read_timeout',
+                                                  DEFAULT_READ_TIMEOUT)),
+                    concurrency=max(1, asint(config.get('ckan.metadata.url_test_concurrency',
+                                                        DEFAULT_CONCURRENCY))),
+                    host_concurrency=max(1, asint(config.get('ckan.metadata.url_test_host_concurrency',
+                                                             DEFAULT_HOST_CONCURRENCY))),
+                    cache_ttl=asint(config.get('ckan.metadata.url_test_cache_ttl',
+                                               DEFAULT_CACHE_TTL)),
+                    negative_cache_ttl=asint(config.get('ckan.metadata.url_test_negative_cache_ttl',
+                                                        DEFAULT_NEGATIVE_CACHE_TTL)),
+                )
+    return _checker
+
+
+def check_url(url):
+    """
+    Check a URL using the process-wide URL checker. See :py:meth:`URLChecker.check`.
+    """
+    return _get_checker().check(url)
+
+
+def check_urls(urls):
+    """
+    Check URLs concurrently using the process-wide URL checker. See :py:meth:`URLChecker.check_all`.
+    """
+    return _get_checker().check_all(urls)
+
+
+def clear():
+    _get_checker().clear()
+
+
+def stats():
+    """
+    Get the size and hit/miss counters of the process-wide URL check cache.
+    """
+    return _get_checker().stats()
+
+
+def find_url_test_instances(resolver, schema, instance):
+    """
+    Find the (string) instances in a document that are subject to a "urlTest": true keyword,
+    by walking the schema and the document together. Subschemas under "allOf", "anyOf", "oneOf",
+    "not" and "if"/"then"/"else" are all followed regardless of whether they apply, so the result
+    may include URLs that validation would not test; it is intended for prefetching.
+
+    :param resolver: the jsonschema RefResolver for the schema
+    :param schema: the (sub)schema dict
+    :param instance: the (sub)document
+    :returns: set of strings
+    """
+    urls = set()
+    visited = set()
+    nodes = [(schema, instance)]
+    while nodes:
+        schema, instance = nodes.pop()
+        if not isinstance(schema, dict) or (id(schema), id(instance)) in visited:
+            continue
+        visited.add((id(schema), id(instance)))
+
+        if '$ref' in schema:
+            try:
+                _url, resolved = resolver.resolve(schema['$ref'])
+                nodes += [(resolved, instance)]
+            except Exception:
+                pass
+            continue
+
+        if schema.get('urlTest') is True and isinstance(instance, basestring):
+            urls.add(instance)
+
+        for keyword in ('allOf', 'anyOf', 'oneOf'):
+            if isinstance(schema.get(keyword), list):
+                nodes += [(subschema, instance) for subschema in schema[keyword]]
+        for keyword in ('not', 'if', 'then', 'else'):
+            if keyword in schema:
+                nodes += [(schema[keyword], instance)]
+
+        if isinstance(instance, dict):
+            properties = schema.get('properties') or {}
+            for key, value in instance.iteritems():
+                if key in properties:
+                    nodes += [(properties[key], value)]
+                else:
+                    nodes += [(schema.get('additionalProperties'), value)]
+                nodes += [(subschema, value) for pattern, subschema in (schema.get('patternProperties') or {}).iteritems()
+                          if re.search(pattern, key)]
+        elif isinstance(instance, list):
+            items = schema.get('items')
+            if isinstance(items, list):
+                nodes += zip(items, instance)
+                nodes += [(schema.get('additionalItems'), value) for value in instance[len(items):]]
+            else:
+                nodes += [(items, value) for value in instance]
+            nodes += [(schema.get('contains'), value) for value in instance]
+
+    return urls
@@ -0,0 +1,139 @@
+# encoding: utf-8
+
+import logging
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from paste.deploy.converters import asint
+
+from ckan.common import config
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CACHE_SIZE = 100
+
+
+class ValidatorCache(object):
+    """
+    A thread-safe, least-recently-used cache of prepared JSONValidator objects.
+
+    Entries are keyed by validator class, by the id of the object that owns the schema
+    (a metadata schema or a workflow state) and by a content hash of the schema JSON, so an
+    entry can never be returned for a schema that has since been changed. Invalidation merely
+    frees up the slots occupied by superseded versions.
+
+    Cached validators must not be used directly; call ``bind()`` on the returned validator
+    to get a copy carrying the per-call object_id and context.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, validator_cls, object_id, schema_json):
+        """
+        Return a prepared validator for the given schema, creating it if necessary.
+
+        :param validator_cls: JSONValidator subclass
+        :param object_id: the id of the object that owns the schema
+        :param schema_json: the schema, as a JSON string
+        :return: instance of validator_cls
+        """
+        key = (validator_cls.__name__, object_id, _content_hash(schema_json))
+        with self._lock:
+            validator = self._entries.pop(key, None)
+            if validator is not None:
+                self._entries[key] = validator
+                self.hits += 1
+                return validator
+            self.misses += 1
+
+        # prepare the validator outside of the lock; if two threads miss on the same key
+        # at the same time, the second one simply replaces the first one's entry
+        validator = validator_cls(json.loads(schema_json))
+        if self.maxsize > 0:
+            with self._lock:
+                self._entries[key] = validator
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return validator
+
+    def invalidate(self, object_id):
+        """
+        Remove all entries for the given schema-owning object.
+        """
+        with self._lock:
+            for key in [key for key in self._entries if key[1] == object_id]:
+                del self._entries[key]
+
+    def clear(self):
+        """
+        Remove all entries and reset the hit/miss counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        :return: dict{'size', 'maxsize', 'hits', 'misses'}
+        """
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+def _content_hash(schema_json):
+    if isinstance(schema_json, unicode):
+        schema_json = schema_json.encode('utf-8')
+    return hashlib.sha1(schema_json).hexdigest()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def _get_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                maxsize = asint(config.get('ckan.metadata.validator_cache_size', DEFAULT_CACHE_SIZE))
+                log.debug("Creating validator cache with max size %d", maxsize)
+                _cache = ValidatorCache(maxsize)
+    return _cache
+
+
+def get_validator(validator_cls, object_id, schema_json):
+    """
+    Get a prepared validator from the process-wide validator cache.
+    See :py:meth:`ValidatorCache.get`.
+    """
+    return _get_cache().get(validator_cls, object_id, schema_json)
+
+
+def invalidate(object_id):
+    """
+    Remove any cached validators for the given metadata schema or workflow state.
+    """
+    _get_cache().invalidate(object_id)
+
+
+def clear():
+    _get_cache().clear()
+
+
+def stats():
+    """
+    Get the size and hit/miss counters of the process-wide validator cache.
+    """
+    return _get_cache().stats()
@@ -0,0 +1,167 @@
+# encoding: utf-8
+
+import logging
+import time
+import threading
+from paste.deploy.converters import asint
+from sqlalchemy import event
+
+from ckan.common import config
+from ckan import model as ckan_model
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CACHE_TTL = 300
+
+# flags a session in which vocabularies or vocabulary tags have been changed
+_SESSION_INFO_KEY = 'metadata_vocabulary_changed'
+
+
+class VocabularyCache(object):
+    """
+    A thread-safe cache of the tag sets of CKAN vocabularies, keyed by vocabulary name.
+    Each entry is a frozenset of lowercased tag names, or None for a non-existent vocabulary.
+
+    Entries are invalidated in-process whenever a vocabulary or a vocabulary tag is
+    created, changed or deleted; they also expire after ``ttl`` seconds, which bounds
+    how long other processes may go on using a superseded tag set.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, session, vocabulary_name):
+        """
+        Return the tag set of the given vocabulary, loading it if necessary.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(vocabulary_name)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        vocabulary = session.query(ckan_model.Vocabulary) \
+            .filter(ckan_model.Vocabulary.name == vocabulary_name) \
+            .first()
+        if vocabulary is not None:
+            tags = frozenset(name.lower() for (name,) in session.query(ckan_model.Tag.name)
+                             .filter(ckan_model.Tag.vocabulary_id == vocabulary.id))
+        else:
+            tags = None
+
+        if self.ttl > 0:
+            with self._lock:
+                self._entries[vocabulary_name] = (now + self.ttl, tags)
+        return tags
+
+    def clear(self):
+        """
+        Remove all entries and reset the hit/miss counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def invalidate_all(self):
+        """
+        Remove all entries, retaining the hit/miss counters.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        :return: dict{'size', 'ttl', 'hits', 'misses'}
+        """
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def _get_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                ttl = asint(config.get('ckan.metadata.vocabulary_cache_ttl', DEFAULT_CACHE_TTL))
+                log.debug("Creating vocabulary cache with TTL %ds", ttl)
+                _cache = VocabularyCache(ttl)
+    return _cache
+
+
+def get_tags(session, vocabulary_name):
+    """
+    Get the lowercased tag names of a vocabulary from the process-wide cache.
+    See :py:meth:`VocabularyCache.get`.
+
+    :returns: frozenset, or None if the vocabulary does not exist
+    """
+    return _get_cache().get(session, vocabulary_name)
+
+
+def invalidate():
+    """
+    Remove all cached vocabulary tag sets. Vocabulary changes are rare, so there is
+    no need to be more selective than this.
+    """
+    _get_cache().invalidate_all()
+
+
+def clear():
+    _get_cache().clear()
+
+
+def stats():
+    """
+    Get the size and hit/miss counters of the process-wide vocabulary cache.
+    """
+    return _get_cache().stats()
+
+
+@event.listens_for(ckan_model.Session, 'after_flush')
+def _after_flush(session, flush_context):
+    # vocabularies and tags are changed by core CKAN actions (and by package updates that
+    # add vocabulary tags), so we watch the session rather than hooking into our own actions;
+    # free tags, which are created along with packages, are ignored
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, ckan_model.Vocabulary) or \
+                (isinstance(obj, ckan_model.Tag) and obj.vocabulary_id is not None):
+            invalidate()
+            # invalidate again on commit (or rollback), in case another session has
+            # meanwhile reloaded the previously committed tags
+            session.info[_SESSION_INFO_KEY] = True
+            return
+
+
+@event.listens_for(ckan_model.Session, 'after_commit')
+def _after_commit(session):
+    # the release of a savepoint is also reported as a commit; the changes are visible
+    # to other sessions only once the outermost transaction commits
+    if session.transaction.nested:
+        return
+    if session.info.pop(_SESSION_INFO_KEY, False):
+        invalidate()
+
+
+@event.listens_for(ckan_model.Session, 'after_rollback')
+def _after_rollback(session):
+    if session.info.get(_SESSION_INFO_KEY, False):
+        invalidate()
+        # changes flushed outside of a rolled-back savepoint may yet be committed
+        if not session.transaction.nested:
+            session.info.pop(_SESSION_INFO_KEY, None)
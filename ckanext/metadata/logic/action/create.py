@@ -2,17 +2,21 @@
 
 import logging
 import json
-from paste.deploy.converters import asbool
-from sqlalchemy import func
+from paste.deploy.converters import asbool, asint
 
 import ckan.plugins.toolkit as tk
-from ckan.common import _
+from ckan.common import _, config
 from ckanext.metadata.logic import schema
 from ckanext.metadata.lib.dictization import model_save
+from ckanext.metadata.lib import record_match
+from ckanext.metadata.lib import parsed_json
+from ckanext.metadata.lib.bulk_invalidate import bulk_invalidate
 from ckan.logic.action.create import organization_create as ckan_org_create
 
 log = logging.getLogger(__name__)
 
+DEFAULT_BULK_UPSERT_BATCH_SIZE = 500
+
 
 # optional params may or may not be supplied by the caller
 # nullable params must be supplied but may be empty
@@ -140,13 +144,10 @@ def metadata_schema_create(context, data_dict):
     dependent_record_list = tk.get_action('metadata_schema_dependent_record_list')(dependent_record_list_context, {'id': metadata_schema.id})
     invalidate_context = context.copy()
     invalidate_context.update({
-        'defer_commit': True,
-        'ignore_auth': True,
         'trigger_action': 'metadata_schema_create',
         'trigger_object_id': metadata_schema.id,
     })
-    for metadata_record_id in dependent_record_list:
-        tk.get_action('metadata_record_invalidate')(invalidate_context, {'id': metadata_record_id})
+    bulk_invalidate(invalidate_context, dependent_record_list)
 
     if not defer_commit:
         model.repo.commit()
@@ -339,6 +340,8 @@ def metadata_record_create(context, data_dict):
     Note that these fields (as well as 'name') may be used in metadata JSON attribute mappings, in which
     case the input value(s) are ignored and overridden by the mapped element(s) from the metadata JSON.
 
+    If an existing record is matched, 'matched_by' ('doi' or 'sid') is set in the context.
+
     :returns: the newly created metadata record (unless 'return_id_only' is set to True
               in the context, in which case just the metadata record id will be returned)
     :rtype: dictionary
@@ -369,21 +372,13 @@ def metadata_record_create(context, data_dict):
 
     # find a matching record by DOI
     if doi:
-        existing_doi_rec = session.query(model.Package). \
-            join(model.PackageExtra, model.Package.id == model.PackageExtra.package_id). \
-            filter(model.PackageExtra.key == 'doi'). \
-            filter(func.lower(model.PackageExtra.value) == doi.lower()). \
-            first()
+        existing_doi_rec = record_match.find_metadata_record(context, 'doi', doi)
     else:
         existing_doi_rec = None
 
     # find a matching record by SID
     if sid:
-        existing_sid_rec = session.query(model.Package). \
-            join(model.PackageExtra, model.Package.id == model.PackageExtra.package_id). \
-            filter(model.PackageExtra.key == 'sid'). \
-            filter(func.lower(model.PackageExtra.value) == sid.lower()). \
-            first()
+        existing_sid_rec = record_match.find_metadata_record(context, 'sid', sid)
     else:
         existing_sid_rec = None
 
@@ -402,6 +397,7 @@ def metadata_record_create(context, data_dict):
     # matched on DOI; switch to an update
     if existing_doi_rec:
         log.info('Matched existing record on DOI; switching to metadata_record_update')
+        context['matched_by'] = 'doi'
         data_dict['id'] = existing_doi_rec.id
         return tk.get_action('metadata_record_update')(internal_context, data_dict)
 
@@ -409,11 +405,13 @@ def metadata_record_create(context, data_dict):
     # metadata_record_update ensures that an existing DOI is not changed or un-set
     if existing_sid_rec:
         log.info('Matched existing record on SID; switching to metadata_record_update')
+        context['matched_by'] = 'sid'
         data_dict['id'] = existing_sid_rec.id
         return tk.get_action('metadata_record_update')(internal_context, data_dict)
 
     # check for discrepancy between parameterized DOI and metadata DOI
-    metadata_dict = json.loads(data_dict['metadata_json'])
+    # the metadata JSON has already been parsed during schema validation
+    metadata_dict = parsed_json.loads(internal_context, data_dict['metadata_json'])
     try:
         metadata_doi = metadata_dict['doi']
         if not isinstance(metadata_doi, basestring) or metadata_doi.lower() != doi.lower():
@@ -423,13 +421,13 @@ def metadata_record_create(context, data_dict):
 
     # inject DOI into the metadata
     if doi:
-        metadata_dict['doi'] = doi
-        data_dict['metadata_json'] = json.dumps(metadata_dict, ensure_ascii=False)
+        metadata_dict = dict(metadata_dict, doi=doi)
+        data_dict['metadata_json'] = parsed_json.dumps(internal_context, metadata_dict)
 
     # map values from the metadata JSON into the data_dict
     attr_map = tk.get_action('metadata_json_attr_map_apply')(internal_context, {
         'metadata_standard_id': data_dict.get('metadata_standard_id'),
-        'metadata_json': data_dict.get('metadata_json'),
+        'metadata_dict': metadata_dict,
     })
     data_dict.update(attr_map['data_dict'])
 
@@ -449,6 +447,7 @@ def metadata_record_create(context, data_dict):
     })
     metadata_record_id = tk.get_action('package_create')(internal_context, data_dict)
     model_save.metadata_record_collection_membership_save(data_dict['metadata_collection_id'], internal_context)
+    model_save.metadata_record_attrs_save(internal_context['package'], internal_context)
 
     if not defer_commit:
         model.repo.commit()
@@ -458,6 +457,100 @@ def metadata_record_create(context, data_dict):
     return output
 
 
+def metadata_record_bulk_upsert(context, data_dict):
+    """
+    Create or update multiple metadata records, e.g. from a harvest run.
+
+    Each record is processed as by :py:func:`metadata_record_create`, including matching
+    on DOI and/or SID to switch to an update. However, the DOI and SID matches for all the
+    records are resolved up front using one query per attribute, and the metadata JSON
+    attribute maps are loaded once per metadata standard.
+
+    Each record is created or updated within its own savepoint, so that a failed record does
+    not affect the others, and the transaction is committed after every ``batch_size`` records.
+    A record that fails for any reason, including an unexpected exception, is rolled back to
+    its savepoint and reported as an error.
+
+    :param records: list of metadata record dicts, with the parameters described for
+        :py:func:`metadata_record_create`
+    :type records: list of dictionaries
+    :param batch_size: the number of records to process per commit (optional, default:
+        the value of the config option ``ckan.metadata.bulk_upsert_batch_size``, or 500)
+    :type batch_size: integer
+
+    :returns: { total_count, error_count, results }, where results contains a dict
+        { id, status, errors } for each input record (in order); status is one of
+        'created', 'updated' or 'error'
+    :rtype: dictionary
+    """
+    log.info("Bulk upserting metadata records")
+    tk.check_access('metadata_record_bulk_upsert', context, data_dict)
+
+    model = context['model']
+    session = context['session']
+    defer_commit = context.get('defer_commit', False)
+
+    records = data_dict.get('records')
+    if not isinstance(records, list) or not all(isinstance(record, dict) for record in records):
+        raise tk.ValidationError({'records': [_('Must be a list of dictionaries')]})
+
+    try:
+        batch_size = asint(data_dict.get('batch_size') or
+                           config.get('ckan.metadata.bulk_upsert_batch_size', DEFAULT_BULK_UPSERT_BATCH_SIZE))
+        if batch_size < 1:
+            raise ValueError
+    except ValueError:
+        raise tk.ValidationError({'batch_size': [_('Must be a positive integer')]})
+
+    # the DOI/SID match cache is shared by the create/update calls for all the records
+    upsert_context = context.copy()
+    upsert_context.update({
+        'defer_commit': True,
+        'return_id_only': True,
+    })
+
+    results = []
+    for i in range(0, len(records), batch_size):
+        batch = records[i:i + batch_size]
+        record_match.preload_matches(upsert_context, batch)
+
+        for record in batch:
+            result = {'id': None, 'status': None, 'errors': None}
+            record_context = upsert_context.copy()
+
+            savepoint = session.begin_nested()
+            try:
+                result['id'] = metadata_record_create(record_context, dict(record))
+                result['status'] = 'updated' if record_context.get('matched_by') else 'created'
+            except tk.ValidationError, e:
+                result.update({'status': 'error', 'errors': e.error_dict})
+            except (tk.ObjectNotFound, tk.NotAuthorized), e:
+                result.update({'status': 'error', 'errors': {'message': unicode(e.message or e.__class__.__name__)}})
+            except Exception, e:
+                log.exception("Bulk upsert: unexpected error processing metadata record")
+                result.update({'status': 'error', 'errors': {'message': unicode(e) or e.__class__.__name__}})
+
+            if result['status'] == 'error':
+                # the failed action may already have rolled back (and closed) the savepoint
+                if savepoint.session is not None:
+                    savepoint.rollback()
+            elif savepoint.is_active:
+                savepoint.commit()
+            if result['id']:
+                record_match.refresh_match(upsert_context, result['id'])
+            results += [result]
+
+        if not defer_commit:
+            model.repo.commit()
+        log.debug("Bulk upsert: processed %d of %d metadata records", i + len(batch), len(records))
+
+    return {
+        'total_count': len(records),
+        'error_count': len([result for result in results if result['status'] == 'error']),
+        'results': results,
+    }
+
+
 def workflow_state_create(context, data_dict):
     """
     Create a new workflow state.
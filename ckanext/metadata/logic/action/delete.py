@@ -7,6 +7,8 @@ import ckan.plugins.toolkit as tk
 from ckan.common import _
 import ckanext.metadata.model as ckanext_model
 from ckanext.metadata.lib.dictization import model_dictize
+from ckanext.metadata.lib import validator_cache
+from ckanext.metadata.lib.bulk_invalidate import bulk_invalidate
 
 log = logging.getLogger(__name__)
 
@@ -37,9 +39,8 @@ def metadata_standard_delete(context, data_dict):
     tk.check_access('metadata_standard_delete', context, data_dict)
 
     if session.query(model.Package) \
-            .join(model.PackageExtra, model.Package.id == model.PackageExtra.package_id) \
-            .filter(model.PackageExtra.key == 'metadata_standard_id') \
-            .filter(model.PackageExtra.value == metadata_standard_id) \
+            .join(ckanext_model.MetadataRecordAttrs, model.Package.id == ckanext_model.MetadataRecordAttrs.package_id) \
+            .filter(ckanext_model.MetadataRecordAttrs.metadata_standard_id == metadata_standard_id) \
             .filter(model.Package.type == 'metadata_record') \
             .filter(model.Package.state != 'deleted') \
             .count() > 0:
@@ -116,15 +117,13 @@ def metadata_schema_delete(context, data_dict):
     dependent_record_list = tk.get_action('metadata_schema_dependent_record_list')(dependent_record_list_context, {'id': metadata_schema_id})
     invalidate_context = context.copy()
     invalidate_context.update({
-        'defer_commit': True,
         'trigger_action': 'metadata_schema_delete',
         'trigger_object_id': metadata_schema_id,
-        'ignore_auth': True,
     })
-    for metadata_record_id in dependent_record_list:
-        tk.get_action('metadata_record_invalidate')(invalidate_context, {'id': metadata_record_id})
+    bulk_invalidate(invalidate_context, dependent_record_list)
 
     metadata_schema.delete()
+    validator_cache.invalidate(metadata_schema_id)
     if not defer_commit:
         model.repo.commit()
 
@@ -212,9 +211,8 @@ def metadata_collection_delete(context, data_dict):
     tk.check_access('metadata_collection_delete', context, data_dict)
 
     if session.query(model.Package) \
-            .join(model.PackageExtra, model.Package.id == model.PackageExtra.package_id) \
-            .filter(model.PackageExtra.key == 'metadata_collection_id') \
-            .filter(model.PackageExtra.value == metadata_collection_id) \
+            .join(ckanext_model.MetadataRecordAttrs, model.Package.id == ckanext_model.MetadataRecordAttrs.package_id) \
+            .filter(ckanext_model.MetadataRecordAttrs.metadata_collection_id == metadata_collection_id) \
             .filter(model.Package.type == 'metadata_record') \
             .filter(model.Package.state != 'deleted') \
             .count() > 0:
@@ -242,6 +240,7 @@ def metadata_record_delete(context, data_dict):
     log.info("Deleting metadata record: %r", data_dict)
 
     model = context['model']
+    defer_commit = context.get('defer_commit', False)
 
     metadata_record_id = tk.get_or_bust(data_dict, 'id')
     metadata_record = model.Package.get(metadata_record_id)
@@ -257,6 +256,7 @@ def metadata_record_delete(context, data_dict):
     internal_context.update({
         'invoked_action': 'metadata_record_delete',
         'ignore_auth': True,
+        'defer_commit': True,
     })
 
     tk.get_action('package_delete')(internal_context, data_dict)
@@ -264,6 +264,9 @@ def metadata_record_delete(context, data_dict):
     # make sure it's not left in the search index
     tk.get_action('metadata_record_index_update')(internal_context, {'id': metadata_record_id})
 
+    if not defer_commit:
+        model.repo.commit()
+
 
 def workflow_state_delete(context, data_dict):
     """
@@ -291,9 +294,8 @@ def workflow_state_delete(context, data_dict):
     tk.check_access('workflow_state_delete', context, data_dict)
 
     if session.query(model.Package) \
-            .join(model.PackageExtra, model.Package.id == model.PackageExtra.package_id) \
-            .filter(model.PackageExtra.key == 'workflow_state_id') \
-            .filter(model.PackageExtra.value == workflow_state_id) \
+            .join(ckanext_model.MetadataRecordAttrs, model.Package.id == ckanext_model.MetadataRecordAttrs.package_id) \
+            .filter(ckanext_model.MetadataRecordAttrs.workflow_state_id == workflow_state_id) \
             .filter(model.Package.type == 'metadata_record') \
             .filter(model.Package.state != 'deleted') \
             .count() > 0:
@@ -333,6 +335,7 @@ def workflow_state_delete(context, data_dict):
     rev.message = _(u'REST API: Delete workflow state %s') % workflow_state_id
 
     workflow_state.delete()
+    validator_cache.invalidate(workflow_state_id)
     if not defer_commit:
         model.repo.commit()
 
@@ -1,19 +1,21 @@
 # encoding: utf-8
 
 import json
+import base64
 import logging
 
 import ckan.plugins.toolkit as tk
-import jsonpointer
 from ckan.common import _
 from paste.deploy.converters import asbool
 from sqlalchemy import func
-from sqlalchemy import or_
+from sqlalchemy import or_, tuple_
 from sqlalchemy.orm import aliased
 
 import ckanext.metadata.model as ckanext_model
 from ckanext.metadata.common import METADATA_VALIDATION_ACTIVITY_TYPE, METADATA_WORKFLOW_ACTIVITY_TYPE
 from ckanext.metadata.lib.dictization import model_dictize
+from ckanext.metadata.lib import attr_map_cache
+from ckanext.metadata.lib import revalidation_queue
 from ckanext.metadata.logic import schema
 from ckanext.metadata.logic.metadata_validator import MetadataValidator
 from ckanext.metadata.logic.workflow_validator import WorkflowValidator
@@ -185,20 +187,17 @@ def metadata_schema_dependent_record_list(context, data_dict):
 
     tk.check_access('metadata_schema_dependent_record_list', context, data_dict)
 
+    attrs = ckanext_model.MetadataRecordAttrs
     q = session.query(model.Package.id) \
-        .join(model.PackageExtra) \
+        .join(attrs, model.Package.id == attrs.package_id) \
         .filter(model.Package.state == 'active') \
-        .filter(model.PackageExtra.key == 'metadata_standard_id') \
-        .filter(model.PackageExtra.value == metadata_schema.metadata_standard_id)
+        .filter(attrs.metadata_standard_id == metadata_schema.metadata_standard_id)
 
     if metadata_schema.organization_id:
         q = q.filter(model.Package.owner_org == metadata_schema.organization_id)
 
     if metadata_schema.infrastructure_id:
-        collection_extra = aliased(model.PackageExtra)
-        q = q.join(collection_extra, model.Package.id == collection_extra.package_id) \
-            .filter(collection_extra.key == 'metadata_collection_id') \
-            .join(model.Member, collection_extra.value == model.Member.table_id) \
+        q = q.join(model.Member, attrs.metadata_collection_id == model.Member.table_id) \
             .filter(model.Member.table_name == 'group') \
             .filter(model.Member.state == 'active') \
             .join(model.Group, model.Group.id == model.Member.group_id) \
@@ -418,9 +417,8 @@ def metadata_record_by_doi(context, data_dict):
     session = context['session']
 
     doi = tk.get_or_bust(data_dict, 'doi')
-    metadata_record_id = session.query(model.PackageExtra.package_id). \
-        filter(model.PackageExtra.key == 'doi'). \
-        filter(func.lower(model.PackageExtra.value) == doi.lower()). \
+    metadata_record_id = session.query(ckanext_model.MetadataRecordAttrs.package_id). \
+        filter(func.lower(ckanext_model.MetadataRecordAttrs.doi) == doi.lower()). \
         scalar()
     data_dict['id'] = metadata_record_id
     return tk.get_action('metadata_record_show')(context, data_dict)
@@ -446,9 +444,8 @@ def metadata_record_by_sid(context, data_dict):
     session = context['session']
 
     sid = tk.get_or_bust(data_dict, 'sid')
-    metadata_record_id = session.query(model.PackageExtra.package_id). \
-        filter(model.PackageExtra.key == 'sid'). \
-        filter(func.lower(model.PackageExtra.value) == sid.lower()). \
+    metadata_record_id = session.query(ckanext_model.MetadataRecordAttrs.package_id). \
+        filter(func.lower(ckanext_model.MetadataRecordAttrs.sid) == sid.lower()). \
         scalar()
     data_dict['id'] = metadata_record_id
     return tk.get_action('metadata_record_show')(context, data_dict)
@@ -476,8 +473,15 @@ def metadata_record_list(context, data_dict):
     :type limit: int
     :param offset: when ``limit`` is given, the number of rows to skip (optional, default: ``0``)
     :type offset: int
+    :param cursor: use keyset pagination: pass an empty string to get the first page, and thereafter
+        the ``next_cursor`` value from the previous page; ``offset`` is ignored, and ``limit``
+        defaults to 100 (optional)
+    :type cursor: string
+    :param count_only: return only the number of matching records (optional, default: ``False``)
+    :type count_only: boolean
 
-    :rtype: list of strings
+    :rtype: list of strings (dictionaries if all_fields); if count_only, an int; if a cursor
+        is given, a dict of { results, next_cursor }, where next_cursor is None on the last page
     """
     log.debug("Retrieving metadata record list: %r", data_dict)
     tk.check_access('metadata_record_list', context, data_dict)
@@ -497,10 +501,12 @@ def metadata_record_list(context, data_dict):
     all_fields = asbool(data_dict.get('all_fields'))
     limit = data_dict.get('limit')
     offset = data_dict.get('offset')
+    count_only = asbool(data_dict.get('count_only'))
+    cursor = data_dict.get('cursor')
+    keyset = cursor is not None
 
     metadata_records_q = session.query(model.Package.id, model.Package.name) \
-        .filter_by(type='metadata_record', state='active') \
-        .order_by(model.Package.title, model.Package.name)
+        .filter_by(type='metadata_record', state='active')
 
     if ids:
         metadata_records_q = metadata_records_q.filter(or_(
@@ -528,9 +534,10 @@ def metadata_record_list(context, data_dict):
         if owner_org != metadata_collection_organization_id:
             raise tk.ValidationError(_("owner_org must be the same organization that owns the metadata collection"))
 
-        metadata_records_q = metadata_records_q.join(model.PackageExtra) \
-            .filter(model.PackageExtra.key == 'metadata_collection_id') \
-            .filter(model.PackageExtra.value == metadata_collection_id)
+        metadata_records_q = metadata_records_q \
+            .join(ckanext_model.MetadataRecordAttrs,
+                  model.Package.id == ckanext_model.MetadataRecordAttrs.package_id) \
+            .filter(ckanext_model.MetadataRecordAttrs.metadata_collection_id == metadata_collection_id)
 
     if infrastructure_id:
         infrastructure = model.Group.get(infrastructure_id)
@@ -540,27 +547,89 @@ def metadata_record_list(context, data_dict):
             raise tk.ObjectNotFound('%s: %s' % (_('Not found'), _('Project')))
         infrastructure_id = infrastructure.id
 
+        infrastructure_attrs = aliased(ckanext_model.MetadataRecordAttrs)
         metadata_records_q = metadata_records_q \
-            .join(model.PackageExtra, model.Package.id == model.PackageExtra.package_id) \
-            .filter(model.PackageExtra.key == 'metadata_collection_id') \
-            .join(model.Member, model.PackageExtra.value == model.Member.table_id) \
+            .join(infrastructure_attrs, model.Package.id == infrastructure_attrs.package_id) \
+            .join(model.Member, infrastructure_attrs.metadata_collection_id == model.Member.table_id) \
             .filter(model.Member.group_id == infrastructure_id) \
             .filter(model.Member.table_name == 'group') \
             .filter(model.Member.state != 'deleted')
 
-    if limit:
-        metadata_records_q = metadata_records_q.limit(limit)
-        if offset:
-            metadata_records_q = metadata_records_q.offset(offset)
+    if count_only:
+        return metadata_records_q.with_entities(func.count(model.Package.id)).scalar()
+
+    if keyset:
+        # order by a non-null sort key, so that it can be compared using a row value
+        sort_title = func.coalesce(model.Package.title, u'')
+        metadata_records_q = metadata_records_q \
+            .add_columns(sort_title) \
+            .order_by(sort_title, model.Package.name)
+        if cursor:
+            try:
+                cursor_title, cursor_name = json.loads(base64.urlsafe_b64decode(str(cursor)))
+            except (TypeError, ValueError):
+                raise tk.ValidationError({'cursor': [_('Invalid cursor')]})
+            metadata_records_q = metadata_records_q.filter(
+                tuple_(sort_title, model.Package.name) > tuple_(cursor_title, cursor_name))
+        try:
+            limit = int(limit or 100)
+        except (TypeError, ValueError):
+            raise tk.ValidationError({'limit': [_('Invalid integer')]})
+        metadata_records_q = metadata_records_q.limit(limit + 1)
+    else:
+        metadata_records_q = metadata_records_q.order_by(model.Package.title, model.Package.name)
+        if limit:
+            metadata_records_q = metadata_records_q.limit(limit)
+            if offset:
+                metadata_records_q = metadata_records_q.offset(offset)
 
     metadata_records = metadata_records_q.all()
+
+    if keyset:
+        next_cursor = None
+        if len(metadata_records) > limit:
+            metadata_records = metadata_records[:limit]
+            last_id, last_name, last_title = metadata_records[-1]
+            next_cursor = base64.urlsafe_b64encode(json.dumps([last_title, last_name]))
+        metadata_records = [(id_, name) for (id_, name, sort_title_) in metadata_records]
+        return {
+            'results': _metadata_record_list_results(context, data_dict, metadata_records, all_fields),
+            'next_cursor': next_cursor,
+        }
+
+    return _metadata_record_list_results(context, data_dict, metadata_records, all_fields)
+
+
+def _metadata_record_list_results(context, data_dict, metadata_records, all_fields):
+    """
+    Convert (id, name) tuples to the output of metadata_record_list.
+    """
+    model = context['model']
+    session = context['session']
+
+    if not all_fields:
+        return [name for (id_, name) in metadata_records]
+
+    deserialize_json = asbool(data_dict.get('deserialize_json'))
+    metadata_record_ids = [id_ for (id_, name) in metadata_records]
+    packages = session.query(model.Package).filter(model.Package.id.in_(metadata_record_ids)).all() \
+        if metadata_record_ids else []
+    packages = {package.id: package for package in packages}
+    packages = [packages[id_] for id_ in metadata_record_ids]
+
+    # metadata_record_show auth depends (at most) on the owning organization, so check it
+    # once per organization rather than once per record
+    checked_orgs = set()
+    for package in packages:
+        if package.owner_org not in checked_orgs:
+            tk.check_access('metadata_record_show', context, {'id': package.id})
+            checked_orgs.add(package.owner_org)
+
+    show_schema = schema.metadata_record_show_schema(deserialize_json)
     result = []
-    for (id_, name) in metadata_records:
-        if all_fields:
-            data_dict['id'] = id_
-            result += [tk.get_action('metadata_record_show')(context, data_dict)]
-        else:
-            result += [name]
+    for metadata_record_dict in model_dictize.metadata_record_list_dictize(packages, context):
+        result_dict, errors = tk.navl_validate(metadata_record_dict, show_schema, context)
+        result += [result_dict]
 
     return result
 
@@ -696,8 +765,8 @@ def metadata_record_validation_schema_list(context, data_dict):
         .filter(model.Member.state == 'active') \
         .all()
     infrastructure_ids = [infra_id for (infra_id,) in infrastructure_ids] + [None]
-    metadata_standard_id = session.query(model.PackageExtra.value) \
-        .filter_by(package_id=metadata_record_id, key='metadata_standard_id').scalar()
+    metadata_standard_id = session.query(ckanext_model.MetadataRecordAttrs.metadata_standard_id) \
+        .filter_by(package_id=metadata_record_id).scalar()
 
     MetadataSchema = ckanext_model.MetadataSchema
     metadata_schema_names = session.query(MetadataSchema.name) \
@@ -1239,6 +1308,9 @@ def metadata_json_attr_map_apply(context, data_dict):
     :type metadata_standard_id: string
     :param metadata_json: JSON dictionary of metadata content
     :type metadata_json: string
+    :param metadata_dict: the metadata content as an already-parsed dictionary; may be
+        supplied instead of metadata_json
+    :type metadata_dict: dictionary
 
     :rtype: dictionary {
                 'data_dict': dict of mapped attribute-value pairs
@@ -1249,38 +1321,23 @@ def metadata_json_attr_map_apply(context, data_dict):
     tk.check_access('metadata_json_attr_map_apply', context, data_dict)
 
     session = context['session']
-    data, errors = tk.navl_validate(data_dict, schema.metadata_json_attr_map_apply_schema(), context)
+    metadata_dict = data_dict.get('metadata_dict')
+    apply_schema = schema.metadata_json_attr_map_apply_schema()
+    if metadata_dict is not None:
+        if type(metadata_dict) is not dict:
+            raise tk.ValidationError({'metadata_dict': [_("Expecting a JSON dictionary")]})
+        apply_schema['metadata_json'] = [tk.get_validator('ignore')]
+
+    data, errors = tk.navl_validate(data_dict, apply_schema, context)
     if errors:
         session.rollback()
         raise tk.ValidationError(errors)
 
-    metadata_standard_id = data['metadata_standard_id']
-    metadata_dict = json.loads(data['metadata_json'])
-
-    metadata_json_attr_maps = session.query(ckanext_model.MetadataJSONAttrMap) \
-        .filter_by(metadata_standard_id=metadata_standard_id) \
-        .filter_by(state='active') \
-        .all()
+    if metadata_dict is None:
+        metadata_dict = json.loads(data['metadata_json'])
 
-    result = {
-        'data_dict': {},
-        'key_dict': {},
-    }
-    for metadata_json_attr_map in metadata_json_attr_maps:
-        attr = metadata_json_attr_map.record_attr
-        path = metadata_json_attr_map.json_path
-        is_key = metadata_json_attr_map.is_key
-
-        try:
-            value = jsonpointer.resolve_pointer(metadata_dict, path) or ''
-        except jsonpointer.JsonPointerException:
-            value = ''
-
-        result['data_dict'][attr] = value
-        if is_key:
-            result['key_dict'][attr] = value
-
-    return result
+    attr_map_plan = attr_map_cache.get_plan(session, data['metadata_standard_id'])
+    return attr_map_plan.apply(metadata_dict)
 
 
 @tk.side_effect_free
@@ -1305,3 +1362,65 @@ def metadata_record_index_show(context, data_dict):
     :type id: string
     """
     tk.check_access('metadata_record_index_show', context, data_dict)
+
+
+@tk.side_effect_free
+def search_agent_stats(context, data_dict):
+    """
+    Placeholder function for retrieving statistics on requests made to a search service.
+    May be implemented as required by another plugin.
+    """
+    tk.check_access('search_agent_stats', context, data_dict)
+
+
+@tk.side_effect_free
+def bulk_job_status(context, data_dict):
+    """
+    Return the progress of a bulk operation, such as a metadata collection validation or
+    workflow state transition.
+
+    :param id: the job group id returned by the bulk operation
+    :type id: string
+    :param error_limit: the maximum number of per-record error messages to return
+        (optional, default: 100)
+    :type error_limit: int
+
+    :returns: { id, action, object_id, user_id, total_count, done_count, error_count,
+        job_count, jobs_done, created, finished, records_per_second, eta_seconds, errors },
+        where errors is a list of { object_id, message, timestamp } dicts, and
+        records_per_second and eta_seconds are None until an estimate is available
+    :rtype: dictionary
+    """
+    log.debug("Retrieving bulk job status: %r", data_dict)
+
+    bulk_job_id = tk.get_or_bust(data_dict, 'id')
+    bulk_job = ckanext_model.BulkJob.get(bulk_job_id)
+    if bulk_job is None:
+        raise tk.ObjectNotFound('%s: %s' % (_('Not found'), _('Bulk Job')))
+
+    tk.check_access('bulk_job_status', context, data_dict)
+
+    try:
+        error_limit = int(data_dict.get('error_limit', 100))
+    except (TypeError, ValueError):
+        raise tk.ValidationError({'error_limit': [_('Invalid integer')]})
+
+    return model_dictize.bulk_job_dictize(bulk_job, context, error_limit)
+
+
+@tk.side_effect_free
+def revalidation_queue_status(context, data_dict):
+    """
+    Return the state of the background revalidation queue, into which metadata records
+    are placed when they are invalidated (if ``ckan.metadata.revalidation_queue`` is enabled).
+
+    :returns: { enabled, depth, claimed_count, lag_seconds, processed_count, error_count,
+        dropped_count }, where depth is the number of records waiting to be revalidated,
+        claimed_count is the number of records being revalidated by the workers, lag_seconds
+        is the time for which the longest-waiting record has been queued or claimed, and
+        dropped_count is the number of records that were dropped after repeated failures
+    :rtype: dictionary
+    """
+    log.debug("Retrieving revalidation queue status")
+    tk.check_access('revalidation_queue_status', context, data_dict)
+    return revalidation_queue.status()
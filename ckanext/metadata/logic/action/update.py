@@ -4,9 +4,8 @@ import logging
 import json
 import random
 import re
-from paste.deploy.converters import asbool, falsy
-from sqlalchemy import func
-from sqlalchemy.orm import aliased
+from paste.deploy.converters import asbool
+from sqlalchemy import func, or_
 import jsonpointer
 
 import ckan.plugins.toolkit as tk
@@ -22,6 +21,12 @@ import ckanext.metadata.model as ckanext_model
 from ckanext.metadata.logic.metadata_validator import MetadataValidator
 from ckanext.metadata.logic.workflow_validator import WorkflowValidator
 from ckanext.metadata.lib.bulk_process import bulk_action
+from ckanext.metadata.lib.bulk_validate import bulk_validate
+from ckanext.metadata.lib.bulk_invalidate import bulk_invalidate
+from ckanext.metadata.lib import validator_cache
+from ckanext.metadata.lib import record_match
+from ckanext.metadata.lib import parsed_json
+from ckanext.metadata.lib import revalidation_queue
 
 log = logging.getLogger(__name__)
 
@@ -135,6 +140,10 @@ def metadata_schema_update(context, data_dict):
 
     :param id: the id or name of the metadata schema to update
     :type id: string
+    :param revalidate: enqueue background jobs to revalidate the invalidated metadata records
+        (optional, default: ``False``); the jobs' progress may be tracked by passing the
+        ``revalidation_job_group_id`` in the output dict to ``bulk_job_status``
+    :type revalidate: boolean
     :param deserialize_json: convert JSON string fields to objects in the output dict (optional, default: ``False``)
     :type deserialize_json: boolean
 
@@ -150,6 +159,7 @@ def metadata_schema_update(context, data_dict):
     defer_commit = context.get('defer_commit', False)
     return_id_only = context.get('return_id_only', False)
     deserialize_json = asbool(data_dict.get('deserialize_json'))
+    revalidate = asbool(data_dict.get('revalidate'))
 
     metadata_schema_id = tk.get_or_bust(data_dict, 'id')
     metadata_schema = ckanext_model.MetadataSchema.get(metadata_schema_id)
@@ -182,6 +192,7 @@ def metadata_schema_update(context, data_dict):
         raise tk.ValidationError(errors)
 
     metadata_schema = model_save.metadata_schema_dict_save(data, context)
+    validator_cache.invalidate(metadata_schema_id)
     new_schema_json = metadata_schema.schema_json
     if new_schema_json:
         new_schema_json = json.loads(new_schema_json)
@@ -201,19 +212,36 @@ def metadata_schema_update(context, data_dict):
 
     invalidate_context = context.copy()
     invalidate_context.update({
-        'defer_commit': True,
-        'ignore_auth': True,
         'trigger_action': 'metadata_schema_update',
         'trigger_object_id': metadata_schema_id,
     })
-    for metadata_record_id in affected_record_ids:
-        tk.get_action('metadata_record_invalidate')(invalidate_context, {'id': metadata_record_id})
+    invalidated_record_ids = bulk_invalidate(invalidate_context, affected_record_ids)
+
+    if revalidate and invalidated_record_ids:
+        # the revalidation jobs are enqueued when the invalidation is committed; they are a
+        # consequence of this (authorized) update, so they do not repeat the auth check
+        revalidate_context = {
+            'model': model,
+            'session': session,
+            'user': user,
+            'ignore_auth': True,
+            'defer_commit': True,
+        }
+        revalidation = bulk_action('metadata_record_validate', revalidate_context,
+                                   [{'id': metadata_record_id} for metadata_record_id in invalidated_record_ids],
+                                   True, object_id=metadata_schema_id)
+    else:
+        revalidation = None
 
     if not defer_commit:
         model.repo.commit()
 
-    output = metadata_schema_id if return_id_only \
-        else tk.get_action('metadata_schema_show')(context, {'id': metadata_schema_id, 'deserialize_json': deserialize_json})
+    if return_id_only:
+        return metadata_schema_id
+
+    output = tk.get_action('metadata_schema_show')(context, {'id': metadata_schema_id, 'deserialize_json': deserialize_json})
+    if revalidation is not None:
+        output['revalidation_job_group_id'] = revalidation['job_group_id']
     return output
 
 
@@ -396,21 +424,13 @@ def metadata_record_update(context, data_dict):
 
     # check that the DOI, if supplied, does not belong to another record
     if doi:
-        existing_doi_rec = session.query(model.Package). \
-            join(model.PackageExtra, model.Package.id == model.PackageExtra.package_id). \
-            filter(model.PackageExtra.key == 'doi'). \
-            filter(func.lower(model.PackageExtra.value) == doi.lower()). \
-            first()
+        existing_doi_rec = record_match.find_metadata_record(context, 'doi', doi)
         if existing_doi_rec and existing_doi_rec.id != metadata_record_id:
             raise tk.ValidationError({"doi": ["The DOI is associated with another metadata record"]})
 
     # check that the SID, if supplied, does not belong to another record
     if sid:
-        existing_sid_rec = session.query(model.Package). \
-            join(model.PackageExtra, model.Package.id == model.PackageExtra.package_id). \
-            filter(model.PackageExtra.key == 'sid'). \
-            filter(func.lower(model.PackageExtra.value) == sid.lower()). \
-            first()
+        existing_sid_rec = record_match.find_metadata_record(context, 'sid', sid)
         if existing_sid_rec and existing_sid_rec.id != metadata_record_id:
             raise tk.ValidationError({"sid": ["The SID is associated with another metadata record"]})
 
@@ -420,7 +440,8 @@ def metadata_record_update(context, data_dict):
         raise tk.ValidationError({"doi": ["A metadata record's DOI, once set, cannot be changed or removed"]})
 
     # check for discrepancy between parameterized DOI and metadata DOI
-    metadata_dict = json.loads(data_dict['metadata_json'])
+    # the metadata JSON has already been parsed during schema validation
+    metadata_dict = parsed_json.loads(internal_context, data_dict['metadata_json'])
     try:
         metadata_doi = metadata_dict['doi']
         if not isinstance(metadata_doi, basestring) or metadata_doi.lower() != doi.lower():
@@ -430,13 +451,13 @@ def metadata_record_update(context, data_dict):
 
     # inject DOI into the metadata
     if doi:
-        metadata_dict['doi'] = doi
-        data_dict['metadata_json'] = json.dumps(metadata_dict, ensure_ascii=False)
+        metadata_dict = dict(metadata_dict, doi=doi)
+        data_dict['metadata_json'] = parsed_json.dumps(internal_context, metadata_dict)
 
     # map values from the metadata JSON into the data_dict
     attr_map = tk.get_action('metadata_json_attr_map_apply')(internal_context, {
         'metadata_standard_id': data_dict.get('metadata_standard_id'),
-        'metadata_json': data_dict.get('metadata_json'),
+        'metadata_dict': metadata_dict,
     })
     data_dict.update(attr_map['data_dict'])
 
@@ -462,11 +483,12 @@ def metadata_record_update(context, data_dict):
     if asbool(metadata_record.extras['validated']):
         old_metadata_json = metadata_record.extras['metadata_json']
         if old_metadata_json:
-            old_metadata_json = json.loads(old_metadata_json)
+            old_metadata_json = parsed_json.loads(internal_context, old_metadata_json)
         old_validation_schemas = set(tk.get_action('metadata_record_validation_schema_list')(internal_context, {'id': metadata_record_id}))
 
     tk.get_action('package_update')(internal_context, data_dict)
     model_save.metadata_record_collection_membership_save(data_dict['metadata_collection_id'], internal_context)
+    model_save.metadata_record_attrs_save(internal_context['package'], internal_context)
 
     # check if we need to invalidate the record
     if asbool(metadata_record.extras['validated']):
@@ -475,7 +497,7 @@ def metadata_record_update(context, data_dict):
 
         new_metadata_json = metadata_record.extras['metadata_json']
         if new_metadata_json:
-            new_metadata_json = json.loads(new_metadata_json)
+            new_metadata_json = parsed_json.loads(internal_context, new_metadata_json)
         new_validation_schemas = set(tk.get_action('metadata_record_validation_schema_list')(internal_context, {'id': metadata_record_id}))
 
         # if either the metadata record content or the set of validation schemas for the record has changed,
@@ -490,12 +512,14 @@ def metadata_record_update(context, data_dict):
             })
             tk.get_action('metadata_record_invalidate')(invalidate_context, {'id': metadata_record_id})
 
+    if not metadata_record.private:
+        index_context = internal_context.copy()
+        index_context['defer_commit'] = True
+        tk.get_action('metadata_record_index_update')(index_context, {'id': metadata_record_id})
+
     if not defer_commit:
         model.repo.commit()
 
-    if not metadata_record.private:
-        tk.get_action('metadata_record_index_update')(internal_context, {'id': metadata_record_id})
-
     output = metadata_record_id if return_id_only \
         else tk.get_action('metadata_record_show')(internal_context, {'id': metadata_record_id, 'deserialize_json': deserialize_json})
     return output
@@ -542,6 +566,7 @@ def metadata_record_invalidate(context, data_dict):
 
     metadata_record.extras['validated'] = False
     metadata_record.extras['errors'] = '{}'
+    model_save.metadata_record_attrs_save(metadata_record, context)
 
     trigger_action = context.get('trigger_action')
     trigger_object_id = context.get('trigger_object_id')
@@ -577,6 +602,7 @@ def metadata_record_invalidate(context, data_dict):
         rev.message = _(u'REST API: Invalidate metadata record %s') % metadata_record_id
 
     activity_dict = tk.get_action('activity_create')(activity_context, activity_dict)
+    revalidation_queue.schedule(context['session'], [metadata_record_id])
 
     if not defer_commit:
         model.repo.commit()
@@ -632,7 +658,8 @@ def metadata_record_validate(context, data_dict):
 
     validation_results = []
     accumulated_errors = {}
-    metadata_dict = json.loads(metadata_record.extras['metadata_json'])
+    # validation does not modify the document, so the shared parsed form can be used
+    metadata_dict = parsed_json.loads(context, metadata_record.extras['metadata_json'])
 
     for metadata_schema in validation_schemas:
         validate_context = context.copy()
@@ -640,8 +667,9 @@ def metadata_record_validate(context, data_dict):
             'allow_side_effects': True,
             'ignore_auth': True,
         })
-        schema_dict = json.loads(metadata_schema['schema_json'])
-        json_validator = MetadataValidator(schema_dict, metadata_record_id, validate_context)
+        json_validator = validator_cache.get_validator(
+            MetadataValidator, metadata_schema['id'], metadata_schema['schema_json']
+        ).bind(metadata_record_id, validate_context)
 
         # validate the metadata
         validation_errors = json_validator.validate(metadata_dict)
@@ -650,7 +678,7 @@ def metadata_record_validate(context, data_dict):
         # regardless of whether or not validation passed
         if metadata_dict != json_validator.jsonschema_validator.root_instance:
             metadata_dict = json_validator.jsonschema_validator.root_instance.copy()
-            metadata_record.extras['metadata_json'] = json.dumps(metadata_dict, ensure_ascii=False)
+            metadata_record.extras['metadata_json'] = parsed_json.dumps(context, metadata_dict)
 
         validation_result = {
             'metadata_schema_id': metadata_schema['id'],
@@ -661,6 +689,7 @@ def metadata_record_validate(context, data_dict):
 
     metadata_record.extras['validated'] = True
     metadata_record.extras['errors'] = json.dumps(accumulated_errors, ensure_ascii=False)
+    model_save.metadata_record_attrs_save(metadata_record, context)
 
     activity_context = context.copy()
     activity_context.update({
@@ -740,6 +769,7 @@ def metadata_record_workflow_state_override(context, data_dict):
     update_search_index = metadata_record.private != workflow_state.metadata_records_private
     metadata_record.private = workflow_state.metadata_records_private
     metadata_record.extras['workflow_state_id'] = workflow_state_id
+    model_save.metadata_record_attrs_save(metadata_record, context)
 
     activity_context = context.copy()
     activity_context.update({
@@ -772,15 +802,16 @@ def metadata_record_workflow_state_override(context, data_dict):
 
     activity_dict = tk.get_action('activity_create')(activity_context, activity_dict)
 
-    if not defer_commit:
-        model.repo.commit()
-
     if update_search_index:
         index_context = context.copy()
         index_context['metadata_record'] = metadata_record
         index_context['ignore_auth'] = True
+        index_context['defer_commit'] = True
         tk.get_action('metadata_record_index_update')(index_context, {'id': metadata_record_id})
 
+    if not defer_commit:
+        model.repo.commit()
+
     return activity_dict
 
 
@@ -840,13 +871,13 @@ def workflow_state_update(context, data_dict):
         raise tk.ValidationError(errors)
 
     workflow_state = model_save.workflow_state_dict_save(data, context)
+    validator_cache.invalidate(workflow_state_id)
 
     if workflow_state.metadata_records_private != old_metadata_records_private:
         # cascade change in 'metadata_records_private' status to metadata records that are in this workflow state
         metadata_records = session.query(model.Package) \
-            .join(model.PackageExtra, model.Package.id == model.PackageExtra.package_id) \
-            .filter(model.PackageExtra.key == 'workflow_state_id') \
-            .filter(model.PackageExtra.value == workflow_state_id) \
+            .join(ckanext_model.MetadataRecordAttrs, model.Package.id == ckanext_model.MetadataRecordAttrs.package_id) \
+            .filter(ckanext_model.MetadataRecordAttrs.workflow_state_id == workflow_state_id) \
             .filter(model.Package.type == 'metadata_record') \
             .filter(model.Package.state != 'deleted') \
             .all()
@@ -863,15 +894,16 @@ def workflow_state_update(context, data_dict):
     else:
         rev.message = _(u'REST API: Update workflow state %s') % workflow_state_id
 
-    if not defer_commit:
-        model.repo.commit()
-
     for metadata_record in metadata_records:
         index_context = context.copy()
         index_context['metadata_record'] = metadata_record
         index_context['ignore_auth'] = True
+        index_context['defer_commit'] = True
         tk.get_action('metadata_record_index_update')(index_context, {'id': metadata_record.id})
 
+    if not defer_commit:
+        model.repo.commit()
+
     output = workflow_state_id if return_id_only \
         else tk.get_action('workflow_state_show')(context, {'id': workflow_state_id, 'deserialize_json': deserialize_json})
     return output
@@ -1059,8 +1091,8 @@ def metadata_record_workflow_state_transition(context, data_dict):
         'ignore_auth': True,
     })
 
-    current_workflow_state_id = session.query(model.PackageExtra.value) \
-        .filter_by(package_id=metadata_record_id, key='workflow_state_id').scalar()
+    current_workflow_state_id = session.query(ckanext_model.MetadataRecordAttrs.workflow_state_id) \
+        .filter_by(package_id=metadata_record_id).scalar()
 
     # already on target state - return the last workflow result
     if current_workflow_state_id == target_workflow_state_id:
@@ -1083,14 +1115,16 @@ def metadata_record_workflow_state_transition(context, data_dict):
     validate_context['allow_side_effects'] = True
 
     # test whether the augmented metadata record passes the rules for the target state
-    workflow_rules_dict = json.loads(target_workflow_state.workflow_rules_json)
-    json_validator = WorkflowValidator(workflow_rules_dict, metadata_record_id, validate_context)
+    json_validator = validator_cache.get_validator(
+        WorkflowValidator, target_workflow_state_id, target_workflow_state.workflow_rules_json
+    ).bind(metadata_record_id, validate_context)
     workflow_errors = json_validator.validate(metadata_record_dict)
 
     if not workflow_errors:
         update_search_index = metadata_record.private != target_workflow_state.metadata_records_private
         metadata_record.private = target_workflow_state.metadata_records_private
         metadata_record.extras['workflow_state_id'] = target_workflow_state_id
+        model_save.metadata_record_attrs_save(metadata_record, context)
     else:
         update_search_index = False
 
@@ -1127,15 +1161,16 @@ def metadata_record_workflow_state_transition(context, data_dict):
 
     activity_dict = tk.get_action('activity_create')(activity_context, activity_dict)
 
-    if not defer_commit:
-        model.repo.commit()
-
     if update_search_index:
         index_context = context.copy()
         index_context['metadata_record'] = metadata_record
         index_context['ignore_auth'] = True
+        index_context['defer_commit'] = True
         tk.get_action('metadata_record_index_update')(index_context, {'id': metadata_record_id})
 
+    if not defer_commit:
+        model.repo.commit()
+
     return activity_dict
 
 
@@ -1168,8 +1203,8 @@ def metadata_record_workflow_state_revert(context, data_dict):
     else:
         raise tk.ObjectNotFound('%s: %s' % (_('Not found'), _('Metadata Record')))
 
-    current_workflow_state_id = session.query(model.PackageExtra.value) \
-        .filter_by(package_id=metadata_record_id, key='workflow_state_id').scalar()
+    current_workflow_state_id = session.query(ckanext_model.MetadataRecordAttrs.workflow_state_id) \
+        .filter_by(package_id=metadata_record_id).scalar()
 
     # already on null state
     if not current_workflow_state_id:
@@ -1186,6 +1221,7 @@ def metadata_record_workflow_state_revert(context, data_dict):
     update_search_index = metadata_record.private != metadata_record_private
     metadata_record.private = metadata_record_private
     metadata_record.extras['workflow_state_id'] = target_workflow_state_id
+    model_save.metadata_record_attrs_save(metadata_record, context)
 
     activity_context = context.copy()
     activity_context.update({
@@ -1218,15 +1254,16 @@ def metadata_record_workflow_state_revert(context, data_dict):
 
     activity_dict = tk.get_action('activity_create')(activity_context, activity_dict)
 
-    if not defer_commit:
-        model.repo.commit()
-
     if update_search_index:
         index_context = context.copy()
         index_context['metadata_record'] = metadata_record
         index_context['ignore_auth'] = True
+        index_context['defer_commit'] = True
         tk.get_action('metadata_record_index_update')(index_context, {'id': metadata_record_id})
 
+    if not defer_commit:
+        model.repo.commit()
+
     return activity_dict
 
 
@@ -1319,8 +1356,18 @@ def metadata_collection_validate(context, data_dict):
     :type id: string
     :param async: validate the records asynchronously (optional, default: ``False``)
     :type async: boolean
-
-    :returns: { total_count, error_count }
+    :param mode: ``serial`` to validate the records one at a time, or ``parallel`` to validate
+        them in chunks, sharing the validation schemas across the records in each chunk
+        (optional, default: ``serial``). Records are validated in parallel only if async, in
+        which case a single background job validates them using a pool of worker processes
+        (see ``ckan.metadata.bulk_validate_processes``). If not async, parallel mode is only
+        chunked: the records are validated one at a time within the calling process, since
+        a worker pool is never forked from a web worker.
+    :type mode: string
+
+    :returns: { total_count, error_count, job_group_id }, where job_group_id may be passed to
+        ``bulk_job_status``; if async, the result also includes job_count; in parallel mode, if
+        not async, it also includes elapsed_seconds, records_per_second, schema_timings and failures
     :rtype: dict
     """
     log.info("Validating metadata collection: %r", data_dict)
@@ -1329,6 +1376,9 @@ def metadata_collection_validate(context, data_dict):
     model = context['model']
     session = context['session']
     async = data_dict.get('async', False)
+    mode = data_dict.get('mode', 'serial')
+    if mode not in ('serial', 'parallel'):
+        raise tk.ValidationError({'mode': [_('Must be one of: serial, parallel')]})
 
     metadata_collection_id = tk.get_or_bust(data_dict, 'id')
     metadata_collection = model.Group.get(metadata_collection_id)
@@ -1337,21 +1387,21 @@ def metadata_collection_validate(context, data_dict):
     else:
         raise tk.ObjectNotFound('%s: %s' % (_('Not found'), _('Metadata Collection')))
 
-    collection_extra = aliased(model.PackageExtra)
-    validated_extra = aliased(model.PackageExtra)
-
+    attrs = ckanext_model.MetadataRecordAttrs
     record_ids = session.query(model.Package.id) \
-        .join(collection_extra) \
-        .join(validated_extra) \
+        .join(attrs, model.Package.id == attrs.package_id) \
         .filter(model.Package.type == 'metadata_record') \
         .filter(model.Package.state == 'active') \
-        .filter(collection_extra.key == 'metadata_collection_id') \
-        .filter(collection_extra.value == metadata_collection_id) \
-        .filter(validated_extra.key == 'validated') \
-        .filter(validated_extra.value.in_(falsy)) \
+        .filter(attrs.metadata_collection_id == metadata_collection_id) \
+        .filter(attrs.validated == False) \
         .all()
+
+    if mode == 'parallel':
+        return bulk_validate(context, [record_id for (record_id,) in record_ids], async,
+                             object_id=metadata_collection_id)
+
     data_dicts = [{'id': record_id} for (record_id,) in record_ids]
-    return bulk_action('metadata_record_validate', context, data_dicts, async)
+    return bulk_action('metadata_record_validate', context, data_dicts, async, object_id=metadata_collection_id)
 
 
 def metadata_collection_workflow_state_transition(context, data_dict):
@@ -1365,7 +1415,8 @@ def metadata_collection_workflow_state_transition(context, data_dict):
     :param async: transition the records asynchronously (optional, default: ``False``)
     :type async: boolean
 
-    :returns: { total_count, error_count }
+    :returns: { total_count, error_count, job_group_id }, where job_group_id may be passed to
+        ``bulk_job_status``; if async, the result also includes job_count
     :rtype: dict
     """
     log.info("Transitioning workflow state of metadata records in collection: %r", data_dict)
@@ -1389,22 +1440,17 @@ def metadata_collection_workflow_state_transition(context, data_dict):
     else:
         raise tk.ObjectNotFound('%s: %s' % (_('Not found'), _('Workflow State')))
 
-    collection_extra = aliased(model.PackageExtra)
-    workflow_state_extra = aliased(model.PackageExtra)
-
+    attrs = ckanext_model.MetadataRecordAttrs
     record_ids = session.query(model.Package.id) \
-        .join(collection_extra) \
-        .join(workflow_state_extra) \
+        .join(attrs, model.Package.id == attrs.package_id) \
         .filter(model.Package.type == 'metadata_record') \
         .filter(model.Package.state == 'active') \
-        .filter(collection_extra.key == 'metadata_collection_id') \
-        .filter(collection_extra.value == metadata_collection_id) \
-        .filter(workflow_state_extra.key == 'workflow_state_id') \
-        .filter(workflow_state_extra.value != target_workflow_state_id) \
+        .filter(attrs.metadata_collection_id == metadata_collection_id) \
+        .filter(or_(attrs.workflow_state_id == None, attrs.workflow_state_id != target_workflow_state_id)) \
         .all()
     data_dicts = [{'id': record_id, 'workflow_state_id': target_workflow_state_id}
                   for (record_id,) in record_ids]
-    return bulk_action('metadata_record_workflow_state_transition', context, data_dicts, async)
+    return bulk_action('metadata_record_workflow_state_transition', context, data_dicts, async, object_id=metadata_collection_id)
 
 
 def metadata_record_assign_doi(context, data_dict):
@@ -1459,13 +1505,14 @@ def metadata_record_assign_doi(context, data_dict):
             unique_number='{:.10f}'.format(random.SystemRandom().random())[2:],
         )
         # collisions are extremely unlikely, but we check anyway
-        collision = session.query(model.PackageExtra) \
-            .filter_by(key='doi', value=doi) \
+        collision = session.query(ckanext_model.MetadataRecordAttrs) \
+            .filter(func.lower(ckanext_model.MetadataRecordAttrs.doi) == doi.lower()) \
             .first()
         if not collision:
             break
 
     metadata_record.extras['doi'] = doi
+    model_save.metadata_record_attrs_save(metadata_record, context)
 
     # if there is a JSON attribute mapping for the 'doi' field, then we try to put the new DOI into the metadata JSON
     doi_json_path = session.query(ckanext_model.MetadataJSONAttrMap.json_path) \
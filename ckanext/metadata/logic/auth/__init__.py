@@ -1,10 +1,8 @@
 # encoding: utf-8
 
-import json
-
 from ckan.common import _, config
 from ckan.logic import auth
-from ckan.lib.redis import connect_to_redis
+from ckanext.metadata.lib import privilege_cache
 
 
 def check_privs(
@@ -26,6 +24,10 @@ def check_privs(
     dependent on ckanext-accesscontrol. At this point, however, it's the simplest means of
     implementing role based access control.
 
+    The user's privileges are cached in the context, so that repeated checks for the same
+    request - e.g. per record in a bulk operation - cost a dict lookup; see
+    :py:func:`ckanext.metadata.lib.privilege_cache.get_privileges`.
+
     Roles are cumulative, i.e. a given role can do everything that any lower role can do.
     admin > curator > harvester > contributor > member
 
@@ -42,40 +44,21 @@ def check_privs(
     harvester_role = config.get('ckan.metadata.harvester_role')
     contributor_role = config.get('ckan.metadata.contributor_role')
 
-    model = context['model']
-    user = context['user']
-    user_id = model.User.by_name(user.decode('utf8')).id
-
-    redis = connect_to_redis()
-    key = 'oidc_token_data:' + user_id
-    token_json = redis.get(key)
-    if not token_json:
+    privileges = privilege_cache.get_privileges(context)
+    if privileges is None:
         return False
-    token_data = json.loads(token_json)
 
-    if token_data['superuser']:
+    if privileges.superuser:
         return True
 
-    is_admin = False
-    is_curator = False
-    is_harvester = False
-    is_contributor = False
-    is_member = False
-
     if require_organization:
-        require_organization = model.Group.get(require_organization).name
-
-    for privilege in token_data['privileges']:
-        if privilege['institution'] == admin_org and privilege['role'] == admin_role:
-            is_admin = True
-        if privilege['institution'] in (admin_org, require_organization) and privilege['role'] == curator_role:
-            is_curator = True
-        if privilege['institution'] == require_organization and privilege['role'] == harvester_role:
-            is_harvester = True
-        if privilege['institution'] == require_organization and privilege['role'] == contributor_role:
-            is_contributor = True
-        if privilege['institution'] == require_organization:
-            is_member = True
+        require_organization = privilege_cache.get_organization_name(context, require_organization)
+
+    is_admin = privileges.has_role(admin_org, admin_role)
+    is_curator = privileges.has_role(admin_org, curator_role) or privileges.has_role(require_organization, curator_role)
+    is_harvester = privileges.has_role(require_organization, harvester_role)
+    is_contributor = privileges.has_role(require_organization, contributor_role)
+    is_member = privileges.is_member(require_organization)
 
     if require_admin:
         return is_admin
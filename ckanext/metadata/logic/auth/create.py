@@ -85,6 +85,15 @@ def metadata_record_create(context, data_dict):
     return {'success': check_privs(context, require_contributor=True, require_organization=(data_dict or {}).get('owner_org'))}
 
 
+def metadata_record_bulk_upsert(context, data_dict):
+    # each record is also authorized individually, as a metadata_record_create
+    records = (data_dict or {}).get('records')
+    organization_ids = set(record.get('owner_org') for record in records if isinstance(record, dict)) \
+        if isinstance(records, list) else set()
+    return {'success': all(check_privs(context, require_contributor=True, require_organization=organization_id)
+                           for organization_id in organization_ids or [None])}
+
+
 def metadata_record_workflow_annotation_create(context, data_dict):
     organization_id = context['model'].Package.get(data_dict['id']).owner_org if 'id' in (data_dict or {}) else None
     return {'success': check_privs(context, require_contributor=True, require_organization=organization_id)}
@@ -131,3 +131,15 @@ def metadata_standard_index_show(context, data_dict):
 
 def metadata_record_index_show(context, data_dict):
     return {'success': True}
+
+
+def search_agent_stats(context, data_dict):
+    return {'success': True}
+
+
+def bulk_job_status(context, data_dict):
+    return {'success': True}
+
+
+def revalidation_queue_status(context, data_dict):
+    return {'success': True}
@@ -1,12 +1,13 @@
 # encoding: utf-8
 
 import logging
+import copy
 import jsonschema
 import jsonschema.validators
 import re
 import ast
 from jsonpointer import resolve_pointer, JsonPointerException
-from collections import deque, OrderedDict
+from collections import OrderedDict
 
 import ckan.plugins.toolkit as tk
 
@@ -21,6 +22,54 @@ def add_post_validation_task(self, action_func, data_dict, error_path):
     }]
 
 
+_EMPTY_TYPES = (str, unicode, list, dict, type(None))
+
+
+def clear_empties(node):
+    """
+    Return a copy of a JSON tree with empty strings, lists and dicts, and nulls, removed -
+    including any lists and dicts that are emptied as a result. The tree is copied in a
+    single pass; the input is not modified.
+
+    Every dict and list in the result is a new object, so the result may be freely modified.
+    Scalars are shared with the input.
+    """
+    node_type = type(node)
+    if node_type is dict:
+        result = {}
+        for key, value in node.iteritems():
+            value = clear_empties(value)
+            if value or type(value) not in _EMPTY_TYPES:
+                result[key] = value
+        return result
+    if node_type is list:
+        result = []
+        for element in node:
+            element = clear_empties(element)
+            if element or type(element) not in _EMPTY_TYPES:
+                result.append(element)
+        return result
+    return node
+
+
+def extend_jsonschema_validators(cls):
+    """
+    Class decorator for JSONValidator and its subclasses. Builds - once, at import time - a
+    dedicated jsonschema validator class for each supported JSON Schema draft, extended with
+    the keywords and converters defined by the decorated class. The jsonschema library's own
+    draft validator classes are never modified.
+    """
+    cls._jsonschema_validator_classes = {}
+    for draft_validator_cls in set(jsonschema.validators.meta_schemas.values()):
+        extended_cls = jsonschema.validators.extend(draft_validator_cls, cls._validators())
+        extended_cls.__name__ = cls.__name__ + draft_validator_cls.__name__
+        extended_cls.add_post_validation_task = add_post_validation_task
+        extended_cls.converters = cls._converters()
+        cls._jsonschema_validator_classes[draft_validator_cls] = extended_cls
+    return cls
+
+
+@extend_jsonschema_validators
 class JSONValidator(object):
     """
     Encapsulates the JSON Schema validation capabilities supported by the jsonschema library.
@@ -36,11 +85,8 @@ class JSONValidator(object):
         :param context: caller's context (optional)
         :type context: dict
         """
-        jsonschema_validator_cls = jsonschema.validators.validator_for(schema)
-        jsonschema_validator_cls.check_schema(schema)
-        jsonschema_validator_cls.VALIDATORS.update(self._validators())
-        jsonschema_validator_cls.add_post_validation_task = add_post_validation_task
-        jsonschema_validator_cls.converters = self._converters()
+        draft_validator_cls = jsonschema.validators.validator_for(schema)
+        draft_validator_cls.check_schema(schema)
 
         formats = self._formats()
         if 'uri' in formats:
@@ -54,12 +100,36 @@ class JSONValidator(object):
             sorted_schema[keyword] = None
         sorted_schema.update(schema)
 
-        self.jsonschema_validator = jsonschema_validator_cls(
-            sorted_schema, format_checker=jsonschema.FormatChecker(formats))
+        self.jsonschema_validator_cls = self._jsonschema_validator_classes[draft_validator_cls]
+        self.schema = sorted_schema
+        self.format_checker = jsonschema.FormatChecker(formats)
+        self._bind(object_id, context)
 
+    def bind(self, object_id=None, context=None):
+        """
+        Return a copy of this validator for validating the given object. The checked schema
+        and the format checker are shared with the copy, so this is cheap compared with
+        constructing a new validator.
+        :param object_id: the id of the object that the copy relates to (optional)
+        :type object_id: string
+        :param context: caller's context (optional)
+        :type context: dict
+        :return: JSONValidator
+        """
+        validator = copy.copy(self)
+        validator._bind(object_id, context)
+        return validator
+
+    def _bind(self, object_id, context):
+        """
+        Create the underlying jsonschema validator, holding the per-call state.
+        """
+        self.jsonschema_validator = self.jsonschema_validator_cls(
+            self.schema, format_checker=self.format_checker)
         self.jsonschema_validator.object_id = object_id
         self.jsonschema_validator.context = context or {}
         self.jsonschema_validator.tasks = []
+        self.jsonschema_validator.memo = self.jsonschema_validator.context.get('validation_memo', {})
 
     @classmethod
     def _validators(cls):
@@ -93,6 +163,14 @@ class JSONValidator(object):
         """
         return {}
 
+    def _prepare(self, instance):
+        """
+        Hook for doing any work up front - e.g. fetching external resources concurrently -
+        before the (cleaned) instance is validated.
+        :param instance: metadata dict
+        """
+        pass
+
     @classmethod
     def check_schema(cls, schema):
         """
@@ -104,135 +182,41 @@ class JSONValidator(object):
 
     def validate(self, instance):
         """
-        Validate a JSON metadata instance.
+        Validate a JSON metadata instance. The instance is not modified; the cleaned (and
+        possibly augmented) copy that was validated is left in ``jsonschema_validator.root_instance``.
         :param instance: metadata dict
         :return: error dict
         """
-
-        def clear_empties(node):
-            """
-            Recursively remove empty strings, lists and dicts from the instance tree.
-            """
-            if type(node) is dict:
-                # iterate over a *copy* of the dict's keys, as we are deleting keys during iteration
-                for element in node.keys():
-                    clear_empties(node[element])
-                    if type(node[element]) in (str, unicode, list, dict, type(None)) and not node[element]:
-                        del node[element]
-            elif type(node) is list:
-                # iterate over a *copy* of the list, as we are deleting elements during iteration
-                for element in list(node):
-                    clear_empties(element)
-                    if type(element) in (str, unicode, list, dict, type(None)) and not element:
-                        node.remove(element)
-
-        def add_error(node, path, message):
-            """
-            Add an error message to the error tree.
-            """
-            index = str(path.popleft()) if path else '__root'
-
-            if index not in node:
-                node[index] = [] if not path else {}
-
-            if path:
-                add_error(node[index], path, message)
-            elif type(node[index]) is dict:
-                # we'll arrive here if we previously added an error at a leaf node and subsequently
-                # want to add an error at a parent/ancestor of that leaf; we must add a "dummy" key
-                # for the error message list
-                add_error(node[index], deque(('_',)), message)
-            else:
-                node[index] += [message]
-
-        # operate on a copy of the incoming data
-        instance = instance.copy()
-        clear_empties(instance)
+        # operate on a cleaned copy of the incoming data; the copy may be modified by
+        # "mapTo" and similar keywords
+        instance = clear_empties(instance)
         self.jsonschema_validator.root_instance = instance
+        self._prepare(instance)
 
         errors = {}
+        required_keys = {}
         for error in self.jsonschema_validator.iter_errors(instance):
-            if error.schema_path[-1] == 'required':
-                # put required errors under the required keys themselves
-                match = re.match(r'(?P<key>.+) is a required property', error.message)
-                assert match is not None, "Unexpected message for 'required' property"
-                required_key = ast.literal_eval(match.group('key'))
-                error.path.append(required_key)
-
-            elif error.schema_path[-1] == 'not' and error.validator_value == {}:
-                error.message = 'This key may not be present in the dictionary'
-
-            elif error.schema_path[-1] == 'minItems':
-                error.path.append('__minItems')
-                error.message = 'Array has too few items'
-
-            elif error.schema_path[-1] == 'uniqueItems':
-                error.path.append('__uniqueItems')
-                error.message = 'Array has non-unique items'
-
-            elif error.schema_path[-1] == 'uniqueObjects':
-                error.path.append('__uniqueObjects')
-                error.message = 'Array has non-unique objects'
-
-            elif error.schema_path[-1] == 'uniqueProperties':
-                error.path.append('__uniqueProperties')
-                error.message = 'Object has non-unique properties'
-
-            elif error.schema_path[-1] == 'contains':
-                error.path.append('__contains')
-                error.message = 'Array does not contain a required item'
-
-            elif error.schema_path[-1] == 'task':
-                error.path.append('__task')
-
-            elif error.schema_path[-1] == 'itemCardinality':
-                error.path.append('__itemCardinality')
-
-            elif error.schema_path[-1] == 'maxProperties':
-                error.path.append('__maxProperties')
-                if error.schema.get('maxProperties') == 0:
-                    error.message = 'Object must be empty'
-                else:
-                    error.message = 'Object has too many properties'
-
-            elif error.schema_path[-1] == 'additionalProperties':
-                error.path.append('__additionalProperties')
-
-            elif error.schema_path[-1] == 'urlTest':
-                error.message = 'URL test failed'
-
-            elif error.schema_path[-1] == 'oneOf':
-                error.path.append('__oneOf')
-                error.message = 'Instance is not valid under exactly one of the given schemas'
-                # hacky way to see if we've used "oneOf" and "if-then-else" to make a switch statement
-                is_switch = False
-                err_i = -1
-                for i, err in enumerate(error.context):
-                    if str(err).startswith('False schema does not allow '):
-                        # this option failed its "if" condition and aborted at the "else": false
-                        is_switch = True
-                    else:
-                        # this option matched its "if" condition but threw a validation error
-                        err_i = i
-                        break
-                if is_switch and err_i >= 0:
-                    error.path.append(err_i)
-                    error.message = str(err)
-
-            elif error.schema_path[-1] == 'anyOf':
-                error.path.append('__anyOf')
-                error.message = 'Instance is not valid under any of the given schemas'
-
-            add_error(errors, error.path, error.message)
+            keyword = error.schema_path[-1] if error.schema_path else None
+            if keyword == 'required':
+                error.path.append(_required_key(error, required_keys))
+            elif keyword in _ERROR_REWRITE_FUNCS:
+                _ERROR_REWRITE_FUNCS[keyword](error)
+            elif keyword in _ERROR_REWRITES:
+                path_suffix, message = _ERROR_REWRITES[keyword]
+                if path_suffix is not None:
+                    error.path.append(path_suffix)
+                if message is not None:
+                    error.message = message
+
+            _add_error(errors, error.path, error.message)
 
         for task in self.jsonschema_validator.tasks:
-            error_path = deque(task['error_path'].split('/'))
-            error_path.popleft()  # remove the leading empty string
-            error_path.append('__task')
+            # remove the leading empty string
+            error_path = task['error_path'].split('/')[1:] + ['__task']
             try:
                 # if error_path resolves to a location in the errors dict, we don't want to process the task
                 resolve_pointer(errors, task['error_path'])
-                add_error(errors, error_path, 'Task not executed due to other errors in the instance')
+                _add_error(errors, error_path, 'Task not executed due to other errors in the instance')
                 continue
             except JsonPointerException:
                 # error_path does not resolve, therefore we have no error and can process the task
@@ -244,8 +228,112 @@ class JSONValidator(object):
                 task['action_func'](context, task['data_dict'])
             except tk.ValidationError, e:
                 message = e.error_dict.get('message') or e.error_dict
-                add_error(errors, error_path, message)
+                _add_error(errors, error_path, message)
             except Exception, e:
-                add_error(errors, error_path, e.message)
+                _add_error(errors, error_path, e.message)
 
         return errors
+
+
+def _add_error(errors, path, message):
+    """
+    Add an error message to the error tree, at the given path (an iterable of keys/indices);
+    an empty path puts the error under '__root'.
+    """
+    keys = [str(key) for key in path] or ['__root']
+    node = errors
+    for key in keys[:-1]:
+        child = node.get(key)
+        if child is None:
+            child = node[key] = {}
+        elif type(child) is list:
+            # we previously added an error at this (leaf) node, and now want to add an error at
+            # a descendant; the existing messages move to a "dummy" key
+            child = node[key] = {'_': child}
+        node = child
+
+    leaf = node.get(keys[-1])
+    if leaf is None:
+        node[keys[-1]] = [message]
+    elif type(leaf) is dict:
+        # we previously added an error at a descendant of this node; we must add a "dummy" key
+        # for the error message list
+        leaf.setdefault('_', []).append(message)
+    else:
+        leaf.append(message)
+
+
+def _required_key(error, required_keys):
+    """
+    Find the missing key that a "required" error relates to, so that the error can be put
+    under the required key itself. jsonschema yields one error per missing key, with the
+    message "<key repr> is a required property"; rather than parsing the message, we match
+    it against the keys that are missing from the instance.
+
+    :param required_keys: per-validation cache of {(instance id, required list id): {message: key}}
+    """
+    if isinstance(error.validator_value, list) and isinstance(error.instance, dict):
+        cache_key = (id(error.instance), id(error.validator_value))
+        if cache_key not in required_keys:
+            required_keys[cache_key] = {'%r is a required property' % key: key
+                                        for key in error.validator_value if key not in error.instance}
+        key = required_keys[cache_key].get(error.message)
+        if key is not None:
+            return key
+
+    # e.g. draft 3, where "required" is a boolean property of the subschema
+    match = re.match(r'(?P<key>.+) is a required property', error.message)
+    assert match is not None, "Unexpected message for 'required' property"
+    return ast.literal_eval(match.group('key'))
+
+
+def _rewrite_not_error(error):
+    if error.validator_value == {}:
+        error.message = 'This key may not be present in the dictionary'
+
+
+def _rewrite_max_properties_error(error):
+    error.path.append('__maxProperties')
+    if error.schema.get('maxProperties') == 0:
+        error.message = 'Object must be empty'
+    else:
+        error.message = 'Object has too many properties'
+
+
+def _rewrite_one_of_error(error):
+    error.path.append('__oneOf')
+    error.message = 'Instance is not valid under exactly one of the given schemas'
+    # hacky way to see if we've used "oneOf" and "if-then-else" to make a switch statement
+    is_switch = False
+    for i, err in enumerate(error.context):
+        if err.schema is False:
+            # this option failed its "if" condition and aborted at the "else": false
+            is_switch = True
+        else:
+            # this option matched its "if" condition but threw a validation error
+            if is_switch:
+                error.path.append(i)
+                error.message = str(err)
+            break
+
+
+# keyword: (path suffix, replacement message); None means leave as is
+_ERROR_REWRITES = {
+    'minItems': ('__minItems', 'Array has too few items'),
+    'uniqueItems': ('__uniqueItems', 'Array has non-unique items'),
+    'uniqueObjects': ('__uniqueObjects', 'Array has non-unique objects'),
+    'uniqueProperties': ('__uniqueProperties', 'Object has non-unique properties'),
+    'contains': ('__contains', 'Array does not contain a required item'),
+    'task': ('__task', None),
+    'itemCardinality': ('__itemCardinality', None),
+    'additionalProperties': ('__additionalProperties', None),
+    'urlTest': (None, 'URL test failed'),
+    'anyOf': ('__anyOf', 'Instance is not valid under any of the given schemas'),
+}
+
+# keyword: function(error) for rewrites that depend on the error details
+_ERROR_REWRITE_FUNCS = {
+    'not': _rewrite_not_error,
+    'maxProperties': _rewrite_max_properties_error,
+    'oneOf': _rewrite_one_of_error,
+}
@@ -5,17 +5,19 @@ import jsonschema.validators
 import jsonschema._utils
 import jsonpointer
 import jsonpatch
+import copy
 from datetime import datetime
 import re
 import urlparse
 import sys
-import requests
 
 import ckan.plugins.toolkit as tk
 from ckan.common import _, config
 from ckan import model as ckan_model
 from ckanext.metadata.common import DOI_RE, TIME_RE
 from ckanext.metadata.logic.auth import check_privs
+from ckanext.metadata.lib import vocabulary_cache
+from ckanext.metadata.lib import url_check
 
 checks_format = jsonschema.FormatChecker.cls_checks
 
@@ -42,15 +44,36 @@ def vocabulary_validator(validator, vocabulary_name, instance, schema):
     """
     "vocabulary" keyword validator function: checks that instance is a tag from the named vocabulary.
     The check is case-insensitive.
+
+    If the validator context contains a 'vocabularies' dict - mapping vocabulary names to sets
+    of lowercased tag names, or to None for non-existent vocabularies - then the named vocabulary
+    is looked up there; otherwise it is taken from the process-wide vocabulary cache.
     """
     if validator.is_type(instance, 'string'):
-        try:
-            vocabulary = tk.get_action('vocabulary_show')(data_dict={'id': vocabulary_name})
-            tags = [tag['name'].lower() for tag in vocabulary['tags']]
-            if instance.lower() not in tags:
-                yield jsonschema.ValidationError(_('Tag not found in vocabulary'))
-        except tk.ObjectNotFound:
+        vocabularies = validator.context.get('vocabularies') or {}
+        if vocabulary_name in vocabularies:
+            tags = vocabularies[vocabulary_name]
+        else:
+            tags = vocabulary_cache.get_tags(ckan_model.Session, vocabulary_name)
+
+        if tags is None:
             yield jsonschema.ValidationError("%s: %s '%s'" % (_('Not found'), _('Vocabulary'), vocabulary_name))
+        elif instance.lower() not in tags:
+            yield jsonschema.ValidationError(_('Tag not found in vocabulary'))
+
+
+def _memoize(validator, key, func):
+    """
+    Look up a value in the validator's memo, computing and storing it if necessary. The memo
+    lasts for the validation run (or, if the caller passed a 'validation_memo' dict in the
+    context, for as long as the caller keeps it), so that repeated references within a document
+    - e.g. the same user email in many places - cost only one DB or Redis lookup.
+    """
+    try:
+        return validator.memo[key]
+    except KeyError:
+        value = validator.memo[key] = func()
+        return value
 
 
 def objectid_validator(validator, model_name, instance, schema):
@@ -58,22 +81,29 @@ def objectid_validator(validator, model_name, instance, schema):
     "objectid" keyword validator function: checks that instance is the id of an object of the named model.
     """
     if validator.is_type(instance, 'string'):
-        show_func_name = '{}_show'.format(model_name)
-        try:
-            show_func = tk.get_action(show_func_name)
-        except:
-            yield jsonschema.ValidationError(_("Invalid model name '{}': action '{}' not found".
-                                               format(model_name, show_func_name)))
-            return
+        error = _memoize(validator, ('objectid', model_name, instance),
+                         lambda: _check_objectid(model_name, instance))
+        if error is not None:
+            yield jsonschema.ValidationError(error)
 
-        try:
-            object_dict = show_func({}, {'id': instance})
-        except:
-            yield jsonschema.ValidationError("%s: %s" % (_("Not found"), _("User")))
-            return
 
-        if object_dict['id'] != instance:
-            yield jsonschema.ValidationError(_("Must use object id not name"))
+def _check_objectid(model_name, object_id):
+    """
+    :returns: an error message, or None if object_id is the id of an object of the named model
+    """
+    show_func_name = '{}_show'.format(model_name)
+    try:
+        show_func = tk.get_action(show_func_name)
+    except:
+        return _("Invalid model name '{}': action '{}' not found".format(model_name, show_func_name))
+
+    try:
+        object_dict = show_func({}, {'id': object_id})
+    except:
+        return "%s: %s" % (_("Not found"), _("User"))
+
+    if object_dict['id'] != object_id:
+        return _("Must use object id not name")
 
 
 def role_validator(validator, role_name, instance, schema):
@@ -83,30 +113,38 @@ def role_validator(validator, role_name, instance, schema):
     """
     if validator.is_type(instance, 'string'):
         metadata_record_id = validator.object_id
-        organization_id = ckan_model.Package.get(metadata_record_id).owner_org
-        users = ckan_model.User.by_email(instance)
-        user = users[0] if users else None
-        if not user:
+        organization_id = _memoize(validator, ('owner_org', metadata_record_id),
+                                   lambda: ckan_model.Package.get(metadata_record_id).owner_org)
+        user_name = _memoize(validator, ('user_by_email', instance),
+                             lambda: _user_name_by_email(instance))
+        if not user_name:
             yield jsonschema.ValidationError(_("User not found for email %s") % instance)
             return
-        check_context = {'user': user.name, 'model': ckan_model}
 
         if role_name == config.get('ckan.metadata.admin_role'):
-            valid = check_privs(check_context, require_admin=True)
+            privs = {'require_admin': True}
         elif role_name == config.get('ckan.metadata.curator_role'):
-            valid = check_privs(check_context, require_curator=True, require_organization=organization_id)
+            privs = {'require_curator': True, 'require_organization': organization_id}
         elif role_name == config.get('ckan.metadata.harvester_role'):
-            valid = check_privs(check_context, require_harvester=True, require_organization=organization_id)
+            privs = {'require_harvester': True, 'require_organization': organization_id}
         elif role_name == config.get('ckan.metadata.contributor_role'):
-            valid = check_privs(check_context, require_contributor=True, require_organization=organization_id)
+            privs = {'require_contributor': True, 'require_organization': organization_id}
         else:
             yield jsonschema.ValidationError(_("Role %s is not supported by this keyword") % role_name)
             return
 
+        check_context = {'user': user_name, 'model': ckan_model}
+        valid = _memoize(validator, ('privs', user_name, tuple(sorted(privs.items()))),
+                         lambda: check_privs(check_context, **privs))
         if not valid:
             yield jsonschema.ValidationError(_("User %s does not have the %s role within the applicable organizational context") % (instance, role_name))
 
 
+def _user_name_by_email(email):
+    users = ckan_model.User.by_email(email)
+    return users[0].name if users else None
+
+
 def unique_objects_validator(validator, key_properties, instance, schema):
     """
     "uniqueObjects" keyword validator: for an array comprising objects, this checks that the objects
@@ -227,25 +265,19 @@ def url_test_validator(validator, url_test, instance, schema):
     "urlTest" keyword validator: the value of this keyword is a boolean; if True,
     a HEAD request is made to the specified url.
 
-    Notes:
-        - We don't verify the server certificate. We are not fetching any data
-          so there is no risk here. It just means a user might get a certificate
-          warning in their browser when following the download link. Many of our
-          metadata download links are to plain-http servers anyway, the risk of
-          man-in-the-middle attacks applies equally to all of them.
-
-        - We allow HTTP 401 Unauthorized responses to pass. This response
-          typically means the resource is present but the user will be asked to
-          login to access it.
+    The URLs in a document are normally checked concurrently before validation starts (see
+    :py:meth:`WorkflowValidator._prepare`), in which case the prefetched result is used here.
+    Results are cached; see :py:class:`ckanext.metadata.lib.url_check.URLChecker`.
     """
     if validator.is_type(instance, 'string'):
         if url_test:
-            try:
-                response = requests.head(instance, verify=False)
-                if response.status_code != 401:
-                    response.raise_for_status()
-            except requests.RequestException, e:
-                yield jsonschema.ValidationError(str(e))
+            results = getattr(validator, 'url_test_results', {})
+            if instance in results:
+                error = results[instance]
+            else:
+                error = url_check.check_url(instance)
+            if error is not None:
+                yield jsonschema.ValidationError(error)
 
 
 def map_init_validator(validator, target_elements, instance, schema):
@@ -254,10 +286,13 @@ def map_init_validator(validator, target_elements, instance, schema):
     written to by "mapTo" operations.
 
     "mapInit" is a dict containing the target element names and their initial values.
+    The initial values are copied, since the schema may be shared by many validations
+    (see :py:mod:`ckanext.metadata.lib.validator_cache`) and "mapTo" modifies the targets
+    in place.
     """
     if validator.is_type(target_elements, 'object'):
         for target_name, init_value in target_elements.iteritems():
-            validator.root_instance[target_name] = init_value
+            validator.root_instance[target_name] = copy.deepcopy(init_value)
 
 
 def map_to_validator(validator, map_params, instance, schema):
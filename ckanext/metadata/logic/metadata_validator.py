@@ -1,9 +1,10 @@
 # encoding: utf-8
 
-from ckanext.metadata.logic.json_validator import JSONValidator
+from ckanext.metadata.logic.json_validator import JSONValidator, extend_jsonschema_validators
 from ckanext.metadata.logic import json_validator_functions as jvf
 
 
+@extend_jsonschema_validators
 class MetadataValidator(JSONValidator):
     """
     JSON Schema validator for metadata.
@@ -16,6 +16,7 @@ _permissions_map = {
         ],
         'submit': [
             'metadata_record_create',
+            'metadata_record_bulk_upsert',
             'metadata_standard_list',
             'metadata_standard_show',
             'infrastructure_list',
@@ -23,6 +24,7 @@ _permissions_map = {
         ],
         'manage': [
             'metadata_record_create',
+            'metadata_record_bulk_upsert',
             'metadata_record_update',
             'metadata_record_delete',
             'metadata_record_validation_schema_list',
@@ -36,6 +38,7 @@ _permissions_map = {
             'metadata_record_workflow_state_transition',
             'metadata_record_workflow_state_revert',
             'metadata_record_index_show',
+            'revalidation_queue_status',
             'metadata_record_index_update',
             'metadata_record_assign_doi',
             'metadata_standard_list',
@@ -57,6 +60,7 @@ _permissions_map = {
             'metadata_collection_delete',
             'metadata_collection_validate',
             'metadata_collection_workflow_state_transition',
+            'bulk_job_status',
         ],
     },
 
@@ -139,6 +143,7 @@ _permissions_map = {
         'manage': [
             'metadata_standard_index_create',
             'metadata_standard_index_delete',
+            'search_agent_stats',
         ],
     },
 }
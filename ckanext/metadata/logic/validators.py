@@ -21,6 +21,7 @@ from ckanext.metadata.common import (
     SID_RE,
 )
 from ckanext.metadata.logic.json_validator import JSONValidator
+from ckanext.metadata.lib import parsed_json
 
 convert_to_extras = tk.get_validator('convert_to_extras')
 
@@ -106,7 +107,7 @@ def json_dict_validator(key, data, errors, context):
     value = data.get(key)
     if value:
         try:
-            obj = json.loads(value)
+            obj = parsed_json.loads(context, value)
         except ValueError, e:
             _abort(errors, key, _("JSON decode error: %s") % e.message)
 
@@ -155,10 +156,13 @@ def format_json(deserialize):
     """
     def callable_(key, data, errors, context):
         value = data.get(key)
-        try:
-            json_obj = json.loads(value) if isinstance(value, basestring) else value
-        except:
-            json_obj = value
+        # an already-parsed document may be reused for formatting, but not for output
+        json_obj = parsed_json.peek(context, value) if isinstance(value, basestring) and not deserialize else None
+        if json_obj is None:
+            try:
+                json_obj = json.loads(value) if isinstance(value, basestring) else value
+            except:
+                json_obj = value
 
         try:
             data[key] = json_obj if deserialize else json.dumps(json_obj, indent=4, ensure_ascii=False)
@@ -375,8 +379,8 @@ def owner_org_owns_metadata_collection(key, data, errors, context):
     # existing value(s) and check that the updated combination satisfies our condition
     organization_id = _convert_missing(organization_id, obj.owner_org if obj else None)
     if obj and not metadata_collection_id:
-        metadata_collection_id = session.query(model.PackageExtra.value) \
-            .filter_by(package_id=id_, key='metadata_collection_id').scalar()
+        metadata_collection_id = session.query(ckanext_model.MetadataRecordAttrs.metadata_collection_id) \
+            .filter_by(package_id=id_).scalar()
 
     metadata_collection_organization_id = session.query(model.GroupExtra.value) \
         .filter_by(group_id=metadata_collection_id, key='organization_id').scalar()
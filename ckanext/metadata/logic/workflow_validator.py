@@ -1,6 +1,7 @@
 # encoding: utf-8
 
-from ckanext.metadata.logic.json_validator import JSONValidator
+from ckanext.metadata.lib import url_check
+from ckanext.metadata.logic.json_validator import JSONValidator, extend_jsonschema_validators
 from ckanext.metadata.logic.json_validator_functions import (
     objectid_validator,
     role_validator,
@@ -9,6 +10,7 @@ from ckanext.metadata.logic.json_validator_functions import (
 )
 
 
+@extend_jsonschema_validators
 class WorkflowValidator(JSONValidator):
     """
     JSON Schema validator for workflow state transitions.
@@ -30,3 +32,10 @@ class WorkflowValidator(JSONValidator):
             'date',
             'email',
         ]
+
+    def _prepare(self, instance):
+        """
+        Check all the URLs subject to "urlTest" concurrently, ahead of validation.
+        """
+        urls = url_check.find_url_test_instances(self.jsonschema_validator.resolver, self.schema, instance)
+        self.jsonschema_validator.url_test_results = url_check.check_urls(urls) if urls else {}
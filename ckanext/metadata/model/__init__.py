@@ -41,3 +41,20 @@ from workflow_annotation import (
     workflow_annotation_table,
     workflow_annotation_revision_table,
 )
+
+from bulk_job import (
+    BulkJob,
+    BulkJobError,
+    bulk_job_table,
+    bulk_job_error_table,
+)
+
+from metadata_record_attrs import (
+    MetadataRecordAttrs,
+    metadata_record_attrs_table,
+)
+
+from index_outbox import (
+    IndexOutbox,
+    index_outbox_table,
+)
@@ -0,0 +1,106 @@
+# encoding: utf-8
+
+from datetime import datetime
+from sqlalchemy import types, Table, Column, ForeignKey, Index
+
+from ckan.model import meta, types as _types, domain_object
+
+
+bulk_job_table = Table(
+    'bulk_job', meta.metadata,
+    Column('id', types.UnicodeText, primary_key=True, default=_types.make_uuid),
+    Column('action', types.UnicodeText, nullable=False),
+    Column('object_id', types.UnicodeText),
+    Column('user_id', types.UnicodeText),
+    Column('total_count', types.Integer, nullable=False, default=0),
+    Column('done_count', types.Integer, nullable=False, default=0),
+    Column('error_count', types.Integer, nullable=False, default=0),
+    Column('job_count', types.Integer, nullable=False, default=0),
+    Column('jobs_done', types.Integer, nullable=False, default=0),
+    Column('created', types.DateTime, nullable=False, default=datetime.utcnow),
+    Column('finished', types.DateTime),
+)
+
+bulk_job_error_table = Table(
+    'bulk_job_error', meta.metadata,
+    Column('id', types.UnicodeText, primary_key=True, default=_types.make_uuid),
+    Column('bulk_job_id', types.UnicodeText, ForeignKey('bulk_job.id', ondelete='CASCADE'), nullable=False),
+    Column('object_id', types.UnicodeText, nullable=False),
+    Column('message', types.UnicodeText, nullable=False),
+    Column('timestamp', types.DateTime, nullable=False, default=datetime.utcnow),
+    Index('idx_bulk_job_error_bulk_job_id', 'bulk_job_id'),
+)
+
+
+class BulkJob(domain_object.DomainObject):
+    """
+    Progress and outcome of a bulk operation - e.g. a metadata collection validation - which
+    may be carried out by several background jobs.
+    """
+
+    @classmethod
+    def get(cls, reference):
+        """
+        Returns a bulk_job object referenced by its id.
+        """
+        if not reference:
+            return None
+
+        return meta.Session.query(cls).get(reference)
+
+    @classmethod
+    def record_progress(cls, bulk_job_id, done_count, errors, job_done=False):
+        """
+        Atomically add the outcome of a batch of invocations to a bulk job, within the
+        current transaction. The job is marked as finished when its last background job
+        (or, for a job without background jobs, its last batch) has been recorded.
+
+        :param bulk_job_id: the bulk job id
+        :param done_count: the number of invocations processed, including failures
+        :param errors: list of (object_id, message) tuples for the failed invocations
+        :param job_done: True if a background job has completed
+        """
+        table = bulk_job_table
+        result = meta.Session.execute(
+            table.update()
+                .where(table.c.id == bulk_job_id)
+                .values(done_count=table.c.done_count + done_count,
+                        error_count=table.c.error_count + len(errors),
+                        jobs_done=table.c.jobs_done + (1 if job_done else 0))
+                .returning(table.c.jobs_done, table.c.job_count, table.c.done_count, table.c.total_count)
+        ).first()
+
+        if errors:
+            meta.Session.execute(bulk_job_error_table.insert(), [{
+                'id': _types.make_uuid(),
+                'bulk_job_id': bulk_job_id,
+                'object_id': object_id,
+                'message': message,
+                'timestamp': datetime.utcnow(),
+            } for object_id, message in errors])
+
+        if result is not None:
+            jobs_done, job_count, done_count, total_count = result
+            if (job_count and jobs_done >= job_count) or (not job_count and done_count >= total_count):
+                meta.Session.execute(
+                    table.update()
+                        .where(table.c.id == bulk_job_id)
+                        .values(finished=datetime.utcnow())
+                )
+
+    def rate(self):
+        """
+        :returns: the average processing rate, in records per second, or None if not yet known
+        """
+        elapsed = ((self.finished or datetime.utcnow()) - self.created).total_seconds()
+        if not self.done_count or elapsed <= 0:
+            return None
+        return self.done_count / elapsed
+
+
+class BulkJobError(domain_object.DomainObject):
+    pass
+
+
+meta.mapper(BulkJob, bulk_job_table)
+meta.mapper(BulkJobError, bulk_job_error_table)
@@ -0,0 +1,109 @@
+# encoding: utf-8
+
+from datetime import datetime
+from collections import namedtuple
+from sqlalchemy import types, Table, Column, Index, select
+
+from ckan.model import meta, domain_object
+
+
+index_outbox_table = Table(
+    'metadata_index_outbox', meta.metadata,
+    Column('id', types.BigInteger, primary_key=True),
+    Column('package_id', types.UnicodeText, nullable=False),
+    Column('index_name', types.UnicodeText, nullable=False),
+    Column('operation', types.UnicodeText, nullable=False),
+    Column('created', types.DateTime, nullable=False, default=datetime.utcnow),
+    Column('state', types.UnicodeText, nullable=False, default=u'pending', server_default=u'pending'),
+    Column('attempts', types.Integer, nullable=False, default=0, server_default='0'),
+    Column('last_error', types.UnicodeText),
+    Index('idx_metadata_index_outbox_package_id', 'package_id'),
+)
+
+# the last operation written for a record, the ids of all the claimed rows for the record,
+# and the number of failed attempts to send the operation
+ClaimedOperation = namedtuple('ClaimedOperation', ('index_name', 'operation', 'row_ids', 'attempts'))
+
+
+class IndexOutbox(domain_object.DomainObject):
+    """
+    Pending search index operations on metadata records. A row is written in the same
+    transaction as the change to the record that requires it, so an operation exists
+    if and only if the change was committed; rows are removed by the relay worker once
+    the operations have been sent to the search agent. Operations that could not be sent
+    are kept in the 'dead' state, and are not retried.
+    """
+
+    PUT = 'put'
+    DELETE = 'delete'
+
+    PENDING = 'pending'
+    DEAD = 'dead'
+
+    @classmethod
+    def add(cls, package_id, index_name, operation):
+        """
+        Add an operation to the outbox, within the current transaction.
+        """
+        meta.Session.execute(index_outbox_table.insert().values(
+            package_id=package_id,
+            index_name=index_name,
+            operation=operation,
+            created=datetime.utcnow(),
+        ))
+
+    @classmethod
+    def claim(cls, limit):
+        """
+        Lock, within the current transaction, the pending operations on the (up to ``limit``)
+        records with the oldest pending operations, together with any later pending operations
+        on the same records. Rows that are locked by a concurrent claim are skipped.
+
+        The claimed rows should be removed or marked as failed before the transaction is
+        committed; if it is rolled back, they are left in the outbox as they were.
+
+        :returns: dict{package_id: ClaimedOperation}
+        """
+        table = index_outbox_table
+        pending = table.c.state == cls.PENDING
+        oldest = select([table.c.package_id]).where(pending).order_by(table.c.id).limit(limit) \
+            .with_for_update(skip_locked=True)
+        rows = meta.Session.execute(
+            select([table.c.id, table.c.package_id, table.c.index_name, table.c.operation, table.c.attempts])
+                .where(pending)
+                .where(table.c.package_id.in_(oldest))
+                .order_by(table.c.id)
+                .with_for_update(skip_locked=True)
+        ).fetchall()
+
+        operations = {}
+        for id_, package_id, index_name, operation, attempts in rows:
+            row_ids = operations[package_id].row_ids if package_id in operations else []
+            operations[package_id] = ClaimedOperation(index_name, operation, row_ids + [id_], attempts)
+        return operations
+
+    @classmethod
+    def remove(cls, row_ids):
+        """
+        Remove claimed rows (for operations that have been sent), within the current transaction.
+        """
+        if row_ids:
+            meta.Session.execute(index_outbox_table.delete().where(index_outbox_table.c.id.in_(row_ids)))
+
+    @classmethod
+    def fail(cls, row_ids, error, dead):
+        """
+        Record a failed attempt to send a record's claimed operation, within the current
+        transaction. The superseded rows are removed; the last row has its attempt count
+        incremented and its error recorded, and is moved to the dead state if ``dead``.
+        """
+        table = index_outbox_table
+        cls.remove(row_ids[:-1])
+        meta.Session.execute(table.update().where(table.c.id == row_ids[-1]).values(
+            attempts=table.c.attempts + 1,
+            last_error=error,
+            state=cls.DEAD if dead else cls.PENDING,
+        ))
+
+
+meta.mapper(IndexOutbox, index_outbox_table)
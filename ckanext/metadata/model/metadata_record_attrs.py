@@ -0,0 +1,100 @@
+# encoding: utf-8
+
+from paste.deploy.converters import asbool
+from sqlalchemy import types, Table, Column, ForeignKey, Index, func, text
+
+from ckan.model import meta, domain_object
+
+
+metadata_record_attrs_table = Table(
+    'metadata_record_attrs', meta.metadata,
+    Column('package_id', types.UnicodeText, ForeignKey('package.id', ondelete='CASCADE'), primary_key=True),
+    Column('doi', types.UnicodeText),
+    Column('sid', types.UnicodeText),
+    Column('metadata_collection_id', types.UnicodeText),
+    Column('metadata_standard_id', types.UnicodeText),
+    Column('workflow_state_id', types.UnicodeText),
+    Column('validated', types.Boolean, nullable=False, default=False),
+)
+
+Index('idx_metadata_record_attrs_doi', func.lower(metadata_record_attrs_table.c.doi))
+Index('idx_metadata_record_attrs_sid', func.lower(metadata_record_attrs_table.c.sid))
+Index('idx_metadata_record_attrs_collection_validated',
+      metadata_record_attrs_table.c.metadata_collection_id, metadata_record_attrs_table.c.validated)
+Index('idx_metadata_record_attrs_standard', metadata_record_attrs_table.c.metadata_standard_id)
+Index('idx_metadata_record_attrs_workflow_state', metadata_record_attrs_table.c.workflow_state_id)
+
+# the package extras that are copied into metadata_record_attrs columns
+EXTRA_KEYS = (
+    'doi',
+    'sid',
+    'metadata_collection_id',
+    'metadata_standard_id',
+    'workflow_state_id',
+    'validated',
+)
+
+
+class MetadataRecordAttrs(domain_object.DomainObject):
+    """
+    A denormalized copy of the metadata record package extras that are used for lookups
+    and filtering, in typed and indexed columns. There is one row per metadata record,
+    which must be kept in sync with the package extras whenever they are saved.
+    """
+
+    @classmethod
+    def get(cls, package_id):
+        if not package_id:
+            return None
+
+        return meta.Session.query(cls).get(package_id)
+
+    def update_from_extras(self, extras):
+        """
+        Set the column values from a metadata record's extras.
+
+        :param extras: dict-like object of package extras
+        """
+        self.doi = extras.get('doi') or None
+        self.sid = extras.get('sid') or None
+        self.metadata_collection_id = extras.get('metadata_collection_id') or None
+        self.metadata_standard_id = extras.get('metadata_standard_id') or None
+        self.workflow_state_id = extras.get('workflow_state_id') or None
+        self.validated = asbool(extras.get('validated') or False)
+
+    @classmethod
+    def backfill(cls, connection):
+        """
+        (Re-)populate the table from the active extras of all metadata records, in a single
+        set-based statement.
+
+        :param connection: SQLAlchemy connection
+        :returns: the number of rows inserted or updated
+        """
+        result = connection.execute(text("""
+            INSERT INTO metadata_record_attrs (package_id, doi, sid, metadata_collection_id,
+                                               metadata_standard_id, workflow_state_id, validated)
+            SELECT p.id,
+                   nullif(max(CASE WHEN e.key = 'doi' THEN e.value END), ''),
+                   nullif(max(CASE WHEN e.key = 'sid' THEN e.value END), ''),
+                   nullif(max(CASE WHEN e.key = 'metadata_collection_id' THEN e.value END), ''),
+                   nullif(max(CASE WHEN e.key = 'metadata_standard_id' THEN e.value END), ''),
+                   nullif(max(CASE WHEN e.key = 'workflow_state_id' THEN e.value END), ''),
+                   coalesce(lower(max(CASE WHEN e.key = 'validated' THEN e.value END))
+                            IN ('true', 'yes', 'on', 'y', 't', '1'), false)
+            FROM package p
+            LEFT JOIN package_extra e ON e.package_id = p.id AND e.state = 'active'
+            WHERE p.type = 'metadata_record'
+            GROUP BY p.id
+            ON CONFLICT (package_id) DO UPDATE SET
+                doi = excluded.doi,
+                sid = excluded.sid,
+                metadata_collection_id = excluded.metadata_collection_id,
+                metadata_standard_id = excluded.metadata_standard_id,
+                workflow_state_id = excluded.workflow_state_id,
+                validated = excluded.validated
+        """))
+        return result.rowcount
+
+
+meta.mapper(MetadataRecordAttrs, metadata_record_attrs_table)
@@ -23,13 +23,113 @@ def init_tables():
         metadata_json_attr_map_revision_table,
         workflow_annotation_table,
         workflow_annotation_revision_table,
+        bulk_job_table,
+        bulk_job_error_table,
+        metadata_record_attrs_table,
+        index_outbox_table,
     )
+    created_tables = []
     for table in tables:
         if not table.exists():
             log.debug("Creating table %s", table.name)
             table.create()
+            created_tables += [table]
         else:
             log.debug("Table %s already exists", table.name)
 
     conn = meta.engine.connect()
     conn.execute(text('alter table package add column if not exists last_publish_check timestamp with time zone'))
+
+    if metadata_record_attrs_table in created_tables:
+        backfill_metadata_record_attrs(conn)
+
+
+def backfill_metadata_record_attrs(conn=None):
+    """
+    Populate the metadata_record_attrs table from the metadata record package extras.
+    """
+    conn = conn or meta.engine.connect()
+    with conn.begin():
+        count = MetadataRecordAttrs.backfill(conn)
+    log.info("Backfilled metadata_record_attrs for %d metadata records", count)
+    return count
+
+
+# indexes on core CKAN tables that support the extension's own queries; lookups on the
+# metadata record extras go through metadata_record_attrs, which carries its own indexes
+INDEXES = (
+    ('idx_metadata_member_table_id_name_state', 'member', '(table_id, table_name, state)', None),
+    ('idx_metadata_activity_object_type_timestamp', 'activity', '(object_id, activity_type, timestamp DESC)', None),
+)
+
+# representative forms of the hot action queries, for comparing query plans
+HOT_QUERIES = (
+    ('DOI/SID match', """
+        SELECT package_id FROM metadata_record_attrs
+        WHERE lower(doi) = lower(:value)
+    """, {'value': u'10.12345/EXAMPLE.1'}),
+    ('metadata collection filter', """
+        SELECT p.id FROM package p
+        JOIN metadata_record_attrs a ON a.package_id = p.id
+        WHERE a.metadata_collection_id = :value
+        AND p.type = 'metadata_record' AND p.state = 'active'
+    """, {'value': u'example-collection-id'}),
+    ('infrastructure join', """
+        SELECT p.id FROM package p
+        JOIN metadata_record_attrs a ON a.package_id = p.id
+        JOIN member m ON m.table_id = a.metadata_collection_id
+        WHERE m.group_id = :value AND m.table_name = 'group' AND m.state != 'deleted'
+        AND p.type = 'metadata_record' AND p.state = 'active'
+    """, {'value': u'example-infrastructure-id'}),
+    ('metadata_record_validation_activity_show', """
+        SELECT id FROM activity
+        WHERE object_id = :value AND activity_type = 'metadata validation'
+        ORDER BY timestamp DESC LIMIT 1
+    """, {'value': u'example-metadata-record-id'}),
+)
+
+
+def create_indexes():
+    """
+    Create the INDEXES, without locking out writes to the indexed tables. An index
+    left invalid by a previously failed concurrent build is dropped and rebuilt.
+
+    :returns: list of (index name, status) tuples, where status is 'created' or 'exists'
+    """
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+    conn = meta.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+    report = []
+    try:
+        for name, table, columns, where in INDEXES:
+            valid = conn.execute(text("""
+                SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+                WHERE c.relname = :name
+            """), name=name).scalar()
+            if valid:
+                report += [(name, 'exists')]
+                continue
+            if valid is not None:
+                log.warning("Dropping invalid index %s", name)
+                conn.execute(text('DROP INDEX CONCURRENTLY IF EXISTS %s' % name))
+
+            log.debug("Creating index %s", name)
+            conn.execute(text('CREATE INDEX CONCURRENTLY %s ON %s %s%s' % (
+                name, table, columns, ' WHERE %s' % where if where else '')))
+            report += [(name, 'created')]
+    finally:
+        conn.close()
+    return report
+
+
+def explain_hot_queries():
+    """
+    Run EXPLAIN for each of the HOT_QUERIES.
+
+    :returns: list of (query name, query plan) tuples
+    """
+    conn = meta.engine.connect()
+    try:
+        return [(name, '\n'.join(row[0] for row in conn.execute(text('EXPLAIN ' + sql), **params)))
+                for name, sql, params in HOT_QUERIES]
+    finally:
+        conn.close()
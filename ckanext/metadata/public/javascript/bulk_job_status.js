@@ -0,0 +1,63 @@
+/*
+ * Polls the bulk_job_status action and displays the progress of a background bulk job
+ * on the metadata collection bulk action page.
+ */
+(function () {
+  var POLL_INTERVAL = 3000;
+  var container = document.getElementById('bulk-job-status');
+  if (!container) {
+    return;
+  }
+  var progress = container.querySelector('.bulk-job-progress');
+  var errorList = container.querySelector('.bulk-job-errors');
+  var url = container.getAttribute('data-api-url') + '?id=' +
+    encodeURIComponent(container.getAttribute('data-bulk-job-id'));
+
+  function formatDuration(seconds) {
+    if (seconds < 60) {
+      return seconds + 's';
+    }
+    return Math.floor(seconds / 60) + 'm ' + (seconds % 60) + 's';
+  }
+
+  function render(job) {
+    var text = job.done_count + ' of ' + job.total_count + ' records processed; ' +
+      job.error_count + ' failed.';
+    if (job.records_per_second) {
+      text += ' Rate: ' + job.records_per_second + ' records/s.';
+    }
+    if (job.finished) {
+      text += ' Finished.';
+      container.className = job.error_count ? 'alert alert-warning' : 'alert alert-success';
+    } else if (job.eta_seconds !== null) {
+      text += ' Estimated time remaining: ' + formatDuration(job.eta_seconds) + '.';
+    }
+    progress.textContent = text;
+
+    errorList.innerHTML = '';
+    for (var i = 0; i < job.errors.length; i++) {
+      var item = document.createElement('li');
+      item.textContent = job.errors[i].object_id + ': ' + job.errors[i].message;
+      errorList.appendChild(item);
+    }
+  }
+
+  function poll() {
+    var request = new XMLHttpRequest();
+    request.open('GET', url);
+    request.onload = function () {
+      if (request.status !== 200) {
+        progress.textContent = 'Unable to retrieve the progress of the background job.';
+        return;
+      }
+      var job = JSON.parse(request.responseText).result;
+      render(job);
+      if (!job.finished) {
+        window.setTimeout(poll, POLL_INTERVAL);
+      }
+    };
+    request.send();
+  }
+
+  poll();
+})();
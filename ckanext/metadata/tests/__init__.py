@@ -9,7 +9,14 @@ from collections import deque
 import traceback
 from nose.tools import nottest
 import os.path
+import importlib
 from subprocess import Popen
+import threading
+import urlparse
+from collections import Counter
+from contextlib import contextmanager
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
 
 from ckan.tests import factories as ckan_factories
 from ckan.tests.helpers import FunctionalTestBase, call_action, reset_db
@@ -40,6 +47,10 @@ def load_example(filename):
     return pkg_resources.resource_string(__name__, '../../../schema/' + filename)
 
 
+def load_archived_example(filename):
+    return pkg_resources.resource_string(__name__, '../../../schema-archived/' + filename)
+
+
 def config_filename():
     """
     Get the test config filename (test.ini)
@@ -59,6 +70,122 @@ def process_queued_tasks():
     p.wait()
 
 
+@contextmanager
+def changed_environ(name, value):
+    """
+    Set an environment variable for the duration of a with block.
+    """
+    original_value = os.environ.get(name)
+    os.environ[name] = value
+    try:
+        yield
+    finally:
+        if original_value is None:
+            del os.environ[name]
+        else:
+            os.environ[name] = original_value
+
+
+def import_elastic_module(name):
+    """
+    Import a module of the metadata_elasticsearch plugin. The search index client requires
+    the RABBITMQ_HOST environment variable at import, although synchronous calls to the
+    search agent do not use the broker.
+    """
+    with changed_environ('RABBITMQ_HOST', os.environ.get('RABBITMQ_HOST') or 'localhost'):
+        return importlib.import_module('ckanext.metadata.elastic.' + name)
+
+
+class StubServer(object):
+    """
+    An HTTP server on a free local port, which answers requests in background threads by
+    calling ``respond(method, path, params)``. This returns a (status, body) tuple; params
+    is a dict of the form fields in the request body, and a body that is not a string is
+    sent as JSON. Requests are counted per path in ``requested_paths``.
+
+    Use as a context manager, which starts the server, and shuts it down on exit.
+    """
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.requested_paths = Counter()
+        self._server = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self._server.server_port
+
+    def __enter__(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_HEAD(self):
+                self._handle('HEAD')
+
+            def do_POST(self):
+                self._handle('POST')
+
+            def _handle(self, method):
+                request_body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+                params = dict((key, values[0]) for key, values in urlparse.parse_qs(request_body).iteritems())
+                status, body = stub.respond(method, self.path, params)
+                stub.requested_paths[self.path] += 1
+                self.send_response(status)
+                self.end_headers()
+                if method != 'HEAD' and body is not None:
+                    self.wfile.write(body if isinstance(body, basestring) else json.dumps(body))
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self._server = Server(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self._server.serve_forever).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class StubSearchAgent(StubServer):
+    """
+    A stub Elastic search agent holding a single index, as a dict of documents keyed by
+    record id, in ``index``. Supports the requests made by the search index client for
+    adding, deleting and paging through records; ``add_bulk`` is supported only if
+    ``bulk`` is set, as it is not provided by all versions of the agent. Requests to a
+    path in ``statuses`` are answered with just the given HTTP status.
+    """
+
+    def __init__(self, bulk=False):
+        super(StubSearchAgent, self).__init__(self._respond)
+        self.bulk = bulk
+        self.index = {}
+        self.statuses = {}
+
+    def _respond(self, method, path, params):
+        if path in self.statuses:
+            return self.statuses[path], None
+        if path == '/search':
+            record_ids = sorted(record_id for record_id in self.index
+                                if record_id > params.get('search_after', ''))
+            results = [self.index[record_id] for record_id in record_ids[:int(params['size'])]]
+            return 200, {'success': True, 'result_length': len(results), 'results': results}
+        if path == '/add':
+            self.index[params['record_id']] = params
+            return 200, {'success': True}
+        if path == '/add_bulk' and self.bulk:
+            for record in json.loads(params['records']):
+                self.index[record['record_id']] = record
+            return 200, {'success': True}
+        if path == '/delete':
+            self.index.pop(params['record_id'], None)
+            return 200, {'success': True}
+        return 404, None
+
+
 def make_uuid():
     return unicode(uuid.uuid4())
 
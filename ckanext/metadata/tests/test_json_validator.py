@@ -0,0 +1,131 @@
+# encoding: utf-8
+
+import json
+import copy
+
+from ckanext.metadata.logic.json_validator import clear_empties
+from ckanext.metadata.logic.metadata_validator import MetadataValidator
+from ckanext.metadata.lib import validator_cache
+from ckanext.metadata.tests import load_archived_example, assert_error
+
+
+def _has_empties(node):
+    if type(node) is dict:
+        return any(value in ('', [], {}, None) or _has_empties(value) for value in node.itervalues())
+    if type(node) is list:
+        return any(element in ('', [], {}, None) or _has_empties(element) for element in node)
+    return False
+
+
+class TestJSONValidator(object):
+
+    def test_clear_empties(self):
+        """
+        Prune empty elements from the example records in schema-archived/, each padded with
+        arrays of mostly-empty items. The input must be left unchanged, and the result must
+        contain no empty elements.
+        """
+        for filename in ('saeon_odp_4.2_record.json', 'saeon_datacite_4.3_record.json',
+                         'saeon_iso19115_record.json', 'mims_metadata_record.json'):
+            metadata_dict = json.loads(load_archived_example(filename))
+            metadata_dict['padded_keywords'] = [{'keyword': 'k%d' % i if i % 2 else '', 'scheme': ''}
+                                                for i in range(1000)]
+            metadata_dict['padded_coordinates'] = [[i, None, [], ''] for i in range(1000)]
+            original_dict = copy.deepcopy(metadata_dict)
+
+            cleaned_dict = clear_empties(metadata_dict)
+
+            assert metadata_dict == original_dict
+            assert not _has_empties(cleaned_dict)
+            assert len(cleaned_dict['padded_keywords']) == 500
+            assert cleaned_dict['padded_keywords'][0] == {'keyword': 'k1'}
+            assert cleaned_dict['padded_coordinates'][0] == [0]
+
+    def test_clear_empties_nested(self):
+        """
+        Containers that become empty once their empty elements are removed are removed too,
+        while falsy non-empty values are kept.
+        """
+        metadata_dict = {
+            'a': {'b': {'c': '', 'd': [None, {}]}},
+            'e': [0, False, '', [[]]],
+            'f': 'value',
+        }
+        assert clear_empties(metadata_dict) == {'e': [0, False], 'f': 'value'}
+
+    def test_error_tree(self):
+        """
+        Validate a generated record with many errors, and check that the errors are placed
+        correctly in the error tree.
+        """
+        item_count = 100
+        schema = {
+            '$schema': 'http://json-schema.org/draft-07/schema#',
+            'type': 'object',
+            'required': ['title', 'identifier'],
+            'properties': {
+                'items': {
+                    'type': 'array',
+                    'minItems': item_count * 2,
+                    'items': {
+                        'type': 'object',
+                        'required': ['name', 'value'],
+                        'properties': {
+                            'name': {'type': 'string'},
+                            'value': {'type': 'number'},
+                            'tags': {'type': 'array', 'uniqueItems': True},
+                        },
+                        'additionalProperties': False,
+                    },
+                },
+            },
+        }
+        metadata_dict = {
+            'items': [{'value': 'v%d' % i, 'tags': ['a', 'a'], 'extra%d' % (i % 3): True}
+                      for i in range(item_count)],
+        }
+
+        errors = MetadataValidator(schema).bind().validate(metadata_dict)
+
+        assert_error(errors, 'title', 'is a required property')
+        assert_error(errors, 'identifier', 'is a required property')
+        assert_error(errors, 'items/__minItems', 'Array has too few items')
+        assert len(errors['items']) == item_count + 1
+        for i in (0, item_count - 1):
+            assert_error(errors, 'items/%d/name' % i, "'name' is a required property")
+            assert_error(errors, 'items/%d/value' % i, 'is not of type')
+            assert_error(errors, 'items/%d/tags/__uniqueItems' % i, 'Array has non-unique items')
+            assert_error(errors, 'items/%d/__additionalProperties' % i, 'Additional properties are not allowed')
+
+    def test_map_init_cached_schema(self):
+        """
+        Validate two records with the same cached validator, using a schema that maps values
+        onto an array initialized by "mapInit". The mapped values of the first record must not
+        leak into the second, nor into the cached schema.
+        """
+        schema_json = json.dumps({
+            '$schema': 'http://json-schema.org/draft-07/schema#',
+            'type': 'object',
+            'mapInit': {'titles': []},
+            'properties': {
+                'title': {
+                    'type': 'string',
+                    'mapTo': {
+                        'target': '/titles/-',
+                        'value': {'type': 'object', 'properties': {'title': {'type': 'string'}}},
+                    },
+                },
+            },
+        })
+        validator_cache.clear()
+
+        results = []
+        for title in ('first', 'second'):
+            validator = validator_cache.get_validator(MetadataValidator, 'test-schema', schema_json).bind()
+            assert validator.validate({'title': title}) == {}
+            results += [validator.jsonschema_validator.root_instance]
+
+        assert validator_cache.stats()['hits'] == 1
+        assert results[0]['titles'] == [{'title': 'first'}]
+        assert results[1]['titles'] == [{'title': 'second'}]
+        assert validator.schema['mapInit'] == {'titles': []}
@@ -1,9 +1,11 @@
 # encoding: utf-8
 
 from ckan.tests import factories as ckan_factories
-from ckan.tests.helpers import call_action
+from ckan.tests.helpers import call_action, changed_config
 import ckan.plugins.toolkit as tk
+import ckan.model as ckan_model
 
+import ckanext.metadata.model as ckanext_model
 from ckanext.metadata.tests import (
     ActionTestBase,
     assert_object_matches_dict,
@@ -286,6 +288,137 @@ class TestMetadataCollectionActions(ActionTestBase):
         assert_package_has_extra(self.metadata_records[1]['id'], 'validated', True)
         assert_package_has_extra(self.metadata_records[2]['id'], 'validated', True)
 
+    def test_bulk_validate_async_chunked(self):
+        self._bulk_action_setup()
+
+        with changed_config('ckan.metadata.bulk_action_chunk_size', 1):
+            result, obj = self.test_action('metadata_collection_validate', id=self.metadata_collection['id'],
+                                           async=True)
+        assert result['total_count'] == 2
+        assert result['job_count'] == 2
+        summary = call_action('bulk_job_status', id=result['job_group_id'])
+        assert summary['jobs_done'] == 0
+        assert summary['finished'] is None
+        assert summary['eta_seconds'] is None
+
+        process_queued_tasks()
+        summary = call_action('bulk_job_status', id=result['job_group_id'])
+        assert summary['action'] == 'metadata_record_validate'
+        assert summary['jobs_done'] == 2
+        assert summary['done_count'] == 2
+        assert summary['error_count'] == 0
+        assert summary['finished'] is not None
+        assert summary['eta_seconds'] == 0
+        assert summary['object_id'] == self.metadata_collection['id']
+        assert_package_has_extra(self.metadata_records[0]['id'], 'validated', True)
+        assert_package_has_extra(self.metadata_records[2]['id'], 'validated', True)
+
+    def test_bulk_validate_async_deferred_commit(self):
+        """
+        Test that when the caller defers the commit, the bulk job is not committed and no background
+        jobs are enqueued until the caller commits, and that both are discarded on rollback.
+        """
+        self._bulk_action_setup()
+
+        result = call_action('metadata_collection_validate', context={'defer_commit': True},
+                             id=self.metadata_collection['id'], async=True)
+        ckan_model.Session.rollback()
+        assert ckanext_model.BulkJob.get(result['job_group_id']) is None
+
+        process_queued_tasks()
+        assert_package_has_extra(self.metadata_records[0]['id'], 'validated', False)
+
+        result = call_action('metadata_collection_validate', context={'defer_commit': True},
+                             id=self.metadata_collection['id'], async=True)
+        ckan_model.repo.commit()
+        process_queued_tasks()
+        summary = call_action('bulk_job_status', id=result['job_group_id'])
+        assert summary['jobs_done'] == 1
+        assert_package_has_extra(self.metadata_records[0]['id'], 'validated', True)
+
+    def test_bulk_validate_async_savepoint(self):
+        """
+        Test that background jobs enqueued within a savepoint are not enqueued when the savepoint
+        is released, but only when the outer transaction commits, and that they are discarded if
+        the savepoint is rolled back.
+        """
+        self._bulk_action_setup()
+
+        savepoint = ckan_model.Session.begin_nested()
+        result = call_action('metadata_collection_validate', context={'defer_commit': True},
+                             id=self.metadata_collection['id'], async=True)
+        savepoint.rollback()
+        ckan_model.repo.commit()
+        assert ckanext_model.BulkJob.get(result['job_group_id']) is None
+        process_queued_tasks()
+        assert_package_has_extra(self.metadata_records[0]['id'], 'validated', False)
+
+        savepoint = ckan_model.Session.begin_nested()
+        result = call_action('metadata_collection_validate', context={'defer_commit': True},
+                             id=self.metadata_collection['id'], async=True)
+        savepoint.commit()
+        process_queued_tasks()
+        assert_package_has_extra(self.metadata_records[0]['id'], 'validated', False)
+
+        ckan_model.repo.commit()
+        process_queued_tasks()
+        summary = call_action('bulk_job_status', id=result['job_group_id'])
+        assert summary['jobs_done'] == 1
+        assert_package_has_extra(self.metadata_records[0]['id'], 'validated', True)
+
+    def test_bulk_validate_serial_progress(self):
+        """
+        Test that progress is recorded per chunk in serial mode.
+        """
+        self._bulk_action_setup()
+
+        with changed_config('ckan.metadata.bulk_action_chunk_size', 1):
+            result, obj = self.test_action('metadata_collection_validate', id=self.metadata_collection['id'])
+        summary = call_action('bulk_job_status', id=result['job_group_id'])
+        assert summary['done_count'] == 2
+        assert summary['finished'] is not None
+
+    def test_bulk_validate_parallel(self):
+        self._bulk_action_setup()
+
+        result, obj = self.test_action('metadata_collection_validate', id=self.metadata_collection['id'],
+                                       mode='parallel')
+        assert result['total_count'] == 2
+        assert result['error_count'] == 0
+        assert result['failures'] == []
+        assert len(result['schema_timings']) == 1
+        assert result['schema_timings'][0]['count'] == 2
+        assert_package_has_extra(self.metadata_records[0]['id'], 'validated', True)
+        assert_package_has_extra(self.metadata_records[1]['id'], 'validated', True)
+        assert_package_has_extra(self.metadata_records[2]['id'], 'validated', True)
+
+        activity_dict = call_action('metadata_record_validation_activity_show', id=self.metadata_records[0]['id'])
+        assert activity_dict['data']['action'] == 'metadata_record_validate'
+
+    def test_bulk_validate_parallel_async(self):
+        self._bulk_action_setup()
+
+        result, obj = self.test_action('metadata_collection_validate', id=self.metadata_collection['id'],
+                                       mode='parallel', async=True)
+        assert result['total_count'] == 2
+        assert result['job_count'] == 1
+        assert_package_has_extra(self.metadata_records[0]['id'], 'validated', False)
+
+        process_queued_tasks()
+        summary = call_action('bulk_job_status', id=result['job_group_id'])
+        assert summary['jobs_done'] == 1
+        assert summary['done_count'] == 2
+        assert summary['finished'] is not None
+        assert_package_has_extra(self.metadata_records[0]['id'], 'validated', True)
+        assert_package_has_extra(self.metadata_records[2]['id'], 'validated', True)
+
+    def test_bulk_validate_invalid_mode(self):
+        self._bulk_action_setup()
+
+        result, obj = self.test_action('metadata_collection_validate', should_error=True,
+                                       id=self.metadata_collection['id'], mode='foo')
+        assert_error(result, 'mode', 'Must be one of: serial, parallel')
+
     def test_bulk_transition(self):
         self._bulk_action_setup()
 
@@ -303,6 +436,32 @@ class TestMetadataCollectionActions(ActionTestBase):
         assert_package_has_extra(self.metadata_records[1]['id'], 'workflow_state_id', self.workflow_transition_2['to_state_id'])
         assert_package_has_extra(self.metadata_records[2]['id'], 'workflow_state_id', self.workflow_transition_1['to_state_id'])
 
+    def test_bulk_transition_job_status(self):
+        self._bulk_action_setup()
+
+        result, obj = self.test_action('metadata_collection_workflow_state_transition',
+                                       id=self.metadata_collection['id'],
+                                       workflow_state_id=self.workflow_transition_2['to_state_id'])
+        assert result['error_count'] == 2
+
+        status = call_action('bulk_job_status', id=result['job_group_id'])
+        assert status['action'] == 'metadata_record_workflow_state_transition'
+        assert status['total_count'] == 3
+        assert status['done_count'] == 3
+        assert status['error_count'] == 2
+        assert status['finished'] is not None
+        assert set(error['object_id'] for error in status['errors']) == \
+            {self.metadata_records[0]['id'], self.metadata_records[2]['id']}
+        assert all(error['message'] == 'Invalid workflow state transition' for error in status['errors'])
+
+        status = call_action('bulk_job_status', id=result['job_group_id'], error_limit=1)
+        assert len(status['errors']) == 1
+
+    def test_bulk_job_status_invalid(self):
+        result, obj = self.test_action('bulk_job_status', should_error=True, exception_class=tk.ObjectNotFound,
+                                       id='foo')
+        assert 'Not found: Bulk Job' in result
+
     def test_bulk_transition_async(self):
         self._bulk_action_setup()
 
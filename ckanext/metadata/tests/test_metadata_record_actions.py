@@ -3,13 +3,23 @@
 import json
 import re
 from datetime import datetime
+from collections import Counter
 
 from ckan.tests import factories as ckan_factories
-from ckan.tests.helpers import call_action
+from ckan.tests.helpers import call_action, changed_config
+import ckan.plugins as plugins
 import ckan.plugins.toolkit as tk
 import ckan.model as ckan_model
 from ckan.lib.redis import connect_to_redis
 from ckanext.metadata.common import DOI_RE
+from ckanext.metadata.lib import validator_cache
+from ckanext.metadata.lib import attr_map_cache
+from ckanext.metadata.lib import vocabulary_cache
+from ckanext.metadata.lib import url_check
+from ckanext.metadata.lib import privilege_cache
+from ckanext.metadata.elastic import transport
+from ckanext.metadata.logic import json_validator_functions
+import ckanext.metadata.model as ckanext_model
 
 from ckanext.metadata.tests import (
     ActionTestBase,
@@ -21,6 +31,10 @@ from ckanext.metadata.tests import (
     assert_metadata_record_has_validation_schemas,
     factories as ckanext_factories,
     load_example,
+    load_archived_example,
+    import_elastic_module,
+    StubServer,
+    StubSearchAgent,
 )
 
 
@@ -145,6 +159,40 @@ class TestMetadataRecordActions(ActionTestBase):
         self._assert_metadata_record_ok(obj, input_dict,
                                         doi=input_dict['doi'].upper())
 
+    def test_create_valid_attrs_synced(self):
+        input_dict = self._make_input_dict()
+        input_dict['doi'] = '10.1234/xyz.123'
+        input_dict['sid'] = 'Some-SID'
+        result, obj = self.test_action('metadata_record_create', **input_dict)
+        attrs = ckanext_model.MetadataRecordAttrs.get(obj.id)
+        assert attrs.doi == '10.1234/XYZ.123'
+        assert attrs.sid == 'Some-SID'
+        assert attrs.metadata_collection_id == input_dict['metadata_collection_id']
+        assert attrs.metadata_standard_id == input_dict['metadata_standard_id']
+        assert attrs.workflow_state_id is None
+        assert attrs.validated is False
+
+        metadata_record = call_action('metadata_record_show', id=obj.id)
+        self._validate_metadata_record(metadata_record)
+        ckan_model.Session.refresh(attrs)
+        assert attrs.validated is True
+
+        input_dict = self._make_input_dict_from_output_dict(metadata_record)
+        input_dict['metadata_json'] = '{ "newtestkey": "newtestvalue" }'
+        self.test_action('metadata_record_update', **input_dict)
+        ckan_model.Session.refresh(attrs)
+        assert attrs.validated is False
+
+    def test_by_doi_and_sid_case_insensitive(self):
+        input_dict = self._make_input_dict()
+        input_dict['doi'] = '10.1234/xyz.123'
+        input_dict['sid'] = 'Some-SID'
+        result, obj = self.test_action('metadata_record_create', **input_dict)
+        result = call_action('metadata_record_by_doi', doi='10.1234/Xyz.123')
+        assert result['id'] == obj.id
+        result = call_action('metadata_record_by_sid', sid='some-sid')
+        assert result['id'] == obj.id
+
     def test_create_valid_auto_generate_doi(self):
         metadata_collection = self._generate_metadata_collection(organization_id=self.owner_org['id'],
                                                                  doi_collection='foo')
@@ -216,6 +264,40 @@ class TestMetadataRecordActions(ActionTestBase):
         result, obj = self.test_action('metadata_record_create', **input_dict)
         self._assert_metadata_record_ok(obj, input_dict, name=identifier, title=title, url=url)
 
+    def test_create_map_attributes_cached(self):
+        """
+        Test that the attribute map plan for a standard is reused, and that it is
+        reloaded when an attribute map for the standard is added or deleted.
+        """
+        self._define_attribute_map('/title', 'title')
+        attr_map_cache.clear()
+
+        input_dict = self._make_input_dict()
+        input_dict.update({'sid': 'sid-1', 'metadata_json': '{"title": "First", "url": "http://example.net/1"}'})
+        result, obj = self.test_action('metadata_record_create', **input_dict)
+        self._assert_metadata_record_ok(obj, input_dict, title='First')
+
+        input_dict.update({'sid': 'sid-2', 'metadata_json': '{"title": "Second", "url": "http://example.net/2"}'})
+        result, obj = self.test_action('metadata_record_create', **input_dict)
+        self._assert_metadata_record_ok(obj, input_dict, title='Second')
+        stats = attr_map_cache.stats()
+        assert stats['misses'] == 1
+        assert stats['hits'] == 1
+
+        url_attr_map = self._define_attribute_map('/url', 'url')
+        input_dict.update({'sid': 'sid-3', 'metadata_json': '{"title": "Third", "url": "http://example.net/3"}'})
+        result, obj = self.test_action('metadata_record_create', **input_dict)
+        self._assert_metadata_record_ok(obj, input_dict, title='Third', url='http://example.net/3')
+        assert attr_map_cache.stats()['misses'] == 2
+
+        call_action('metadata_json_attr_map_delete', id=url_attr_map['id'])
+        input_dict.update({'sid': 'sid-4', 'metadata_json': '{"title": "Fourth", "url": "http://example.net/4"}'})
+        result, obj = self.test_action('metadata_record_create', **input_dict)
+        self._assert_metadata_record_ok(obj, input_dict, title='Fourth')
+        stats = attr_map_cache.stats()
+        assert stats['misses'] == 3
+        assert stats['hits'] == 1
+
     def test_create_valid_map_empty_attributes(self):
         """
         Test that when values do not exist in the metadata JSON for the defined mappings,
@@ -442,6 +524,120 @@ class TestMetadataRecordActions(ActionTestBase):
         self._assert_metadata_record_ok(obj, metadata_record)
         assert obj.id == metadata_record['id']
 
+    def test_bulk_upsert(self):
+        existing_record = self._generate_metadata_record(doi='10.1234/existing')
+        new_input_dict = self._make_input_dict()
+        new_input_dict['sid'] = 'new-sid'
+        repeat_input_dict = self._make_input_dict()
+        repeat_input_dict.update({'sid': 'NEW-SID', 'title': 'Updated Title'})
+        existing_input_dict = self._make_input_dict()
+        existing_input_dict['doi'] = '10.1234/EXISTING'
+        invalid_input_dict = self._make_input_dict()
+        invalid_input_dict.update({'sid': 'invalid-sid', 'metadata_json': 'not json'})
+
+        result, obj = self.test_action('metadata_record_bulk_upsert',
+                                       records=[new_input_dict, repeat_input_dict, existing_input_dict, invalid_input_dict],
+                                       batch_size=2)
+        assert result['total_count'] == 4
+        assert result['error_count'] == 1
+        assert [item['status'] for item in result['results']] == ['created', 'updated', 'updated', 'error']
+        assert result['results'][1]['id'] == result['results'][0]['id']
+        assert result['results'][2]['id'] == existing_record['id']
+        assert 'metadata_json' in result['results'][3]['errors']
+
+        new_record = ckan_model.Package.get(result['results'][0]['id'])
+        assert new_record.title == 'Updated Title'
+        assert_package_has_extra(new_record.id, 'sid', 'NEW-SID')
+        assert ckan_model.Session.query(ckan_model.Package) \
+            .filter_by(type='metadata_record', state='active').count() == 2
+
+    def test_bulk_upsert_invalid(self):
+        result, obj = self.test_action('metadata_record_bulk_upsert', should_error=True,
+                                       records='not a list')
+        assert_error(result, 'records', 'Must be a list of dictionaries')
+
+        result, obj = self.test_action('metadata_record_bulk_upsert', should_error=True,
+                                       records=[], batch_size=0)
+        assert_error(result, 'batch_size', 'Must be a positive integer')
+
+    def test_write_path_json_parsing(self):
+        """
+        Count the parses of the metadata JSON on create and update, for the large example
+        records in schema-archived/. Each write should parse the document once (during schema
+        validation), with the parsed form being reused for the DOI check, attribute mapping,
+        package schema validation and formatting of the output.
+        """
+        parse_counts = []
+        json_loads = json.loads
+
+        def counting_loads(value, *args, **kwargs):
+            if isinstance(value, basestring) and '"parse_count_marker"' in value:
+                parse_counts[-1] += 1
+            return json_loads(value, *args, **kwargs)
+
+        for filename in ('saeon_odp_4.2_record.json', 'saeon_datacite_4.3_record.json',
+                         'saeon_iso19115_record.json', 'mims_metadata_record.json'):
+            metadata_dict = json.loads(load_archived_example(filename))
+            metadata_dict.pop('doi', None)
+            metadata_dict['parse_count_marker'] = True
+            input_dict = self._make_input_dict()
+            input_dict.update({
+                'sid': filename.replace('.json', ''),
+                'metadata_json': json.dumps(metadata_dict, indent=4),
+            })
+
+            json.loads = counting_loads
+            try:
+                parse_counts += [0]
+                metadata_record = call_action('metadata_record_create', **input_dict)
+                create_parse_count = parse_counts[-1]
+
+                metadata_dict['updated'] = True
+                metadata_record['metadata_json'] = json.dumps(metadata_dict, indent=4)
+                parse_counts += [0]
+                call_action('metadata_record_update', **metadata_record)
+                update_parse_count = parse_counts[-1]
+            finally:
+                json.loads = json_loads
+
+            assert create_parse_count == 1, filename
+            assert update_parse_count == 1, filename
+
+    def test_auth_privilege_cache(self):
+        """
+        Repeat auth checks for a contributor, with a shared context (as for the per-record
+        checks in a bulk operation) and with a fresh context per check. The user's privileges
+        should be loaded from Redis once per context.
+        """
+        self._grant_privilege(self.normal_user['id'], self.owner_org['name'], 'contributor')
+        metadata_record = self._generate_metadata_record()
+        check_count = 20
+        loads = []
+        load_privileges = privilege_cache._load_privileges
+
+        def counting_load_privileges(user_id):
+            loads.append(user_id)
+            return load_privileges(user_id)
+
+        def make_context():
+            return {'user': self.normal_user['name'], 'model': ckan_model, 'session': ckan_model.Session}
+
+        privilege_cache._load_privileges = counting_load_privileges
+        try:
+            context = make_context()
+            for _ in range(check_count):
+                assert tk.check_access('metadata_record_update', context, {'id': metadata_record['id']})
+            shared_load_count = len(loads)
+
+            for _ in range(check_count):
+                assert tk.check_access('metadata_record_update', make_context(), {'id': metadata_record['id']})
+            fresh_load_count = len(loads) - shared_load_count
+        finally:
+            privilege_cache._load_privileges = load_privileges
+
+        assert shared_load_count == 1
+        assert fresh_load_count == check_count
+
     def test_update_valid(self):
         metadata_record = self._generate_metadata_record()
         new_metadata_collection = self._generate_metadata_collection(organization_id=self.owner_org['id'])
@@ -883,6 +1079,56 @@ class TestMetadataRecordActions(ActionTestBase):
         self.test_action('metadata_record_delete',
                          id=metadata_record['id'])
 
+    def test_list_all_fields(self):
+        metadata_records = [self._generate_metadata_record() for _ in range(3)]
+        self._validate_metadata_record(metadata_records[1])
+
+        result, obj = self.test_action('metadata_record_list',
+                                       owner_org=self.owner_org['id'],
+                                       metadata_collection_id=self.metadata_collection['id'],
+                                       all_fields=True,
+                                       deserialize_json=True)
+        assert len(result) == 3
+        for record_dict in result:
+            assert record_dict == call_action('metadata_record_show', id=record_dict['id'], deserialize_json=True)
+        assert set(record_dict['id'] for record_dict in result) == set(record['id'] for record in metadata_records)
+
+    def test_list_count_only(self):
+        for _ in range(3):
+            self._generate_metadata_record()
+
+        result, obj = self.test_action('metadata_record_list',
+                                       owner_org=self.owner_org['id'],
+                                       metadata_collection_id=self.metadata_collection['id'],
+                                       count_only=True)
+        assert result == 3
+
+    def test_list_keyset_pagination(self):
+        metadata_records = [self._generate_metadata_record() for _ in range(5)]
+        all_names = call_action('metadata_record_list', owner_org=self.owner_org['id'])
+
+        names = []
+        cursor = ''
+        pages = 0
+        while cursor is not None:
+            result, obj = self.test_action('metadata_record_list',
+                                           owner_org=self.owner_org['id'],
+                                           cursor=cursor,
+                                           limit=2)
+            assert len(result['results']) <= 2
+            names += result['results']
+            cursor = result['next_cursor']
+            pages += 1
+
+        assert pages == 3
+        assert names == all_names
+        assert set(names) == set(record['name'] for record in metadata_records)
+
+    def test_list_invalid_cursor(self):
+        result, obj = self.test_action('metadata_record_list', should_error=True,
+                                       cursor='foo')
+        assert_error(result, 'cursor', 'Invalid cursor')
+
     def test_invalidate(self):
         metadata_record = self._generate_metadata_record()
         metadata_schema = self._validate_metadata_record(metadata_record)
@@ -909,6 +1155,56 @@ class TestMetadataRecordActions(ActionTestBase):
         assert_package_has_extra(metadata_record['id'], 'errors', '{}')
         self.assert_validate_activity_logged(metadata_record['id'], metadata_schema)
 
+    def test_validate_cached_validator(self):
+        metadata_record_1 = self._generate_metadata_record()
+        metadata_record_2 = self._generate_metadata_record()
+        metadata_schema = ckanext_factories.MetadataSchema(
+            metadata_standard_id=self.metadata_standard['id'])
+        validator_cache.clear()
+
+        self.test_action('metadata_record_validate', id=metadata_record_1['id'])
+        self.test_action('metadata_record_validate', id=metadata_record_2['id'])
+        stats = validator_cache.stats()
+        assert stats['misses'] == 1
+        assert stats['hits'] == 1
+        assert stats['size'] == 1
+
+        call_action('metadata_schema_update',
+                    id=metadata_schema['id'],
+                    metadata_standard_id=metadata_schema['metadata_standard_id'],
+                    organization_id='',
+                    infrastructure_id='',
+                    schema_json='{ "required": ["testkey"] }')
+        assert validator_cache.stats()['size'] == 0
+
+    def test_validate_cached_vocabulary(self):
+        """
+        Test that a vocabulary's tags are loaded once for all the keywords checked against it,
+        and that the cached tags are invalidated when a tag is added to the vocabulary.
+        """
+        vocabulary = call_action('vocabulary_create', name='test_vocabulary', tags=[{'name': 'Alpha'}])
+        ckanext_factories.MetadataSchema(
+            metadata_standard_id=self.metadata_standard['id'],
+            schema_json=json.dumps({'properties': {'keywords': {
+                'type': 'array', 'items': {'vocabulary': 'test_vocabulary'}}}}))
+        metadata_record_1 = self._generate_metadata_record(metadata_json='{"keywords": ["alpha", "ALPHA"]}')
+        metadata_record_2 = self._generate_metadata_record(metadata_json='{"keywords": ["alpha", "beta"]}')
+        vocabulary_cache.clear()
+
+        self.test_action('metadata_record_validate', id=metadata_record_1['id'])
+        assert_package_has_extra(metadata_record_1['id'], 'validated', True)
+        assert_package_has_extra(metadata_record_1['id'], 'errors', '{}')
+        stats = vocabulary_cache.stats()
+        assert stats['misses'] == 1
+        assert stats['hits'] == 1
+        assert stats['size'] == 1
+
+        call_action('tag_create', name='Beta', vocabulary_id=vocabulary['id'])
+        assert vocabulary_cache.stats()['size'] == 0
+
+        self.test_action('metadata_record_validate', id=metadata_record_2['id'])
+        assert_package_has_extra(metadata_record_2['id'], 'errors', '{}')
+
     def test_workflow_annotations_valid(self):
         metadata_record = self._generate_metadata_record()
 
@@ -989,6 +1285,66 @@ class TestMetadataRecordActions(ActionTestBase):
                                      key='metadata_json/description')
         assert_error(result, 'key', 'Must be purely lowercase alphanumeric')
 
+    def test_workflow_rules_url_test(self):
+        """
+        Test that the URLs subject to "urlTest" are checked once each, and that the results
+        are cached (including failures) for subsequent checks.
+        """
+        def respond(method, path, params):
+            return {'/ok': 200, '/login': 401}.get(path, 404), None
+
+        with StubServer(respond) as server:
+            metadata_record_json = json.dumps({
+                'links': [server.url + '/ok', server.url + '/missing', server.url + '/login', server.url + '/ok'],
+                'other': server.url + '/other',
+            })
+            workflow_rules_json = json.dumps({
+                'properties': {'links': {'type': 'array', 'items': {'type': 'string', 'urlTest': True}}},
+            })
+            url_check.clear()
+
+            for _ in range(2):
+                errors = call_action('metadata_record_workflow_rules_check',
+                                     metadata_record_json=metadata_record_json,
+                                     workflow_rules_json=workflow_rules_json)
+                assert_error(errors, 'links/1', 'URL test failed')
+                assert set(errors['links'].keys()) == {'1'}
+
+            assert server.requested_paths == Counter({'/ok': 1, '/missing': 1, '/login': 1})
+            assert url_check.stats()['hits'] == 3
+
+    def test_workflow_rules_objectid_memoized(self):
+        """
+        Test that each distinct object id is looked up once per validation run, and that
+        the memoized result is reported at every location where the id occurs.
+        """
+        lookups = []
+        check_objectid = json_validator_functions._check_objectid
+
+        def counting_check_objectid(model_name, object_id):
+            lookups.append(object_id)
+            return check_objectid(model_name, object_id)
+
+        metadata_record_json = json.dumps({
+            'orgs': [self.owner_org['id'], self.owner_org['name'], self.owner_org['id'], self.owner_org['name']],
+        })
+        workflow_rules_json = json.dumps({
+            'properties': {'orgs': {'type': 'array', 'items': {'type': 'string', 'objectid': 'organization'}}},
+        })
+
+        json_validator_functions._check_objectid = counting_check_objectid
+        try:
+            errors = call_action('metadata_record_workflow_rules_check',
+                                 metadata_record_json=metadata_record_json,
+                                 workflow_rules_json=workflow_rules_json)
+        finally:
+            json_validator_functions._check_objectid = check_objectid
+
+        assert sorted(lookups) == sorted([self.owner_org['id'], self.owner_org['name']])
+        assert set(errors['orgs'].keys()) == {'1', '3'}
+        assert_error(errors, 'orgs/1', 'Must use object id not name')
+        assert_error(errors, 'orgs/3', 'Must use object id not name')
+
     def test_workflow_transition_captured(self):
         metadata_record = self._generate_metadata_record(
             metadata_json=load_example('saeon_odp_4.2_record.json'))
@@ -1344,3 +1700,137 @@ class TestMetadataRecordActions(ActionTestBase):
         result, obj = self.test_action('metadata_record_assign_doi', should_error=True,
                                        id=metadata_record['id'])
         assert_error(result, 'message', 'The metadata record already has a DOI')
+
+    def test_index_outbox_claim(self):
+        """
+        Test that search index outbox operations are coalesced per record (last write wins),
+        that they are written only if the transaction commits, that claimed operations are
+        returned to the outbox if the claiming transaction is rolled back, and that failed
+        operations are retried until they are moved to the dead state.
+        """
+        outbox = ckanext_model.IndexOutbox
+        outbox.add('record-1', 'index-1', outbox.PUT)
+        outbox.add('record-2', 'index-1', outbox.PUT)
+        outbox.add('record-1', 'index-1', outbox.DELETE)
+        ckan_model.repo.commit()
+        outbox.add('record-3', 'index-1', outbox.PUT)
+        ckan_model.Session.rollback()
+
+        claimed = outbox.claim(10)
+        assert dict((package_id, (operation.index_name, operation.operation))
+                    for package_id, operation in claimed.iteritems()) == \
+            {'record-1': ('index-1', 'delete'), 'record-2': ('index-1', 'put')}
+        assert len(claimed['record-1'].row_ids) == 2
+        ckan_model.Session.rollback()
+
+        claimed = outbox.claim(1)
+        assert claimed.keys() == ['record-1']
+        outbox.remove(claimed['record-1'].row_ids)
+        claimed = outbox.claim(1)
+        assert claimed.keys() == ['record-2']
+        assert claimed['record-2'].attempts == 0
+        outbox.fail(claimed['record-2'].row_ids, u'Agent error', False)
+        ckan_model.repo.commit()
+
+        claimed = outbox.claim(10)
+        assert claimed.keys() == ['record-2']
+        assert claimed['record-2'].attempts == 1
+        outbox.fail(claimed['record-2'].row_ids, u'Agent error', True)
+        ckan_model.repo.commit()
+
+        assert outbox.claim(10) == {}
+        rows = ckan_model.Session.query(outbox).all()
+        assert [(row.package_id, row.state, row.attempts, row.last_error) for row in rows] == \
+            [('record-2', 'dead', 2, 'Agent error')]
+        ckan_model.repo.commit()
+
+    def test_index_outbox_relay(self):
+        """
+        Test that the outbox relay sends the pending operations to a (stub) search agent and
+        removes them, retries transient failures up to the configured number of attempts, and
+        moves rejected operations straight to the dead state.
+        """
+        relay = import_elastic_module('outbox').relay
+        outbox = ckanext_model.IndexOutbox
+        index_name = self.metadata_standard['name']
+        metadata_records = [self._generate_metadata_record() for _ in range(3)]
+        for metadata_record in metadata_records[:2]:
+            ckan_model.Package.get(metadata_record['id']).private = False
+        ckan_model.repo.commit()
+        published_ids = sorted(metadata_record['id'] for metadata_record in metadata_records[:2])
+        private_id = metadata_records[2]['id']
+
+        def outbox_rows(package_id):
+            return [(row.operation, row.state, row.attempts) for row in
+                    ckan_model.Session.query(outbox).filter_by(package_id=package_id).order_by(outbox.id)]
+
+        with StubSearchAgent() as agent, \
+                changed_config('ckan.metadata.elastic.search_agent_url', agent.url), \
+                changed_config('ckan.metadata.elastic.outbox_max_attempts', 2), \
+                changed_config('ckan.metadata.elastic.outbox_poll_interval', 0):
+            transport.clear()
+            agent.index[private_id] = {'record_id': private_id}
+            for package_id in published_ids + [published_ids[1]]:
+                outbox.add(package_id, index_name, outbox.PUT)
+            outbox.add(private_id, index_name, outbox.DELETE)
+            ckan_model.repo.commit()
+
+            relay(once=True)
+            assert sorted(agent.index) == published_ids
+            assert agent.requested_paths['/add'] == 2
+            assert agent.requested_paths['/delete'] == 1
+            assert ckan_model.Session.query(outbox).count() == 0
+
+            # transient failure: retried until the attempts are used up
+            agent.statuses['/delete'] = 503
+            outbox.add(private_id, index_name, outbox.DELETE)
+            ckan_model.repo.commit()
+            relay(once=True)
+            assert outbox_rows(private_id) == [('delete', 'pending', 1)]
+            relay(once=True)
+            assert outbox_rows(private_id) == [('delete', 'dead', 2)]
+            transport.clear()
+            agent.requested_paths.clear()
+            relay(once=True)
+            assert agent.requested_paths['/delete'] == 0
+
+            # rejected: not retried
+            agent.statuses['/add'] = 400
+            outbox.add(published_ids[0], index_name, outbox.PUT)
+            ckan_model.repo.commit()
+            relay(once=True)
+            assert outbox_rows(published_ids[0]) == [('put', 'dead', 1)]
+
+    def test_index_outbox_written(self):
+        """
+        Test that, with the search index outbox enabled, a metadata record update and workflow
+        state transition and revert each write the expected outbox operation.
+        """
+        import_elastic_module('plugin')
+        with changed_config('ckan.metadata.elastic.search_agent_url', 'http://127.0.0.1:9'):
+            plugins.load('metadata_elasticsearch')
+        try:
+            outbox = ckanext_model.IndexOutbox
+            index_name = self.metadata_standard['name']
+            metadata_record = self._generate_metadata_record()
+            workflow_state = ckanext_factories.WorkflowState(metadata_records_private=False)
+            ckanext_factories.WorkflowTransition(from_state_id='', to_state_id=workflow_state['id'])
+
+            def outbox_operations():
+                return [(row.index_name, row.operation) for row in
+                        ckan_model.Session.query(outbox).filter_by(package_id=metadata_record['id']).order_by(outbox.id)]
+
+            with changed_config('ckan.metadata.elastic.index_outbox', True):
+                self.test_action('metadata_record_workflow_state_transition', id=metadata_record['id'],
+                                 workflow_state_id=workflow_state['id'])
+                assert_package_has_attribute(metadata_record['id'], 'private', False)
+                assert outbox_operations() == [(index_name, 'put')]
+
+                self.test_action('metadata_record_update', **metadata_record)
+                assert outbox_operations() == [(index_name, 'put'), (index_name, 'put')]
+
+                self.test_action('metadata_record_workflow_state_revert', id=metadata_record['id'])
+                assert_package_has_attribute(metadata_record['id'], 'private', True)
+                assert outbox_operations() == [(index_name, 'put'), (index_name, 'put'), (index_name, 'delete')]
+        finally:
+            plugins.unload('metadata_elasticsearch')
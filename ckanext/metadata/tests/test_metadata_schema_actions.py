@@ -1,9 +1,16 @@
 # encoding: utf-8
 
+import time
+
 from ckan.tests import factories as ckan_factories
-from ckan.tests.helpers import call_action
+from ckan.tests.helpers import call_action, changed_config
+from ckan.lib.redis import connect_to_redis
+import ckan.plugins.toolkit as tk
+import ckan.model as ckan_model
 
 from ckanext.metadata import model as ckanext_model
+from ckanext.metadata.lib import revalidation_queue
+from ckanext.metadata.lib.bulk_invalidate import bulk_invalidate
 from ckanext.metadata.tests import (
     ActionTestBase,
     generate_name,
@@ -14,9 +21,16 @@ from ckanext.metadata.tests import (
     assert_metadata_schema_has_dependent_records,
     factories as ckanext_factories,
     load_example,
+    process_queued_tasks,
 )
 
 
+def _clear_revalidation_queue():
+    connect_to_redis().delete(revalidation_queue.QUEUE_KEY, revalidation_queue.QUEUED_AT_KEY,
+                              revalidation_queue.CLAIMED_KEY, revalidation_queue.CLAIMED_PRIORITY_KEY,
+                              revalidation_queue.ATTEMPTS_KEY, revalidation_queue.STATS_KEY)
+
+
 class TestMetadataSchemaActions(ActionTestBase):
 
     def _generate_and_validate_metadata_record(self, metadata_standard_id=None,
@@ -478,6 +492,152 @@ class TestMetadataSchemaActions(ActionTestBase):
         self.assert_invalidate_activity_logged(metadata_record_1['id'], 'metadata_schema_update', obj)
         self.assert_invalidate_activity_logged(metadata_record_2['id'], 'metadata_schema_update', obj)
 
+    def test_update_json_invalidate_records_revalidate(self):
+        """
+        Update the JSON of a schema with the revalidate option. The dependent records should be
+        invalidated, and then revalidated by the background jobs.
+        """
+        metadata_record_1, _, metadata_schema = self._generate_and_validate_metadata_record()
+        metadata_record_2 = self._generate_and_validate_metadata_record_using_schema(metadata_schema)
+
+        result, obj = self.test_action('metadata_schema_update',
+                                       id=metadata_schema['id'],
+                                       metadata_standard_id=metadata_schema['metadata_standard_id'],
+                                       organization_id='',
+                                       infrastructure_id='',
+                                       schema_json='{ "newtestkey": "newtestvalue" }',
+                                       revalidate=True)
+
+        for metadata_record in (metadata_record_1, metadata_record_2):
+            assert_package_has_extra(metadata_record['id'], 'validated', False)
+            assert_package_has_extra(metadata_record['id'], 'errors', '{}')
+            assert ckanext_model.MetadataRecordAttrs.get(metadata_record['id']).validated is False
+            self.assert_invalidate_activity_logged(metadata_record['id'], 'metadata_schema_update', obj)
+        summary = call_action('bulk_job_status', id=result['revalidation_job_group_id'])
+        assert summary['action'] == 'metadata_record_validate'
+        assert summary['object_id'] == metadata_schema['id']
+        assert summary['total_count'] == 2
+        assert summary['jobs_done'] == 0
+
+        process_queued_tasks()
+        for metadata_record in (metadata_record_1, metadata_record_2):
+            assert_package_has_extra(metadata_record['id'], 'validated', True)
+            assert ckanext_model.MetadataRecordAttrs.get(metadata_record['id']).validated is True
+        summary = call_action('bulk_job_status', id=result['revalidation_job_group_id'])
+        assert summary['done_count'] == 2
+        assert summary['error_count'] == 0
+
+    def test_update_json_invalidate_records_message(self):
+        """
+        The revision message given in the context should be applied to the invalidation.
+        """
+        metadata_record, _, metadata_schema = self._generate_and_validate_metadata_record()
+
+        call_action('metadata_schema_update', context={'user': self.normal_user['name'], 'message': 'Fix schema'},
+                    id=metadata_schema['id'],
+                    metadata_standard_id=metadata_schema['metadata_standard_id'],
+                    organization_id='',
+                    infrastructure_id='',
+                    schema_json='{ "newtestkey": "newtestvalue" }')
+
+        assert_package_has_extra(metadata_record['id'], 'validated', False)
+        activity_dict = call_action('metadata_record_validation_activity_show', id=metadata_record['id'])
+        assert activity_dict['data']['action'] == 'metadata_record_invalidate'
+        assert ckan_model.Session.query(ckan_model.Revision).get(activity_dict['revision_id']).message == 'Fix schema'
+
+    def test_bulk_invalidate_invalid_user(self):
+        metadata_record, _, metadata_schema = self._generate_and_validate_metadata_record()
+        context = {'model': ckan_model, 'session': ckan_model.Session, 'user': ''}
+        try:
+            bulk_invalidate(context, [metadata_record['id']])
+            assert False, "Expected ValidationError"
+        except tk.ValidationError, e:
+            assert 'user_id' in e.error_dict
+        ckan_model.Session.rollback()
+        assert_package_has_extra(metadata_record['id'], 'validated', True)
+
+    def test_update_json_invalidate_records_revalidation_queue(self):
+        """
+        Update the JSON of a schema with the revalidation queue enabled. The dependent records
+        should be queued once each, and then revalidated by the worker.
+        """
+        _clear_revalidation_queue()
+        metadata_record_1, _, metadata_schema = self._generate_and_validate_metadata_record()
+        metadata_record_2 = self._generate_and_validate_metadata_record_using_schema(metadata_schema)
+
+        with changed_config('ckan.metadata.revalidation_queue', True):
+            self.test_action('metadata_schema_update',
+                             id=metadata_schema['id'],
+                             metadata_standard_id=metadata_schema['metadata_standard_id'],
+                             organization_id='',
+                             infrastructure_id='',
+                             schema_json='{ "newtestkey": "newtestvalue" }')
+            call_action('metadata_record_invalidate', id=metadata_record_1['id'])
+
+            queue_status = call_action('revalidation_queue_status')
+            assert queue_status['enabled'] is True
+            assert queue_status['depth'] == 2
+            for metadata_record in (metadata_record_1, metadata_record_2):
+                assert_package_has_extra(metadata_record['id'], 'validated', False)
+
+            revalidation_queue.drain(once=True)
+            assert call_action('revalidation_queue_status')['depth'] == 0
+            for metadata_record in (metadata_record_1, metadata_record_2):
+                assert_package_has_extra(metadata_record['id'], 'validated', True)
+
+    def test_invalidate_revalidation_queue_savepoint(self):
+        """
+        Invalidate records within savepoints, with the revalidation queue enabled. A record
+        should be queued only once the outer transaction commits, and not at all if its
+        savepoint is rolled back.
+        """
+        _clear_revalidation_queue()
+        metadata_record_1, _, metadata_schema = self._generate_and_validate_metadata_record()
+        metadata_record_2 = self._generate_and_validate_metadata_record_using_schema(metadata_schema)
+
+        with changed_config('ckan.metadata.revalidation_queue', True):
+            savepoint = ckan_model.Session.begin_nested()
+            call_action('metadata_record_invalidate', context={'defer_commit': True}, id=metadata_record_1['id'])
+            savepoint.rollback()
+            savepoint = ckan_model.Session.begin_nested()
+            call_action('metadata_record_invalidate', context={'defer_commit': True}, id=metadata_record_2['id'])
+            savepoint.commit()
+            assert call_action('revalidation_queue_status')['depth'] == 0
+
+            ckan_model.repo.commit()
+            assert call_action('revalidation_queue_status')['depth'] == 1
+            assert_package_has_extra(metadata_record_1['id'], 'validated', True)
+            assert_package_has_extra(metadata_record_2['id'], 'validated', False)
+
+    def test_revalidation_queue_claim_expiry(self):
+        """
+        A record claimed by a worker that stops before committing its revalidation should be
+        put back in the queue when the claim expires, and dropped once it has been claimed
+        the maximum number of times.
+        """
+        _clear_revalidation_queue()
+        metadata_record, _, metadata_schema = self._generate_and_validate_metadata_record()
+
+        with changed_config('ckan.metadata.revalidation_queue', True), \
+                changed_config('ckan.metadata.revalidation_claim_timeout', 1), \
+                changed_config('ckan.metadata.revalidation_max_attempts', 2):
+            call_action('metadata_record_invalidate', id=metadata_record['id'])
+            assert revalidation_queue.claim(10) == [metadata_record['id']]
+            queue_status = call_action('revalidation_queue_status')
+            assert queue_status['depth'] == 0
+            assert queue_status['claimed_count'] == 1
+
+            time.sleep(1.1)
+            assert revalidation_queue.claim(10) == [metadata_record['id']]
+            time.sleep(1.1)
+            assert revalidation_queue.claim(10) == []
+            queue_status = call_action('revalidation_queue_status')
+            assert queue_status['depth'] == 0
+            assert queue_status['claimed_count'] == 0
+            assert queue_status['dropped_count'] == 1
+            assert queue_status['lag_seconds'] == 0
+            assert_package_has_extra(metadata_record['id'], 'validated', False)
+
     def test_update_json_invalidate_records_2(self):
         """
         Update the JSON of a schema that was used to validate existing metadata records that are associated with
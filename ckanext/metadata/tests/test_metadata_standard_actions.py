@@ -1,8 +1,13 @@
 # encoding: utf-8
 
-from ckan.tests.helpers import call_action
+import socket
+
+import requests
+from ckan.tests.helpers import call_action, changed_config
+import ckan.model as ckan_model
 
 from ckanext.metadata import model as ckanext_model
+from ckanext.metadata.elastic import transport
 from ckanext.metadata.tests import (
     ActionTestBase,
     make_uuid,
@@ -10,6 +15,9 @@ from ckanext.metadata.tests import (
     assert_object_matches_dict,
     assert_error,
     factories as ckanext_factories,
+    import_elastic_module,
+    StubServer,
+    StubSearchAgent,
 )
 
 
@@ -294,3 +302,175 @@ class TestMetadataStandardActions(ActionTestBase):
         self.test_action('metadata_standard_delete',
                          id=metadata_standard['id'])
         assert ckanext_model.MetadataSchema.get(metadata_schema['id']).state == 'deleted'
+
+    def test_search_agent_transport(self):
+        """
+        Test that requests to a (stub) search agent are retried on transient errors, that the
+        circuit breaker fails fast once the agent is down, and that latencies are recorded.
+        """
+        responses = {
+            '/flaky': iter([503, 503, 200]),
+            '/down': iter([503] * 100),
+            '/bad': iter([400]),
+            '/create_index': iter([503, 200]),
+        }
+
+        def respond(method, path, params):
+            status = next(responses[path])
+            return status, {'success': status == 200}
+
+        with StubServer(respond) as server:
+            requested_paths = server.requested_paths
+            agent = transport.AgentTransport(connect_timeout=1, read_timeout=1, pool_size=2, retries=2,
+                                             backoff=0.01, backoff_max=0.05,
+                                             breaker_threshold=2, breaker_reset=60)
+
+            assert agent.post(server.url + '/flaky', {'index': 'test'}).json() == {'success': True}
+            assert requested_paths['/flaky'] == 3
+
+            try:
+                agent.post(server.url + '/bad', {})
+                assert False, "Expected HTTPError"
+            except requests.HTTPError:
+                pass
+            assert requested_paths['/bad'] == 1
+            assert agent.breaker.state == 'closed'
+
+            for _ in range(2):
+                try:
+                    agent.post(server.url + '/down', {})
+                    assert False, "Expected HTTPError"
+                except requests.HTTPError:
+                    pass
+            assert requested_paths['/down'] == 6
+            assert agent.breaker.state == 'open'
+
+            try:
+                agent.post(server.url + '/flaky', {})
+                assert False, "Expected AgentUnavailable"
+            except transport.AgentUnavailable:
+                pass
+            assert requested_paths['/down'] == 6
+
+            stats = agent.stats()
+            assert stats['circuit'] == 'open'
+            assert stats['endpoints']['/flaky']['count'] == 3
+            assert stats['endpoints']['/flaky']['errors'] == 2
+            assert stats['endpoints']['/down']['count'] == 6
+            assert sum(stats['endpoints']['/down']['buckets'].values()) == 6
+
+            # a request that is not idempotent is retried only if it could not be sent
+            agent = transport.AgentTransport(connect_timeout=1, read_timeout=1, pool_size=2, retries=2,
+                                             backoff=0.01, backoff_max=0.05,
+                                             breaker_threshold=10, breaker_reset=60)
+            try:
+                agent.post(server.url + '/create_index', {'index': 'test'}, idempotent=False)
+                assert False, "Expected HTTPError"
+            except requests.HTTPError:
+                pass
+            assert requested_paths['/create_index'] == 1
+
+            unused_socket = socket.socket()
+            unused_socket.bind(('127.0.0.1', 0))
+            unused_port = unused_socket.getsockname()[1]
+            unused_socket.close()
+            try:
+                agent.post('http://127.0.0.1:%d/delete_index' % unused_port, {'index': 'test'}, idempotent=False)
+                assert False, "Expected ConnectionError"
+            except requests.ConnectionError:
+                pass
+            assert agent.stats()['endpoints']['/delete_index']['count'] == 3
+
+    def test_index_audit(self):
+        """
+        Test the search index audit against a (stub) search agent: that missing, stale and
+        orphaned documents are reported, and that a repair fixes just those documents.
+        """
+        audit = import_elastic_module('audit')
+
+        metadata_standard = ckanext_factories.MetadataStandard()
+        metadata_records = [ckanext_factories.MetadataRecord(metadata_standard_id=metadata_standard['id'])
+                            for _ in range(4)]
+        for metadata_record in metadata_records[:3]:
+            ckan_model.Package.get(metadata_record['id']).private = False
+        ckan_model.repo.commit()
+        published_ids = sorted(metadata_record['id'] for metadata_record in metadata_records[:3])
+
+        with StubSearchAgent() as agent:
+            index = agent.index
+            requested_paths = agent.requested_paths
+            transport.clear()
+            standard = ckanext_model.MetadataStandard.get(metadata_standard['id'])
+            with changed_config('ckan.metadata.elastic.search_agent_url', agent.url), \
+                    changed_config('ckan.metadata.elastic.bulk_batch_size', 2):
+                report = audit.audit_index(ckan_model.Session, standard, repair=True)
+                assert sorted(report['missing']) == published_ids
+                assert sorted(index) == published_ids
+
+                del index[published_ids[0]]
+                index[published_ids[1]]['organization'] = 'Changed Title'
+                index['orphaned-record'] = {'record_id': 'orphaned-record'}
+                requested_paths.clear()
+
+                report = audit.audit_index(ckan_model.Session, standard)
+                assert report['missing'] == [published_ids[0]]
+                assert report['stale'] == [published_ids[1]]
+                assert report['orphaned'] == ['orphaned-record']
+                assert (report['db_count'], report['index_count']) == (3, 3)
+                assert set(requested_paths) == {'/search'}
+
+                report = audit.audit_index(ckan_model.Session, standard, repair=True)
+                assert report['repair_failed'] == 0
+                assert requested_paths['/delete'] == 1
+                assert sorted(index) == published_ids
+
+                report = audit.audit_index(ckan_model.Session, standard)
+                assert report['missing'] == report['stale'] == report['orphaned'] == []
+
+    def test_index_metadata_records(self):
+        """
+        Test that published records are added to a (stub) search index - by one request per
+        record, or by bulk requests if enabled - and other records removed, and that records
+        whose requests are rejected are counted as failed.
+        """
+        bulk_index = import_elastic_module('bulk_index')
+
+        metadata_standard = ckanext_factories.MetadataStandard()
+        metadata_records = [ckanext_factories.MetadataRecord(metadata_standard_id=metadata_standard['id'])
+                            for _ in range(4)]
+        for metadata_record in metadata_records[:3]:
+            ckan_model.Package.get(metadata_record['id']).private = False
+        ckan_model.repo.commit()
+        published_ids = sorted(metadata_record['id'] for metadata_record in metadata_records[:3])
+        private_id = metadata_records[3]['id']
+        criteria = [ckanext_model.MetadataRecordAttrs.metadata_standard_id == metadata_standard['id']]
+
+        for bulk in (False, True):
+            with StubSearchAgent(bulk=bulk) as agent, \
+                    changed_config('ckan.metadata.elastic.search_agent_url', agent.url), \
+                    changed_config('ckan.metadata.elastic.bulk_batch_size', 2), \
+                    changed_config('ckan.metadata.elastic.bulk_add', bulk):
+                transport.clear()
+                agent.index[private_id] = {'record_id': private_id}
+
+                counts = bulk_index.index_metadata_records(ckan_model.Session, criteria, async=False)
+                assert counts == {'records_added': 3, 'records_removed': 1, 'records_failed': 0}
+                assert sorted(agent.index) == published_ids
+                assert agent.index[published_ids[0]]['metadata_json'] == \
+                    ckan_model.Package.get(published_ids[0]).extras['metadata_json']
+                assert agent.requested_paths['/delete'] == 1
+                if bulk:
+                    assert agent.requested_paths['/add_bulk'] == 2
+                    assert agent.requested_paths['/add'] == 0
+                else:
+                    assert agent.requested_paths['/add'] == 3
+                    assert agent.requested_paths['/add_bulk'] == 0
+
+        # an agent that does not provide add_bulk rejects the bulk requests
+        with StubSearchAgent(bulk=False) as agent, \
+                changed_config('ckan.metadata.elastic.search_agent_url', agent.url), \
+                changed_config('ckan.metadata.elastic.bulk_add', True):
+            transport.clear()
+            counts = bulk_index.index_metadata_records(ckan_model.Session, criteria, async=False)
+            assert counts['records_failed'] == 3
+            assert agent.index == {}